@@ -1,17 +1,31 @@
 #!/usr/bin/python
+import ctypes
+import errno
+import heapq
 import json
 import os
+import queue
 import sys
 import re
+import shlex
+import shutil
+import socket
+import subprocess
+import threading
+import time
 
 import requests
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import jsonpickle
 from pprint import pprint
-from clint.textui import progress
-from urllib3.exceptions import IncompleteRead
 
 import helpers.upnp as upnp
+from helpers.catalogue import Catalogue
+from helpers.client import FetchClient
+from helpers.download import (CONST_LOCK, get_short_length, get_written_size, is_live, open_stream, record_written,
+                              remove_written)
+from helpers.proxy import RecordingProxy, SegmentCache, create_server
 
 try:
     from urlparse import urlparse
@@ -19,49 +33,278 @@ except ImportError:
     from urllib.parse import urlparse
 
 SAVE_FILE = "fetchtv_save_list.json"
-FETCHTV_PORT = 49152
-CONST_LOCK = '.lock'
+DUPLICATES_FILE = "fetchtv_duplicates.json"
+CATALOGUE_FILE = "fetchtv_catalogue.db"
+CACHE_DIR = "fetchtv_cache"
+THROUGHPUT_FILE = "fetchtv_throughput.json"
+RECORDING_EXTENSION = 'mpeg'
+DEFAULT_TRANSCODE_EXTENSION = 'mp4'
 MAX_FILENAME = 255
 REQUEST_TIMEOUT = 5
-MAX_OCTET = 4398046510080
+STREAM_TIMEOUT = 30
+STALE_LOCK = 600
+LOCK_OWNER = '.owner'
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+MAX_OCTET = upnp.MAX_OCTET
+DEFAULT_WORKERS = 1
+DEFAULT_PROCESSES = 1
+MAX_PROCESS_ERROR = 500
+MIN_FREE_SPACE = 100 * 1024 * 1024
+PREALLOCATE_MIN = 1024 * 1024
+CHECKPOINT_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 8192
+DEFAULT_BUFFER = 16
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 30
+FOLLOW_POLL = 10
+FOLLOW_IDLE = 120
+DISK_FULL_SKIP = 'skip'
+DISK_FULL_DEFER = 'defer'
+OVERWRITE_CHANGED = 'changed'
+DUPLICATES_SKIP = 'skip'
+DUPLICATES_LINK = 'link'
+DUPLICATE_DURATION_TOLERANCE = 60
+DUPLICATE_SIZE_TOLERANCE = 0.02
+THROUGHPUT_SAMPLES = 100
+DAY_SECONDS = 24 * 60 * 60
+WINDOW_POLL = 60
+DEFAULT_PROXY_PORT = 8080
+DEFAULT_CACHE_LIMIT = 10
+
+PRINT_LOCK = threading.Lock()
+# Set when the run is interrupted, so the downloads in progress stop
+STOPPING = threading.Event()
 
 
 class SavedFiles:
     """
     FetchTV recorded items that have already been saved
-    Serialised to and from JSON
+    Serialised to and from JSON, each server namespace has its own file
     """
+    _LOCK = threading.Lock()
 
     @staticmethod
-    def load(path):
+    def get_filename(path, namespace=''):
+        if not namespace:
+            return path + os.path.sep + SAVE_FILE
+        name, ext = os.path.splitext(SAVE_FILE)
+        return path + os.path.sep + f'{name}_{create_valid_filename(namespace)}{ext}'
+
+    @staticmethod
+    def load(path, namespace='', legacy=False):
         """
         Instantiate from JSON file, if it exists
+        A new namespace is seeded from the shared file saved before servers had their own, when legacy is set as
+        it can only be this server's
         """
-        with open(path + os.path.sep + SAVE_FILE, "a+") as read_file:
+        with open(SavedFiles.get_filename(path, namespace), "a+") as read_file:
             read_file.seek(0)
             content = read_file.read()
             inst = jsonpickle.loads(content) if content else SavedFiles()
             inst.path = path
-            return inst
+            inst.namespace = namespace
+            try:
+                inst.__details
+            except AttributeError:
+                # Saved before file details were recorded
+                inst.__details = {}
+        if namespace and legacy and not content and os.path.exists(SavedFiles.get_filename(path)):
+            # Saved before servers had their own files, e.g. with --ip, so they aren't saved again
+            legacy = SavedFiles.load(path)
+            inst.__files.update(legacy.__files)
+            inst.__details.update(legacy.__details)
+        return inst
 
     def __init__(self):
         self.__files = {}
+        self.__details = {}
         self.path = ''
-
-    def add_file(self, item):
-        self.__files[item.id] = item.title
-        # Serialise after each success
-        with open(self.path + os.path.sep + SAVE_FILE, "w") as write_file:
-            write_file.write(jsonpickle.dumps(self))
+        self.namespace = ''
+
+    def add_file(self, item, file_path=None):
+        with SavedFiles._LOCK:
+            self.__files[item.id] = item.title
+            if file_path:
+                # Used to check if the file has changed since it was saved
+                stat = os.stat(file_path)
+                # The final output path, which may differ from the recording's, e.g. transcoded to another format
+                self.__details[item.id] = {'size': item.size, 'bytes': stat.st_size, 'mtime': stat.st_mtime,
+                                           'path': file_path}
+            # Serialise after each success
+            with open(SavedFiles.get_filename(self.path, self.namespace), "w") as write_file:
+                write_file.write(jsonpickle.dumps(self))
 
     def contains(self, item):
         return item.id in self.__files.keys()
 
+    def get_path(self, item):
+        """
+        Return where the item was saved, or None if it wasn't recorded
+        """
+        return self.__details.get(item.id, {}).get('path')
+
+    def is_unchanged(self, item, file_path):
+        """
+        Returns True if the saved file is complete and matches the server's recording
+        Uses the details recorded when the file was saved, otherwise the file size must match the item size
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        details = self.__details.get(item.id)
+        if not details:
+            return stat.st_size == item.size
+        return (details['size'] == item.size and details['bytes'] == stat.st_size and
+                details['mtime'] == stat.st_mtime)
+
+
+class DuplicateIndex:
+    """
+    Recordings that have been saved, indexed by normalised show and title, so repeats of the same broadcast can
+    be found before they're downloaded. Matches must also have a similar duration and size.
+    Serialised to and from JSON, shared by all servers saving to the same path
+    """
+    _LOCK = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        """
+        Instantiate from JSON file, if it exists
+        """
+        with open(path + os.path.sep + DUPLICATES_FILE, "a+") as read_file:
+            read_file.seek(0)
+            content = read_file.read()
+            inst = jsonpickle.loads(content) if content else DuplicateIndex()
+            inst.path = path
+            return inst
+
+    @staticmethod
+    def get_key(item):
+        return f'{normalise_title(item.parent_name)}|{normalise_title(item.title)}'
+
+    def __init__(self):
+        self.__entries = {}
+        self.path = ''
+
+    def __getstate__(self):
+        # Only serialise recordings that have been saved
+        entries = {key: [entry for entry in entries if entry['file']] for key, entries in self.__entries.items()}
+        return {'entries': entries, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.__entries = state['entries']
+        self.path = state['path']
+
+    def find(self, item):
+        """
+        Return the index entry of a saved, or currently saving, duplicate of the item
+        If there isn't one the item is added to the index as currently saving
+        """
+        with DuplicateIndex._LOCK:
+            for entry in self.__entries.get(DuplicateIndex.get_key(item), []):
+                if (entry['id'] != item.id and
+                        abs(entry['duration'] - item.duration) <= DUPLICATE_DURATION_TOLERANCE and
+                        abs(entry['size'] - item.size) <= entry['size'] * DUPLICATE_SIZE_TOLERANCE and
+                        (not entry['file'] or os.path.exists(entry['file']))):
+                    return entry
+            self.__add(item)
+            return None
+
+    def add(self, item):
+        """
+        Add an item to the index as currently saving
+        """
+        with DuplicateIndex._LOCK:
+            self.__add(item)
+
+    def __add(self, item):
+        self.__entries.setdefault(DuplicateIndex.get_key(item), []).append(
+            {'id': item.id, 'title': item.title, 'duration': item.duration, 'size': item.size, 'file': None})
+
+    def finish(self, item, file_path=None):
+        """
+        Record the file an item was saved to, or remove it from the index if it wasn't saved
+        """
+        with DuplicateIndex._LOCK:
+            entries = self.__entries.get(DuplicateIndex.get_key(item), [])
+            entry = next((entry for entry in entries if entry['id'] == item.id), None)
+            if not entry:
+                return
+            if not file_path:
+                entries.remove(entry)
+                return
+            entry['file'] = file_path
+            # Serialise after each success
+            with open(self.path + os.path.sep + DUPLICATES_FILE, "w") as write_file:
+                write_file.write(jsonpickle.dumps(self))
+
+
+class ThroughputHistory:
+    """
+    Bytes and time taken by recent downloads, used to estimate how long saving the pending recordings will take
+    Serialised to and from JSON, shared by all servers saving to the same path
+    """
+    _LOCK = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        """
+        Instantiate from JSON file, if it exists
+        """
+        with open(path + os.path.sep + THROUGHPUT_FILE, "a+") as read_file:
+            read_file.seek(0)
+            content = read_file.read()
+            inst = jsonpickle.loads(content) if content else ThroughputHistory()
+            inst.path = path
+            return inst
+
+    def __init__(self):
+        self.samples = []
+        self.path = ''
+
+    def add(self, size, seconds):
+        """
+        Record a completed download, only the most recent THROUGHPUT_SAMPLES are kept
+        """
+        if size <= 0 or seconds <= 0:
+            return
+        with ThroughputHistory._LOCK:
+            self.samples = self.samples[-(THROUGHPUT_SAMPLES - 1):] + [[size, seconds]]
+            with open(self.path + os.path.sep + THROUGHPUT_FILE, "w") as write_file:
+                write_file.write(jsonpickle.dumps(self))
+
+    def get_rate(self):
+        """
+        Average bytes per second of a single download, or None if nothing has been downloaded yet
+        """
+        seconds = sum(sample[1] for sample in self.samples)
+        return sum(sample[0] for sample in self.samples) / seconds if seconds else None
+
+    def estimate(self, sizes, workers=DEFAULT_WORKERS):
+        """
+        Estimate the seconds taken to download files of the given sizes, in order, with the number of workers
+        Each worker is assumed to download at the historical rate
+        """
+        rate = self.get_rate()
+        if not rate:
+            return None
+        finish_times = [0.0] * max(1, min(workers, len(sizes)))
+        for size in sizes:
+            # The next download starts on the worker that finishes first
+            heapq.heappush(finish_times, heapq.heappop(finish_times) + size / rate)
+        return max(finish_times)
+
 
 class Options:
     PARAM_COMMANDS = ['help', 'info', 'shows', 'recordings', 'isrecording']
-    PARAM_OPTIONS = ['ip', 'port', 'save', 'folder', 'title', 'overwrite', 'exclude', 'new', 'json']
-    PARAM_MULTI_VALUE = ['title', 'folder', 'exclude']
+    PARAM_OPTIONS = ['ip', 'port', 'save', 'folder', 'title', 'overwrite', 'exclude', 'new', 'json', 'ndjson',
+                     'servers', 'workers', 'postprocess', 'processes',
+                     'retries', 'diskfull', 'duplicates', 'catalogue', 'refresh', 'search', 'segments',
+                     'buffer', 'follow', 'plan', 'adaptive', 'window', 'proxy', 'cachedir', 'cachelimit',
+                     'from-manifest', 'transcode', 'extension', 'staging']
+    PARAM_MULTI_VALUE = ['title', 'folder', 'exclude', 'servers', 'window']
 
     INSTANCE = None
 
@@ -70,6 +313,8 @@ class Options:
         self.has_command = False
         self.set_commands(argv)
         self.set_options(argv)
+        self.set_choice('duplicates', [DUPLICATES_SKIP, DUPLICATES_LINK])
+        self.set_choice('diskfull', [DISK_FULL_SKIP, DISK_FULL_DEFER])
 
         if self.save:
             self.__dict['save'] = self.save.rstrip(os.path.sep)
@@ -92,7 +337,7 @@ class Options:
             if not val:
                 self.__dict[opt] = False
                 continue
-            val = str(val).split('=')
+            val = str(val).split('=', 1)
 
             if len(val) == 1:  # No value provided
                 val = True
@@ -105,6 +350,16 @@ class Options:
             else:
                 self.__dict[opt] = val
 
+    def set_choice(self, opt, choices):
+        """
+        Check an option's value is one of its choices, the first is the default when it's given without a value
+        """
+        val = self.__dict[opt]
+        if val is True:
+            self.__dict[opt] = choices[0]
+        elif val and val not in choices:
+            raise ValueError(f'Invalid --{opt} value, expected {"|".join(choices)}: {val}')
+
     @property
     def help(self):
         return self.__dict['help']
@@ -157,39 +412,1032 @@ class Options:
     def json(self):
         return self.__dict['json']
 
+    @property
+    def ndjson(self):
+        return self.__dict['ndjson']
+
+    @property
+    def servers(self):
+        return self.__dict['servers']
+
+    @property
+    def workers(self):
+        return self.__dict['workers']
+
+    @property
+    def postprocess(self):
+        return self.__dict['postprocess']
+
+    @property
+    def processes(self):
+        return self.__dict['processes']
+
+    @property
+    def retries(self):
+        return self.__dict['retries']
+
+    @property
+    def disk_full(self):
+        return self.__dict['diskfull']
+
+    @property
+    def duplicates(self):
+        return self.__dict['duplicates']
+
+    @property
+    def catalogue(self):
+        return self.__dict['catalogue']
+
+    @property
+    def refresh(self):
+        return self.__dict['refresh']
+
+    @property
+    def search(self):
+        return self.__dict['search']
+
+    @property
+    def segments(self):
+        return self.__dict['segments']
+
+    @property
+    def buffer(self):
+        return self.__dict['buffer']
+
+    @property
+    def follow(self):
+        return self.__dict['follow']
+
+    @property
+    def plan(self):
+        return self.__dict['plan']
+
+    @property
+    def adaptive(self):
+        return self.__dict['adaptive']
+
+    @property
+    def window(self):
+        return self.__dict['window']
+
+    @property
+    def proxy(self):
+        return self.__dict['proxy']
+
+    @property
+    def cache_dir(self):
+        return self.__dict['cachedir']
+
+    @property
+    def cache_limit(self):
+        return self.__dict['cachelimit']
+
+    @property
+    def from_manifest(self):
+        return self.__dict['from-manifest']
+
+    @property
+    def transcode(self):
+        return self.__dict['transcode']
+
+    @property
+    def extension(self):
+        return self.__dict['extension']
+
+    @property
+    def staging(self):
+        return self.__dict['staging']
+
+
+class SpacePlanner:
+    """
+    Reserves disk space for each recording before it's queued, so downloads aren't started that can't fit
+    Items that won't fit are either skipped, or all remaining items are deferred to the next run
+    """
+
+    def __init__(self, policy=DISK_FULL_SKIP):
+        self.policy = policy
+        self.deferred = False
+        self.__free = {}
+        self.__reserved = {}
+        self.__lock = threading.Lock()
+
+    def reserve(self, directory, size, file_path=None):
+        """
+        Returns True if the space could be reserved on the directory's volume
+        Space reserved for a file path is kept until finish is called for it
+        """
+        device = os.stat(directory).st_dev
+        with self.__lock:
+            if device not in self.__free:
+                self.__free[device] = shutil.disk_usage(directory).free - MIN_FREE_SPACE
+            if self.deferred:
+                return False
+            if size > self.__free[device]:
+                self.deferred = self.policy == DISK_FULL_DEFER
+                return False
+            self.__free[device] -= size
+            if file_path:
+                # A list, the same file path can be queued by several servers
+                self.__reserved.setdefault(file_path, []).append((directory, size))
+            return True
+
+    def release(self, directory, size):
+        """
+        Return space reserved on the directory's volume, once it's no longer needed
+        """
+        device = os.stat(directory).st_dev
+        with self.__lock:
+            if device in self.__free:
+                self.__free[device] += size
+
+    def finish(self, file_path, saved):
+        """
+        Done with the space reserved for a file path, it's returned unless the file was saved and is using it
+        """
+        with self.__lock:
+            reserved = self.__reserved.get(file_path)
+            if not reserved:
+                return
+            directory, size = reserved.pop()
+            if not reserved:
+                del self.__reserved[file_path]
+        if not saved:
+            self.release(directory, size)
+
+
+class TransferPaused(Exception):
+    """
+    Raised when a download is paused because its transfer window has closed
+    """
+
+
+class TransferStopped(Exception):
+    """
+    Raised when a download is stopped because the run was interrupted, e.g. with Ctrl+C
+    The lock file is kept so the download can be resumed by the next run
+    """
+
+
+def check_stopping():
+    if STOPPING.is_set():
+        raise TransferStopped()
+
+
+class TransferWindows:
+    """
+    Times of day when recordings can be downloaded, e.g. 01:00-06:00, a window ending before it starts runs
+    past midnight. Downloads wait for a window to open, and are paused when it closes so they can continue
+    from where they stopped in the next window
+    """
+
+    def __init__(self, windows):
+        self.windows = [TransferWindows.parse(window) for window in windows]
+        self.closed = True
+        self.__lock = threading.Lock()
+        self.__timer = None
+
+    @staticmethod
+    def parse(window):
+        """
+        Return the start and end of a window as seconds since midnight
+        """
+        match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', window.strip())
+        if not match:
+            raise ValueError(f'Invalid time window, expected HH:MM-HH:MM: {window}')
+        hour, minute, end_hour, end_minute = [int(value) for value in match.groups()]
+        return (hour * 60 + minute) * 60 % DAY_SECONDS, (end_hour * 60 + end_minute) * 60 % DAY_SECONDS
+
+    @staticmethod
+    def get_seconds(now=None):
+        now = now or datetime.now()
+        return now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1000000
+
+    def get_wait(self, now=None):
+        """
+        Seconds until a window opens, 0 if one is open
+        """
+        seconds = TransferWindows.get_seconds(now)
+        if self.get_remaining(now):
+            return 0
+        return min((start - seconds) % DAY_SECONDS for start, end in self.windows)
+
+    def get_remaining(self, now=None):
+        """
+        Seconds until the open windows close, 0 if none are open
+        """
+        seconds = TransferWindows.get_seconds(now)
+        remaining = 0
+        for start, end in self.windows:
+            if start == end:
+                # Open all day
+                return DAY_SECONDS
+            if (seconds - start) % DAY_SECONDS < (end - start) % DAY_SECONDS:
+                remaining = max(remaining, (end - seconds) % DAY_SECONDS)
+        return remaining
+
+    def wait(self, lock_file=None):
+        """
+        Wait for a window to open, and schedule it to close
+        The lock file of a paused download, and its owner, are touched while waiting, so they aren't taken to be
+        abandoned
+        Returns the seconds spent waiting
+        """
+        start = time.monotonic()
+        delay = self.get_wait()
+        if delay:
+            print_item(f'Waiting {format_duration(delay)} for the next download window', level=2)
+        while delay:
+            time.sleep(min(delay, WINDOW_POLL))
+            check_stopping()
+            for path in [lock_file, lock_file + LOCK_OWNER] if lock_file else []:
+                if os.path.exists(path):
+                    os.utime(path)
+            delay = self.get_wait()
+        with self.__lock:
+            self.closed = False
+            if not self.__timer:
+                self.__timer = threading.Timer(self.get_remaining(), self.__close)
+                self.__timer.daemon = True
+                self.__timer.start()
+        return time.monotonic() - start
+
+    def __close(self):
+        with self.__lock:
+            self.closed = True
+            self.__timer = None
+
+
+class SaveSession:
+    """
+    State shared by all the saves in a run, which may be from several servers to the same path
+    """
+
+    def __init__(self, options):
+        self.planner = SpacePlanner(options.disk_full or DISK_FULL_SKIP)
+        self.duplicates = DuplicateIndex.load(options.save) if options.duplicates else None
+        self.throughput = ThroughputHistory.load(options.save)
+        self.windows = TransferWindows(options.window) if options.window else None
+
+
+class PostProcessor:
+    """
+    Runs a command on each saved recording, e.g. comskip or ffmpeg
+    Commands run in a bounded pool so they overlap with the downloads that are still running
+    """
+
+    def __init__(self, command, processes=DEFAULT_PROCESSES, callback=None):
+        self.args = shlex.split(command, posix=os.name != 'nt')
+        self.callback = callback
+        self.__executor = ThreadPoolExecutor(max_workers=processes)
+        self.__futures = []
+
+    def submit(self, item, file_path, result):
+        result['postprocess'] = {'status': 'pending'}
+        self.__futures.append(self.__executor.submit(self.run, item, file_path, result))
+
+    def run(self, item, file_path, result):
+        """
+        Run the command for a saved file, replacing the {file}, {folder} and {title} placeholders
+        """
+        args = [arg.replace('{file}', file_path)
+                   .replace('{folder}', os.path.dirname(file_path))
+                   .replace('{title}', item.title) for arg in self.args]
+        status = {'command': subprocess.list2cmdline(args)}
+        try:
+            process = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            status['returncode'] = process.returncode
+            status['status'] = 'success' if process.returncode == 0 else 'failed'
+            if process.returncode != 0:
+                status['error'] = process.stderr.decode(errors='replace')[-MAX_PROCESS_ERROR:].strip()
+        except OSError as err:
+            status['status'] = 'failed'
+            status['error'] = str(err)
+
+        if status['status'] != 'success':
+            print_error(f'Post-processing failed for [{item.title}]: {status["error"]}', level=2)
+        result['postprocess'] = status
+        if self.callback:
+            self.callback(item, file_path, result)
+
+    def cancel(self):
+        """
+        Don't run the queued commands
+        """
+        for future in self.__futures:
+            future.cancel()
+
+    def shutdown(self):
+        """
+        Wait for all the commands to finish
+        """
+        self.__executor.shutdown(wait=True)
+        for future in self.__futures:
+            future.result()
+
+
+class FileMover:
+    """
+    Moves saved recordings from a staging directory to the save path in the background, so downloads are written
+    to a fast local disk and don't wait on a slow one, e.g. a NAS share
+    Files are renamed when both paths are on the same file system, otherwise they're copied then removed
+    """
+
+    def __init__(self, staging, path, planner=None):
+        self.staging = staging
+        self.path = path
+        self.planner = planner
+        # One at a time, moves to the same disk don't benefit from running at once
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__futures = []
+        self.__reserved = {}
+        self.__lock = threading.Lock()
+
+    def get_staged_path(self, file_path):
+        """
+        Where a recording is saved before it's moved to the file path, the same folders under the staging directory
+        """
+        return os.path.join(self.staging, os.path.relpath(file_path, self.path))
+
+    def reserve(self, file_path, size):
+        """
+        Returns True if the space could be reserved on the staging volume, until the recording has been moved
+        Nothing more is needed when it's the same volume as the file path, the recording is only renamed
+        """
+        staged_dir = os.path.dirname(self.get_staged_path(file_path))
+        os.makedirs(staged_dir, exist_ok=True)
+        if not self.planner or os.stat(staged_dir).st_dev == os.stat(os.path.dirname(file_path)).st_dev:
+            return True
+        if not self.planner.reserve(staged_dir, size):
+            return False
+        with self.__lock:
+            self.__reserved[file_path] = size
+        return True
+
+    def release(self, file_path):
+        with self.__lock:
+            size = self.__reserved.pop(file_path, None)
+        if size is not None:
+            self.planner.release(os.path.dirname(self.get_staged_path(file_path)), size)
+
+    def finish(self, file_path, moved):
+        """
+        Done with the space reserved for a recording on both volumes, the file path's is returned unless it was moved
+        """
+        self.release(file_path)
+        if self.planner:
+            self.planner.finish(file_path, moved)
+
+    def submit(self, item, staged_path, file_path, result, callback):
+        """
+        Queue a saved recording to be moved, callback(moved) is called once it has been moved or has failed
+        """
+        future = self.__executor.submit(self.run, item, staged_path, file_path, result, callback)
+        # A move that's cancelled before it starts doesn't need its space
+        future.add_done_callback(lambda f: f.cancelled() and self.finish(file_path, False))
+        self.__futures.append(future)
+
+    def run(self, item, staged_path, file_path, result, callback):
+        try:
+            self.move(staged_path, file_path)
+            moved = True
+        except OSError as err:
+            # The staged file is kept, so it isn't lost
+            msg = f'Error moving [{item.title}] from the staging directory: {err}'
+            print_error(msg, level=2)
+            result['error'] = msg
+            moved = False
+        self.finish(file_path, moved)
+        callback(moved)
+
+    @staticmethod
+    def move(staged_path, file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            os.replace(staged_path, file_path)
+            return
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+        # On another file system, copied to a lock file first so a partial copy isn't mistaken for a saved file
+        lock_file = file_path + CONST_LOCK
+        try:
+            shutil.copyfile(staged_path, lock_file)
+            os.replace(lock_file, file_path)
+        except OSError:
+            if os.path.exists(lock_file):
+                os.remove(lock_file)
+            raise
+        os.remove(staged_path)
+
+    def cancel(self):
+        """
+        Don't start the queued moves, the recordings are kept in the staging directory
+        """
+        for future in self.__futures:
+            future.cancel()
+
+    def shutdown(self):
+        """
+        Wait for all the recordings to be moved
+        """
+        self.__executor.shutdown(wait=True)
+        for future in self.__futures:
+            future.result()
+
+
+class BufferedWriter:
+    """
+    Writes chunks to a file on its own thread, so a slow disk doesn't stall the network reads and a slow
+    network doesn't stall the disk. The chunks waiting to be written are capped at buffer_size bytes.
+    The time each side spent waiting for the other is recorded, to show which one is the bottleneck
+    """
+
+    def __init__(self, f, buffer_size):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.error = None
+        self.bytes_written = 0
+        self.buffered = 0
+        self.peak_buffered = 0
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize=max(1, buffer_size // CHUNK_SIZE))
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def write(self, chunk):
+        """
+        Queue a chunk to be written, waiting while the buffer is full
+        Raises the writer's error, if it has failed
+        """
+        if self.error:
+            raise self.error
+        with self.__lock:
+            self.buffered += len(chunk)
+            self.peak_buffered = max(self.peak_buffered, self.buffered)
+        try:
+            self.__queue.put_nowait(chunk)
+        except queue.Full:
+            # Disk is slower than the network
+            start = time.monotonic()
+            self.__queue.put(chunk)
+            self.read_wait += time.monotonic() - start
+
+    def close(self):
+        """
+        Wait for the queued chunks to be written
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            try:
+                chunk = self.__queue.get_nowait()
+            except queue.Empty:
+                # Network is slower than the disk
+                start = time.monotonic()
+                chunk = self.__queue.get()
+                self.write_wait += time.monotonic() - start
+            if chunk is None:
+                return
+            with self.__lock:
+                self.buffered -= len(chunk)
+            if self.error:
+                # Keep draining so the reader isn't blocked
+                continue
+            try:
+                self.f.write(chunk)
+                self.bytes_written += len(chunk)
+            except OSError as err:
+                self.error = err
+
+    def get_stats(self):
+        return {
+            'buffer': self.buffer_size,
+            'peak': self.peak_buffered,
+            'read_wait': round(self.read_wait, 3),
+            'write_wait': round(self.write_wait, 3)
+        }
+
+
+class CheckpointedFile:
+    """
+    Records how many bytes of a preallocated lock file have been written, every CHECKPOINT_SIZE bytes, so a run
+    that's killed before the unwritten space is released resumes from the written bytes, not the preallocated size
+    """
+
+    def __init__(self, f, lock_file, interval=CHECKPOINT_SIZE):
+        self.f = f
+        self.lock_file = lock_file
+        self.interval = interval
+        self.__unrecorded = 0
+
+    def write(self, chunk):
+        self.f.write(chunk)
+        self.__unrecorded += len(chunk)
+        if self.__unrecorded >= self.interval:
+            # Only what has reached the file system is recorded
+            self.f.flush()
+            record_written(self.lock_file, self.f.tell())
+            self.__unrecorded = 0
+
+
+class Transfer:
+    """
+    Bytes received for a download, updated on every chunk so kept as cheap as possible
+    """
+    __slots__ = ['title', 'total', 'bytes']
+
+    def __init__(self, title, total):
+        self.title = title
+        self.total = total
+        self.bytes = 0
+
+
+class ProgressReporter:
+    """
+    Reports the combined progress of all the active downloads at a fixed interval, from its own thread
+    Downloads only add the bytes they receive to their Transfer. The status line is redrawn in place on a terminal,
+    otherwise a log line is written every PROGRESS_LOG_INTERVAL seconds
+    """
+
+    def __init__(self, stream=None, interval=None):
+        self.stream = stream
+        self.interval = interval
+        self.__lock = threading.Lock()
+        self.__transfers = []
+        self.__finished_bytes = 0
+        self.__thread = None
+        self.__last_bytes = 0
+        self.__last_time = None
+        self.__rate = 0.0
+        self.__line_length = 0
+
+    def get_stream(self):
+        return self.stream or sys.stderr
+
+    def is_tty(self):
+        stream = self.get_stream()
+        return hasattr(stream, 'isatty') and stream.isatty()
+
+    def get_interval(self):
+        if self.interval:
+            return self.interval
+        return PROGRESS_INTERVAL if self.is_tty() else PROGRESS_LOG_INTERVAL
+
+    def start(self, title, total):
+        transfer = Transfer(title, total)
+        with self.__lock:
+            self.__transfers.append(transfer)
+            if not self.__thread:
+                self.__last_bytes = self.__finished_bytes
+                self.__last_time = time.monotonic()
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+        return transfer
+
+    def finish(self, transfer):
+        with self.__lock:
+            if transfer in self.__transfers:
+                self.__transfers.remove(transfer)
+                self.__finished_bytes += transfer.bytes
+
+    def get_status(self):
+        """
+        Return the number of active downloads, bytes received and expected, rate in bytes per second and ETA
+        """
+        with self.__lock:
+            transfers = list(self.__transfers)
+            finished_bytes = self.__finished_bytes
+        received = sum(transfer.bytes for transfer in transfers)
+        total = sum(transfer.total for transfer in transfers if transfer.total)
+
+        now = time.monotonic()
+        moved = finished_bytes + received
+        if self.__last_time and now > self.__last_time:
+            rate = (moved - self.__last_bytes) / (now - self.__last_time)
+            # Smooth the rate so the ETA doesn't jump around
+            self.__rate = rate if not self.__rate else self.__rate * 0.7 + rate * 0.3
+        self.__last_bytes = moved
+        self.__last_time = now
+
+        remaining = max(total - sum(transfer.bytes for transfer in transfers if transfer.total), 0)
+        eta = remaining / self.__rate if self.__rate > 0 else None
+        return {'active': len(transfers), 'bytes': received, 'total': total, 'rate': self.__rate, 'eta': eta}
+
+    def format_status(self, status):
+        text = f'{status["active"]} downloading, {format_size(status["bytes"])}'
+        if status['total']:
+            text += f' of {format_size(status["total"])}'
+        text += f', {format_size(status["rate"])}/s'
+        if status['eta'] is not None:
+            text += f', ETA {format_duration(status["eta"])}'
+        return text
+
+    def report(self):
+        text = self.format_status(self.get_status())
+        stream = self.get_stream()
+        with PRINT_LOCK:
+            if self.is_tty():
+                stream.write('\r' + text.ljust(self.__line_length))
+                self.__line_length = len(text)
+            else:
+                stream.write(f'\t -- {text}\n')
+            stream.flush()
+
+    def __run(self):
+        while True:
+            time.sleep(self.get_interval())
+            with self.__lock:
+                if not self.__transfers:
+                    self.__thread = None
+                    break
+            self.report()
+        if self.is_tty() and self.__line_length:
+            with PRINT_LOCK:
+                self.get_stream().write('\r' + ' ' * self.__line_length + '\r')
+                self.get_stream().flush()
+            self.__line_length = 0
+
+
+PROGRESS = ProgressReporter()
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def normalise_title(title):
+    """
+    Normalise a title so repeats of the same broadcast match
+    e.g. 'S4 E2 - And the DJ Face - Wed 01 Jul' = 's4 e2 and the dj face'
+    """
+    # Remove the recording date
+    title = re.sub(r'\s+-\s+(Mon|Tue|Wed|Thu|Fri|Sat|Sun)\s+\d{1,2}\s+[A-Za-z]{3}$', '', title or '')
+    return re.sub(r'[\W_]+', ' ', title).strip().lower()
+
+
+def create_valid_filename(filename):
+    result = filename.strip()
+    # Remove special characters
+    for c in '<>:"/\\|?*':
+        result = result.replace(c, '')
+    # Remove whitespace
+    for c in '\t ':
+        result = result.replace(c, '_')
+    return result[:MAX_FILENAME]
+
+
+def download_file(item, filename, json_result, resume=False, segments=1, buffer_size=DEFAULT_BUFFER * 1024 * 1024,
+                  follow=False, windows=None):
+    """
+    Download the url contents to a file
+    Dropped connections are retried, continuing from the bytes already written to the lock file
+    Large files can be downloaded in several segments at once, if the server supports range requests
+    Up to buffer_size bytes are held in memory while they're written, a buffer_size of 0 writes each chunk as
+    it's read
+    Items that are currently recording are skipped, unless follow is set
+    Downloads are paused when the transfer windows close, and continue once they open again
+    """
+    print_item('Writing: [%s] to [%s]' % (item.title, filename))
+    if windows:
+        wait_for_window(windows, filename + CONST_LOCK, json_result)
+    if segments > 1 and not resume:
+        saved = download_segments(item, filename, json_result, segments)
+        if saved is not None:
+            return saved
+        print_warning('Server doesn\'t support range requests, downloading as a single stream', level=2)
+
+    breaker = upnp.get_circuit_breaker(item.url)
+    delays = upnp.RETRY_POLICY.delays()
+    while True:
+        try:
+            if windows:
+                wait_for_window(windows, filename + CONST_LOCK, json_result)
+            breaker.check(item.url)
+            saved = write_stream(item, filename, json_result, resume, buffer_size, follow, windows)
+            breaker.success()
+            return saved
+        except TransferPaused:
+            print_item('Download window closed, pausing: [%s]' % item.title, level=2)
+            resume = True
+            continue
+        except upnp.UpnpError as err:
+            msg = f'Error writing file: {err}'
+        except requests.exceptions.RequestException as err:
+            breaker.failure()
+            msg = f'Error writing file: {err}'
+            delay = next(delays, None)
+            if delay is not None:
+                print_warning(f'{msg}, retrying in {delay:.1f} seconds', level=2)
+                time.sleep(delay)
+                resume = os.path.exists(filename + CONST_LOCK)
+                continue
+
+        print_error(msg, level=2)
+        json_result['error'] = msg
+        return False
+
+
+def wait_for_window(windows, lock_file, json_result):
+    """
+    Wait for a transfer window to open, adding the time paused to the result, so it isn't counted as transfer time
+    """
+    paused = windows.wait(lock_file)
+    if paused:
+        json_result['paused'] = json_result.get('paused', 0) + paused
+
+
+def transcode_file(item, file_path, json_result, command, windows=None):
+    """
+    Pipe the recording straight into a command's stdin, e.g. ffmpeg remuxing it to MP4, without saving the raw
+    recording first. The {file}, {folder} and {title} placeholders in the command are replaced, {file} being the
+    lock file the command writes to, which is renamed to file_path once the command succeeds
+    Dropped connections are retried from the beginning, the command can't continue from where it stopped, as are
+    transcodes paused when the transfer windows close
+    """
+    print_item('Transcoding: [%s] to [%s]' % (item.title, file_path))
+    breaker = upnp.get_circuit_breaker(item.url)
+    delays = upnp.RETRY_POLICY.delays()
+    while True:
+        try:
+            if windows:
+                wait_for_window(windows, get_lock_file(file_path, transcoding=True), json_result)
+            breaker.check(item.url)
+            saved = transcode_stream(item, file_path, json_result, command, windows)
+            breaker.success()
+            return saved
+        except TransferPaused:
+            print_item('Download window closed, pausing: [%s]' % item.title, level=2)
+            continue
+        except upnp.UpnpError as err:
+            msg = f'Error transcoding file: {err}'
+        except requests.exceptions.RequestException as err:
+            breaker.failure()
+            msg = f'Error transcoding file: {err}'
+            delay = next(delays, None)
+            if delay is not None:
+                print_warning(f'{msg}, retrying in {delay:.1f} seconds', level=2)
+                time.sleep(delay)
+                continue
+
+        print_error(msg, level=2)
+        json_result['error'] = msg
+        return False
+
+
+def transcode_stream(item, file_path, json_result, command, windows=None):
+    """
+    Write the media stream to the command's stdin. While the pipe is full the stream isn't read, so the Fetch
+    Server only sends as fast as the command can process it
+    The command's exit status is recorded in the result, and its output renamed to file_path if it succeeds
+    Network errors are raised so the transfer can be retried, TransferPaused is raised if the windows close
+    """
+    lock_file = get_lock_file(file_path, transcoding=True)
+    args = [arg.replace('{file}', lock_file)
+               .replace('{folder}', os.path.dirname(file_path))
+               .replace('{title}', item.title) for arg in shlex.split(command, posix=os.name != 'nt')]
+    status = {'command': subprocess.list2cmdline(args), 'bytes': 0}
+    json_result['transcode'] = status
+    with requests.get(item.url, stream=True, timeout=STREAM_TIMEOUT) as r:
+        if 400 <= r.status_code < 500:
+            raise upnp.UpnpError(msg=f'Request failed with status: {r.status_code}')
+        r.raise_for_status()
+        if is_live(r):
+            msg = 'Skipping item it\'s currently recording'
+            print_warning(msg, level=2)
+            json_result['warning'] = msg
+            return False
+
+        # A partial output from an earlier attempt would make the command prompt to overwrite it
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+        try:
+            process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE)
+        except OSError as err:
+            raise upnp.UpnpError(msg=f'Unable to run [{status["command"]}]: {err}')
+        # The command writes the lock file, so it's still active if this process is killed while the command finishes
+        claim_lock(lock_file, process.pid)
+        # Read on its own thread, a command blocked writing to a full stderr pipe would stop reading stdin
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+        reader.start()
+
+        transfer = PROGRESS.start(item.title, int(r.headers.get('content-length', 0)))
+        try:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                check_stopping()
+                if chunk:  # filter out keep-alive new chunks
+                    process.stdin.write(chunk)
+                    transfer.bytes += len(chunk)
+                    status['bytes'] += len(chunk)
+                    if windows and windows.closed:
+                        raise TransferPaused()
+        except BrokenPipeError:
+            # The command exited early, its exit status has the reason
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            if os.path.exists(lock_file):
+                os.remove(lock_file)
+            raise
+        finally:
+            PROGRESS.finish(transfer)
+            try:
+                # End of the input for the command
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    status['returncode'] = process.wait()
+    reader.join()
+    if status['returncode'] != 0 or not os.path.exists(lock_file):
+        status['status'] = 'failed'
+        if status['returncode'] != 0:
+            status['error'] = (errors[0] if errors else b'').decode(errors='replace')[-MAX_PROCESS_ERROR:].strip()
+        else:
+            status['error'] = 'No output written to {file}'
+        msg = f'Transcoding failed for [{item.title}]: {status["error"]}'
+        print_error(msg, level=2)
+        json_result['error'] = msg
+        if os.path.exists(lock_file):
+            os.remove(lock_file)
+        return False
+
+    status['status'] = 'success'
+    os.replace(lock_file, file_path)
+    return True
 
-def create_valid_filename(filename):
-    result = filename.strip()
-    # Remove special characters
-    for c in '<>:"/\\|?*':
-        result = result.replace(c, '')
-    # Remove whitespace
-    for c in '\t ':
-        result = result.replace(c, '_')
-    return result[:MAX_FILENAME]
+
+def get_range_length(url):
+    """
+    Return the full length of the url if the server supports range requests, otherwise None
+    """
+    with requests.get(url, stream=True, headers={'Range': 'bytes=0-0'}, timeout=REQUEST_TIMEOUT) as r:
+        match = re.match(r'bytes\s+0-0/(\d+)$', r.headers.get('content-range', ''))
+        if r.status_code != 206 or not match:
+            return None
+        return int(match.group(1))
 
 
-def download_file(item, filename, json_result):
+def download_segments(item, filename, json_result, segments):
     """
-    Download the url contents to a file
+    Download byte ranges of the url over several connections at once, writing each at its offset in the lock file
+    The lock file is only renamed once all the ranges are complete
+    Returns None if the server doesn't support range requests
     """
-    print_item('Writing: [%s] to [%s]' % (item.title, filename))
-    with requests.get(item.url, stream=True) as r:
-        r.raise_for_status()
+    try:
+        total_length = get_range_length(item.url)
+    except requests.exceptions.RequestException:
+        return None
+    if not total_length or total_length == MAX_OCTET:
+        return None
+
+    lock_file = filename + CONST_LOCK
+    try:
+        with open(lock_file, 'xb') as f:
+            preallocate(f, total_length)
+    except FileExistsError:
+        msg = 'Already writing (lock file exists) skipping'
+        print_warning(msg, level=2)
+        json_result['warning'] = msg
+        return False
+    # The ranges are written out of order, so a lock file left by an interrupted run is restarted from the beginning,
+    # whether or not it was preallocated
+    record_written(lock_file, 0)
+
+    size = -(-total_length // segments)
+    ranges = [(start, min(start + size, total_length) - 1) for start in range(0, total_length, size)]
+    print_item(f'Downloading {total_length} bytes in {len(ranges)} segments', level=2)
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            received = list(executor.map(lambda r: download_segment(item.url, lock_file, *r, title=item.title),
+                                         ranges))
+        incomplete = [start for (start, end), length in zip(ranges[:-1], received) if length != end - start + 1]
+        if incomplete:
+            raise upnp.UpnpError(msg=f'Incomplete segments starting at {incomplete}')
+    except (IOError, upnp.UpnpError) as err:
+        os.remove(lock_file)
+        remove_written(lock_file)
+        msg = f'Error writing file: {err}'
+        print_error(msg, level=2)
+        json_result['error'] = msg
+        return False
+
+    actual_length = ranges[-1][0] + received[-1]
+    if actual_length != total_length:
+        # Known issue where the media stream is shorter than its reported size
+        msg = f'Handling known issue where content header size {total_length}, doesn\'t match actual size {actual_length}, continuing...'
+        print_warning(msg, level=2)
+        json_result['warning'] = msg
+        with open(lock_file, 'r+b') as f:
+            f.truncate(actual_length)
+    os.rename(lock_file, filename)
+    remove_written(lock_file)
+    return True
+
+
+def download_segment(url, lock_file, start, end, title=None):
+    """
+    Write a byte range of the url at its offset in the lock file
+    Dropped connections are retried, continuing from the bytes already received
+    Returns the number of bytes written, the last range can be short if the server over-reports the size
+    """
+    delays = upnp.RETRY_POLICY.delays()
+    position = start
+    transfer = PROGRESS.start(title or url, end - start + 1)
+    try:
+        with open(lock_file, 'r+b') as f:
+            while position <= end:
+                try:
+                    with requests.get(url, stream=True, headers={'Range': f'bytes={position}-{end}'},
+                                      timeout=STREAM_TIMEOUT) as r:
+                        if r.status_code == 416 and position > start:
+                            # No more data available
+                            break
+                        if r.status_code != 206:
+                            raise upnp.UpnpError(msg=f'Range request failed with status: {r.status_code}')
+                        f.seek(position)
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            check_stopping()
+                            if chunk:  # filter out keep-alive new chunks
+                                f.write(chunk)
+                                position += len(chunk)
+                                transfer.bytes += len(chunk)
+                    break
+                except requests.exceptions.RequestException:
+                    delay = next(delays, None)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+    finally:
+        PROGRESS.finish(transfer)
+    return position - start
+
+
+def write_stream(item, filename, json_result, resume=False, buffer_size=0, follow=False, windows=None):
+    """
+    Write the media stream to the lock file, and rename it once complete
+    When resuming only the bytes missing from the lock file are requested
+    Network errors are raised so the download can be retried, TransferPaused is raised if the windows close
+    """
+    lock_file = filename + CONST_LOCK
+    r, offset = open_stream(requests.get, item.url, lock_file, resume, STREAM_TIMEOUT)
+    with r:
         total_length = int(r.headers.get('content-length'))
-        if total_length == MAX_OCTET:
+        live = is_live(r)
+        if live and not follow:
             msg = 'Skipping item it\'s currently recording'
             print_warning(msg, level=2)
             json_result['warning'] = msg
             return False
 
         try:
-            bytes_written = 0
-            with open(filename + CONST_LOCK, 'xb') as f:
-                for chunk in progress.bar(r.iter_content(chunk_size=8192), expected_size=(total_length / 8192) + 1):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        bytes_written += len(chunk)
+            mode = 'ab' if offset else 'wb' if resume else 'xb'
+            with open(lock_file, mode) as f:
+                if live:
+                    print_item('Following recording in progress', level=2)
+                    follow_stream(item, f, r, offset)
+                    json_result['followed'] = True
+                else:
+                    out = f
+                    if not offset and preallocate(f, total_length):
+                        out = CheckpointedFile(f, lock_file)
+                    writer = BufferedWriter(out, buffer_size) if buffer_size else out
+                    transfer = PROGRESS.start(item.title, total_length)
+                    try:
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            check_stopping()
+                            if chunk:  # filter out keep-alive new chunks
+                                writer.write(chunk)
+                                transfer.bytes += len(chunk)
+                                if windows and windows.closed:
+                                    raise TransferPaused()
+                    finally:
+                        PROGRESS.finish(transfer)
+                        if writer is not out:
+                            writer.close()
+                            json_result['backpressure'] = writer.get_stats()
+                        # Release any preallocated space that wasn't written
+                        f.truncate(f.tell())
+                        remove_written(lock_file)
+                    if writer is not out and writer.error:
+                        raise writer.error
 
         except FileExistsError:
             msg = 'Already writing (lock file exists) skipping'
@@ -198,78 +1446,373 @@ def download_file(item, filename, json_result):
             return False
 
         except IOError as err:
-            handled_error = False
-            try:
-                if isinstance(err.args[0].args[1], IncompleteRead):
-                    # Check if incomplete read is likely due to a bad content-length in the media stream
-                    content_length = int(r.headers.get('content-length'))
-                    actual_length = int(r.raw.tell())
-                    if content_length != actual_length:
-                        msg = f'Handling known issue where content header size {total_length}, doesn\'t match actual size {actual_length}, continuing...'
-                        print_warning(msg, level=2)
-                        json_result['warning'] = msg
-                        handled_error = True
-            except (IndexError, AttributeError):
-                # Some other error occurred
-                pass
-
-            if not handled_error:
+            actual_length = get_short_length(err, r)
+            if actual_length is not None:
+                msg = f'Handling known issue where content header size {total_length}, doesn\'t match actual size {actual_length}, continuing...'
+                print_warning(msg, level=2)
+                json_result['warning'] = msg
+            else:
+                if isinstance(err, requests.exceptions.RequestException):
+                    # Network error, the partial download is kept so it can be resumed
+                    raise
                 msg = f'Error writing file: {err}'
                 print_error(msg, level=2)
                 json_result['error'] = msg
                 return False
 
-        os.rename(filename + CONST_LOCK, filename)
+        os.rename(lock_file, filename)
+        return True
+
+
+def follow_stream(item, f, response, position=0):
+    """
+    Write a recording that's still in progress, reconnecting from the end of the file each time the stream
+    runs out. Finishes once the server reports the recording is complete, or it stops growing for FOLLOW_IDLE seconds
+    """
+    transfer = PROGRESS.start(item.title, 0)
+    idle_since = time.monotonic()
+    try:
+        while True:
+            received = 0
+            live = True
+            if response is not None:
+                with response:
+                    if response.status_code == 200 and position:
+                        # Range not supported, start from the beginning
+                        f.seek(0)
+                        f.truncate()
+                        position = 0
+                    if response.status_code in (200, 206):
+                        live = is_live(response)
+                        try:
+                            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                                check_stopping()
+                                if chunk:  # filter out keep-alive new chunks
+                                    f.write(chunk)
+                                    received += len(chunk)
+                                    transfer.bytes += len(chunk)
+                        except requests.exceptions.RequestException:
+                            # Dropped, or timed out waiting for more of the recording
+                            live = True
+            position += received
+            if not live:
+                # Recording complete, and everything has been received
+                return
+
+            if received:
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since >= FOLLOW_IDLE:
+                print_warning(f'Recording stopped growing after {position} bytes, finishing', level=2)
+                return
+            time.sleep(FOLLOW_POLL)
+            check_stopping()
+            try:
+                response = requests.get(item.url, stream=True, headers={'Range': f'bytes={position}-'},
+                                        timeout=STREAM_TIMEOUT)
+            except requests.exceptions.RequestException:
+                response = None
+    finally:
+        PROGRESS.finish(transfer)
+
+
+def preallocate(f, size):
+    """
+    Reserve the space for a file up front, so it's written contiguously and fails fast if the disk is full
+    Returns True if the space was reserved, the bytes written are then recorded next to the file as they're unknown
+    from its size, until the unwritten space is released
+    """
+    if size < PREALLOCATE_MIN or not hasattr(os, 'posix_fallocate'):
+        return False
+    record_written(f.name, 0)
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
         return True
+    except OSError as err:
+        remove_written(f.name)
+        if err.errno == errno.ENOSPC:
+            raise
+        # Not supported by the file system, e.g. a network share
+        return False
 
 
-def get_fetch_recordings(location, options):
+def get_fetch_recordings(location, options, server=None):
     """
     Return all FetchTV recordings, or only for a particular folder if specified
     """
+    return list(iter_fetch_recordings(location, options, server))
+
+
+def iter_fetch_recordings(location, options, server=None):
+    """
+    Yield each matching FetchTV recording folder as soon as it has been browsed.
+    Folders are tagged with the server name when provided.
+    """
+    criteria = get_search_criteria(options)
+    folder_filter = get_folder_filter(options)
+    folders = search_fetch_folders(location, criteria, get_browse_filter(options), folder_filter) if criteria else None
+    if folders is None:
+        controller = get_controller(options, f'Browse {get_server_name(location)}', upnp.ADAPTIVE_MAX)
+        folders = iter_fetch_folders(location, get_browse_filter(options), controller, folder_filter,
+                                     with_items=not options.shows)
+    for result in iter_recording_items(options, folders):
+        if server:
+            result['server'] = server
+        yield result
+
+
+def iter_fetch_folders(location, browse_filter=upnp.FILTER_ALL, controller=None, folder_filter=None,
+                       with_items=True):
+    """
+    Yield every FetchTV recording folder, with its items, as soon as it has been browsed
+    The folders are browsed concurrently when a ConcurrencyController is provided
+    Folders that don't match the folder_filter aren't browsed
+    """
     api_service = upnp.get_services(location)
-    base_folders = upnp.find_directories(api_service)
+    base_folders = upnp.iter_directories(api_service, browse_filter=upnp.FILTER_TITLES, with_items=False)
     recording = [folder for folder in base_folders if folder.title == 'Recordings']
     if len(recording) == 0:
-        return []
-    recordings = upnp.find_directories(api_service, recording[0].id)
-    return filter_recording_items(options, recordings)
+        return
+    yield from upnp.iter_directories(api_service, recording[0].id, browse_filter, with_items, controller,
+                                     folder_filter)
+
+
+def search_fetch_folders(location, criteria, browse_filter=upnp.FILTER_ALL, folder_filter=None):
+    """
+    Return every FetchTV recording folder, with only the items matching the search criteria.
+    Only the folders are browsed, the items are found with a single search of the recordings.
+    Returns None when the server doesn't support searching, so the items can be browsed instead
+    """
+    try:
+        api_service = upnp.get_services(location)
+        if not api_service.search:
+            return None
+        base_folders = upnp.iter_directories(api_service, browse_filter=upnp.FILTER_TITLES, with_items=False)
+        recording = [folder for folder in base_folders if folder.title == 'Recordings']
+        if len(recording) == 0:
+            return []
+        return upnp.search_folders(api_service, recording[0].id, criteria, browse_filter, folder_filter)
+    except upnp.UpnpError as err:
+        print_warning(f'Search failed, browsing all recordings instead: {err}')
+        return None
+
+
+def get_manifest_recordings(location, options, server=None):
+    """
+    Return the recordings listed in the --from-manifest file, grouped by folder, without browsing the recordings.
+    Items with a listed URL and folder are used as is, the rest are looked up with a BrowseMetadata request each.
+    Folders are tagged with the server name when provided, and only its items are included
+    """
+    api_service = None
+    folders = {}
+    for entry in read_manifest(options.from_manifest):
+        if server and entry.get('server') and entry['server'] != server:
+            continue
+        if entry.get('url') and entry.get('folder'):
+            item = upnp.Item.from_values({
+                'type': 'object.item.videoItem',
+                'id': str(entry['id']),
+                'parent_id': str(entry.get('folder_id', '')),
+                'parent_name': entry['folder'],
+                'title': entry.get('title', ''),
+                'description': entry.get('description', ''),
+                'url': entry['url'],
+                'size': int(entry.get('size', 0)),
+                'duration': entry.get('duration', 0)
+            })
+        else:
+            api_service = api_service or upnp.get_services(location)
+            item = upnp.find_metadata(api_service, entry['id'], get_browse_filter(options))
+            if item is None:
+                print_warning(f'Recording not found on the Fetch Server: [{entry["id"]}]', level=1)
+                continue
+        folder = folders.get(item.parent_id)
+        if folder is None:
+            folder = upnp.Folder.from_values({'id': item.parent_id, 'title': entry.get('folder') or item.parent_name})
+            folders[item.parent_id] = folder
+        folder.items.append(item)
+
+    results = list(iter_recording_items(options, folders.values()))
+    for result in results:
+        if server:
+            result['server'] = server
+    return results
+
+
+def read_manifest(path):
+    """
+    Return the items listed in a manifest, with their folder's title and id when known
+    The manifest is the JSON or NDJSON output of --recordings or --save, or one item id per line
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        return list(iter_manifest_entries(json.loads(text)))
+    except json.JSONDecodeError:
+        pass
+
+    entries = []
+    folder_titles = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            record = line
+        if isinstance(record, dict) and record.get('record') == 'folder':
+            folder_titles[record['id']] = record['title']
+            continue
+        for entry in iter_manifest_entries(record):
+            if 'folder_id' in entry and not entry.get('folder'):
+                entry['folder'] = folder_titles.get(entry['folder_id'])
+            entries.append(entry)
+    return entries
+
+
+def iter_manifest_entries(value, folder=None, server=None):
+    """
+    Yield each item in a parsed manifest, a folder with items, a save result, an item or an item id
+    """
+    if isinstance(value, list):
+        for entry in value:
+            yield from iter_manifest_entries(entry, folder, server)
+    elif isinstance(value, dict):
+        server = value.get('server', server)
+        if 'items' in value:
+            yield from iter_manifest_entries(value['items'], value, server)
+        elif 'item' in value:
+            yield from iter_manifest_entries(value['item'], folder, server)
+        elif 'id' in value:
+            entry = dict(value, server=server)
+            if folder:
+                entry.update(folder=folder.get('title'), folder_id=folder.get('id'))
+            yield entry
+    elif isinstance(value, (str, int)) and str(value).strip():
+        yield {'id': str(value).strip(), 'server': server}
+
+
+def get_folder_filter(options):
+    """
+    Return a predicate for the folders to browse, or None if all the folders are needed
+    """
+    if not options.folder and not options.exclude:
+        return None
+    return lambda folder: has_folder_match(folder, options)
+
+
+def get_search_criteria(options):
+    """
+    Translate the title options into UPnP search criteria, or None when all the items are needed
+    """
+    if options.shows or not options.title:
+        return None
+    return upnp.get_title_criteria(options.title)
+
+
+def get_controller(options, name, maximum):
+    """
+    Return a controller that adapts the number of concurrent requests, if requested
+    """
+    if not options.adaptive:
+        return None
+    return upnp.ConcurrencyController(name, maximum=maximum, log=lambda msg: print_item(msg, level=1))
+
+
+def get_browse_filter(options):
+    """
+    Only request the item properties that will be used
+    """
+    if options.shows:
+        return upnp.FILTER_TITLES
+    if options.json or options.ndjson:
+        # Includes the description
+        return upnp.FILTER_ALL
+    return upnp.FILTER_MEDIA
+
+
+def get_catalogue_path(options):
+    return options.catalogue if type(options.catalogue) is str else CATALOGUE_FILE
+
+
+def uses_catalogue(options):
+    return (options.catalogue or options.search) and not options.save
+
+
+def has_catalogue(options):
+    path = get_catalogue_path(options)
+    if not os.path.exists(path):
+        return False
+    catalogue = Catalogue(path)
+    try:
+        return not catalogue.is_empty()
+    finally:
+        catalogue.close()
+
+
+def refresh_catalogue(location, options):
+    """
+    Browse all the recordings on a FetchTV server and replace them in the local catalogue
+    """
+    print_heading('Refreshing catalogue', get_catalogue_path(options))
+    # Browsed before opening the catalogue, so it isn't locked while browsing
+    folders = list(iter_fetch_folders(location))
+    catalogue = Catalogue(get_catalogue_path(options))
+    try:
+        catalogue.refresh(get_server_name(location), folders)
+    finally:
+        catalogue.close()
 
 
-def has_include_folder(recording, options):
-    return not (options.folder and
-                not next((include_folder for include_folder in options.folder
-                          if recording.title.lower().find(include_folder.strip().lower()) != -1), False))
+def get_catalogue_recordings(options, servers=None, tagged=False):
+    """
+    Return the matching recordings from the local catalogue, for the named servers or all servers
+    """
+    catalogue = Catalogue(get_catalogue_path(options))
+    try:
+        results = []
+        for server in servers or catalogue.get_servers():
+            folders = catalogue.get_folders(server, options.search)
+            for result in iter_recording_items(options, folders):
+                if options.search and not result['items']:
+                    continue
+                if tagged:
+                    result['server'] = server
+                results.append(result)
+        return results
+    finally:
+        catalogue.close()
 
 
-def has_exclude_folder(recording, options):
-    return (options.exclude and
-            next((exclude_folder for exclude_folder in options.exclude
-                  if recording.title.lower().find(exclude_folder.strip().lower()) != -1), False))
+def has_folder_match(recording, options):
+    return upnp.is_match(recording.title, options.folder, options.exclude)
 
 
 def has_title_match(item, options):
-    return not (options.title and
-                not next((include_title for include_title in options.title
-                          if item.title.lower().find(include_title.strip().lower()) != -1), False))
+    return upnp.is_match(item.title, options.title)
 
 
 def is_recording(item):
     with requests.get(item.url, stream=True) as r:
         r.raise_for_status()
-        total_length = int(r.headers.get('content-length'))
-        return total_length == MAX_OCTET
+        return is_live(r)
 
 
 def filter_recording_items(options, recordings):
     """
     Process the returned FetchTV recordings and filter the results as per the provided options.
     """
-    results = []
+    return list(iter_recording_items(options, recordings))
+
+
+def iter_recording_items(options, recordings):
+    """
+    Filter the FetchTV recordings as per the provided options, yielding each matching folder
+    """
     for recording in recordings:
         result = {'title': recording.title, 'id': recording.id, 'items': []}
         # Skip not matching folders
-        if not has_include_folder(recording, options) or has_exclude_folder(recording, options):
+        if not has_folder_match(recording, options):
             continue
 
         # Process recorded items
@@ -283,27 +1826,18 @@ def filter_recording_items(options, recordings):
                 if not options.is_recording or is_recording(item):
                     result['items'].append(item)
 
-        results.append(result)
-        if options.is_recording:
-            # Only return folders with a recording item
-            results = [result for result in results if len(result['items']) > 0]
-    return results
+        # Only return folders with a recording item
+        if not options.is_recording or len(result['items']) > 0:
+            yield result
 
 
 def discover_fetch(ip=False, port=False):
     print_heading('Starting Discovery')
-    found = False
     try:
-        location_urls = upnp.discover_pnp_locations() if not ip else ['http://%s:%i/MediaServer.xml' % (ip, port)]
-        for location in location_urls:
-            try:
-                locations = upnp.parse_locations([location])
-                if locations[0].manufacturerURL == 'http://www.fetch.com/':
-                    print_heading('Discovery successful', locations[0].url)
-                    return locations[0]
-            except upnp.UpnpError:
-                # Bad location
-                pass
+        location_urls = upnp.discover_pnp_locations() if not ip else [upnp.get_location_url(ip, port)]
+        for location in upnp.iter_fetch_locations(location_urls):
+            print_heading('Discovery successful', location.url)
+            return location
     except upnp.UpnpError as err:
         print_error(err)
 
@@ -311,6 +1845,29 @@ def discover_fetch(ip=False, port=False):
     return None
 
 
+def discover_fetch_servers(servers=True, port=upnp.FETCHTV_PORT):
+    """
+    Return all Fetch servers found by auto-discovery, or from a list of "<ip>[:<port>]" servers
+    """
+    print_heading('Starting Discovery')
+    result = []
+    try:
+        location_urls = upnp.discover_pnp_locations() if servers is True else upnp.get_location_urls(servers, port)
+        for location in upnp.iter_fetch_locations(location_urls):
+            print_heading('Discovery successful', location.url)
+            result.append(location)
+    except upnp.UpnpError as err:
+        print_error(err)
+
+    if not result:
+        print_heading('Discovery failed', 'ERROR: Unable to locate Fetch UPNP service')
+    return result
+
+
+def get_server_name(location):
+    return urlparse(location.url).netloc
+
+
 def show_help():
     print('''
       Usage:
@@ -352,61 +1909,515 @@ def show_help():
         Options:
         --ip=<ip_address>             --> Specify the IP Address of the Fetch Server, if auto-discovery fails
         --port=<port>                 --> Specify the port of the Fetch Server, if auto-discovery fails, normally 49152
-        --overwrite                   --> Will save and overwrite any existing files
+        --overwrite[=changed]         --> Will save and overwrite any existing files, or only files that are missing,
+                                          incomplete or have changed on the Fetch Server
         --save=<path>                 --> Save recordings to the specified path
         --folder="<text>[,<text>]"    --> Only return recordings where the folder contains the specified text
         --exclude="<text>[,<text>]"   --> Don't download folders containing the specified text
         --title="<text>[,<text>]"     --> Only return recordings where the item contains the specified text
         --json                        --> Output show/recording/save results in JSON
+        --ndjson                      --> Output show/recording/save results as one JSON record per line, as they
+                                          become available
+        --servers[="<ip>[:<port>][,<ip>[:<port>]]"]
+                                      --> Process several Fetch Servers concurrently, either the ones listed or all
+                                          that can be auto-discovered. Results are tagged with the server.
+                                          Each server has its own saved list, only a single server keeps the list
+                                          saved by earlier runs without --servers
+        --workers=<number>            --> Number of recordings to save concurrently from each Fetch Server, default 1
+        --postprocess="<command>"     --> Run a command on each saved recording while other downloads continue, the
+                                          {file}, {folder} and {title} placeholders are replaced for each recording
+        --processes=<number>          --> Number of post-processing commands to run at once, default 1
+        --retries=<number>            --> Number of times to retry a failed request or download, default 3.
+                                          Interrupted downloads continue from where they stopped
+        --diskfull=<skip|defer>       --> When a recording won't fit on the disk either skip it and continue saving
+                                          smaller recordings, or defer it and all remaining recordings to the next
+                                          run, default skip
+        --duplicates=<skip|link>      --> Find repeats of recordings that have already been saved, e.g. recorded on
+                                          another channel. Either skip them, or hard link them to the saved file
+        --catalogue[=<file>]          --> List recordings from a local catalogue without contacting the Fetch Server,
+                                          the catalogue is created on first use. Default fetchtv_catalogue.db
+        --refresh                     --> Refresh the local catalogue from the Fetch Server
+        --search="<text>"             --> Only return recordings where the title or description contains all the
+                                          words, searches the local catalogue
+        --segments=<number>           --> Download each recording over several connections at once, if the Fetch
+                                          Server supports it
+        --buffer=<MB>                 --> Memory used to hold each download while it's written to disk, so the
+                                          network and disk don't wait on each other. 0 to disable, default 16
+        --follow                      --> Save recordings that are still in progress, following them as they grow
+                                          until the recording completes or stops growing
+        --plan                        --> List the recordings that would be saved, with their total size and an
+                                          estimate of the time taken from the speed of earlier saves
+        --adaptive                    --> Adjust the number of concurrent browse requests and downloads to what the
+                                          Fetch Server can handle, up to --workers downloads, default 8
+        --window="<HH:MM-HH:MM>[,<HH:MM-HH:MM>]"
+                                      --> Only download during these times of day. Downloads wait for a window to
+                                          open, and pause when it closes to continue in the next one
+        --proxy[=<port>]              --> Serve the recordings over HTTP so they can be played straight away, from
+                                          http://<host>:<port>/recordings. Default port 8080
+        --cachedir=<path>             --> Where the proxy caches the parts of recordings that have been played,
+                                          default fetchtv_cache
+        --cachelimit=<GB>             --> Maximum size of the proxy cache, the least recently played parts are
+                                          removed first. Default 10
+        --from-manifest=<file>        --> Only the recordings listed in the file, either the JSON or NDJSON output
+                                          of --recordings or --save, or one item id per line. The recordings
+                                          aren't browsed, each item is looked up by its id unless its URL is listed
+        --transcode="<command>"       --> Pipe each recording into a command as it's downloaded, instead of saving
+                                          the .mpeg file. The command reads stdin and writes to {file}, the
+                                          {folder} and {title} placeholders are also replaced. Transcodes that are
+                                          interrupted, or paused by --window, restart from the beginning
+        --extension=<ext>             --> Extension of the files written by --transcode, default mp4
+        --staging=<path>              --> Save recordings to a local directory first, then move them to the --save
+                                          path in the background, e.g. when saving to a slow network share
     ''')
 
 
-def save_recordings(recordings, options: Options):
+def load_saved_files(path, server=None, legacy=False):
+    """
+    Load the saved files, kept separately for each server when one is provided
+    Set legacy when it's the only server being saved, so the shared saved files from earlier runs are its own
+    """
+    return SavedFiles.load(path, (server.udn or get_server_name(server)) if server else '', legacy)
+
+
+def save_recordings(recordings, options: Options, server=None, session=None, legacy=False):
     """
     Save all recordings for the specified folder (if not already saved)
+    Each folder's items are queued for saving as soon as the folder is yielded, so recordings can be a generator
+    that's still browsing the server
+    When a server is provided its saved files are kept separately, and results are tagged with its name
+    The session can be shared by concurrent saves to the same path
     """
     some_to_record = False
     path = options.save
-    saved_files = SavedFiles.load(path)
+    saved_files = load_saved_files(path, server, legacy)
+    workers = int(options.workers) if options.workers else DEFAULT_WORKERS
+    if options.adaptive and not options.workers:
+        workers = upnp.ADAPTIVE_MAX
+    # Up to workers downloads are started at once, as allowed by the controller
+    controller = get_controller(options, f'Download {get_server_name(server) if server else ""}'.strip(), workers)
+    if not session:
+        session = SaveSession(options)
+    mover = FileMover(options.staging, path, session.planner) if options.staging else None
+    post_processor = None
+    if options.postprocess:
+        post_processor = PostProcessor(options.postprocess,
+                                       int(options.processes) if options.processes else DEFAULT_PROCESSES,
+                                       lambda item, file_path, result: post_processed(item, file_path, result,
+                                                                                      saved_files, options))
     json_result = []
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for show in recordings:
+                    # Saving from several servers is stopped from the main thread
+                    check_stopping()
+                    for item in show['items']:
+                        if options.overwrite or not saved_files.contains(item):
+                            some_to_record = True
+                            file_path = get_file_path(path, show, item, get_extension(options))
+                            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+                            result = {'item': create_item(item), 'recorded': False}
+                            if server:
+                                result['server'] = get_server_name(server)
+                            json_result.append(result)
+                            if options.overwrite == OVERWRITE_CHANGED and saved_files.is_unchanged(item, file_path):
+                                msg = 'Already saved and unchanged, skipping: [%s]' % item.title
+                                print_item(msg)
+                                result['skipped'] = msg
+                                report_result(result, options)
+                                continue
+                            if session.duplicates and save_duplicate(item, file_path, result, saved_files,
+                                                                     session.duplicates, options):
+                                report_result(result, options)
+                                continue
+                            if not reserve_space(session.planner, item, file_path, result, mover):
+                                if session.duplicates:
+                                    session.duplicates.finish(item)
+                                report_result(result, options)
+                                continue
+                            future = executor.submit(save_item, item, file_path, result, saved_files, options,
+                                                     post_processor, session.duplicates, session.throughput,
+                                                     controller, session.windows, mover, session.planner)
+                            # A save that's cancelled before it starts doesn't need its space
+                            future.add_done_callback(lambda f, file_path=file_path: f.cancelled() and release_space(
+                                session.planner, file_path, mover))
+                            futures.append(future)
+            except KeyboardInterrupt:
+                # Before the executor waits for the queued saves
+                stop_saving(futures, mover, post_processor)
+                raise
+        if mover:
+            # Moved recordings are then post-processed
+            mover.shutdown()
+        if post_processor:
+            post_processor.shutdown()
+    except KeyboardInterrupt:
+        stop_saving(futures, mover, post_processor)
+        raise
+    # Raise any unexpected download errors
+    for future in futures:
+        future.result()
+    if not some_to_record:
+        print_item('There is nothing new to record')
+    return json_result
+
+
+def stop_saving(futures, mover=None, post_processor=None):
+    """
+    Stop the saves in progress and don't start the queued ones, moves or commands, rather than waiting for them all
+    """
+    STOPPING.set()
+    for future in futures:
+        future.cancel()
+    if mover:
+        mover.cancel()
+    if post_processor:
+        post_processor.cancel()
+
+
+def get_file_path(path, show, item, extension=RECORDING_EXTENSION):
+    return (path + os.path.sep + create_valid_filename(show['title']) + os.path.sep +
+            create_valid_filename(item.title) + '.' + extension)
+
+
+def get_extension(options):
+    """
+    Recordings are saved as .mpeg, unless they're transcoded
+    """
+    if not options.transcode:
+        return RECORDING_EXTENSION
+    return options.extension.lstrip('.') if type(options.extension) is str else DEFAULT_TRANSCODE_EXTENSION
+
+
+def get_lock_file(file_path, transcoding=False):
+    """
+    The file written to until a recording is saved. A transcoder's lock file keeps the extension, as commands
+    like ffmpeg choose the output format from it
+    """
+    if not transcoding:
+        return file_path + CONST_LOCK
+    root, extension = os.path.splitext(file_path)
+    return root + CONST_LOCK + extension
+
+
+def plan_recordings(recordings, options: Options, server=None, legacy=False):
+    """
+    List the recordings that would be saved, without saving them, with their total size and an estimate of
+    how long they'd take to download based on the throughput of earlier runs
+    """
+    saved_files = load_saved_files(options.save, server, legacy)
+    throughput = ThroughputHistory.load(options.save)
+    workers = int(options.workers) if options.workers else DEFAULT_WORKERS
+    result = {'items': [], 'size': 0, 'duration': 0}
+    if server:
+        result['server'] = get_server_name(server)
     for show in recordings:
         for item in show['items']:
-            if options.overwrite or not saved_files.contains(item):
-                some_to_record = True
-                directory = path + os.path.sep + create_valid_filename(show['title'])
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                file_path = directory + os.path.sep + create_valid_filename(item.title) + '.mpeg'
-
-                result = {'item': create_item(item), 'recorded': False}
-                json_result.append(result)
-                # Check if already writing
-                lock_file = file_path + CONST_LOCK
-                if os.path.exists(lock_file):
-                    msg = 'Already writing (lock file exists) skipping: [%s]' % item.title
-                    print_item(msg)
-                    result['warning'] = msg
-                    continue
+            if not options.overwrite and saved_files.contains(item):
+                continue
+            if options.overwrite == OVERWRITE_CHANGED and saved_files.is_unchanged(
+                    item, get_file_path(options.save, show, item, get_extension(options))):
+                continue
+            print_item(f'[{show["title"]}] {item.title} - {format_size(item.size)}, '
+                       f'{format_duration(item.duration)}')
+            result['items'].append(dict(folder=show['title'], **create_item(item)))
+            result['size'] += item.size
+            result['duration'] += item.duration
+
+    rate = throughput.get_rate()
+    result['rate'] = rate
+    result['eta'] = throughput.estimate([item['size'] for item in result['items']], workers)
+    summary = f'{len(result["items"])} recordings, {format_size(result["size"])}'
+    if result['eta'] is not None:
+        summary += (f', about {format_duration(result["eta"])} with {workers} worker(s) at '
+                    f'{format_size(rate)}/s each')
+    else:
+        summary += ', no earlier downloads to estimate the time from'
+    print_heading('Plan', summary)
+    if options.ndjson:
+        print_ndjson(dict(record='plan', **result))
+    return [result]
 
-                if download_file(item, file_path, result):
-                    result['recorded'] = True
-                    saved_files.add_file(item)
-    if not some_to_record:
-        print('\t -- There is nothing new to record')
-    return json_result
+
+def reserve_space(planner, item, file_path, result, mover=None):
+    """
+    Reserve the disk space needed to save an item, less anything already written by an earlier run
+    When staging, the space is also reserved on the staging volume until the recording has been moved
+    Recordings in progress aren't planned for, their size isn't known until they finish
+    """
+    if item.size == MAX_OCTET:
+        return True
+    needed = item.size - get_written_size(file_path + CONST_LOCK)
+    staged_needed = item.size - get_written_size(mover.get_staged_path(file_path) + CONST_LOCK) if mover else 0
+    if planner.reserve(os.path.dirname(file_path), needed, file_path):
+        if not mover or mover.reserve(file_path, staged_needed):
+            return True
+        planner.finish(file_path, False)
+
+    if planner.deferred:
+        msg = 'Not enough disk space, deferred to the next run: [%s]' % item.title
+    else:
+        msg = 'Not enough disk space, skipping: [%s]' % item.title
+    print_warning(msg, level=1)
+    result['warning'] = msg
+    return False
+
+
+def release_space(planner, file_path, mover=None, saved=False):
+    """
+    Done with the space reserved for an item by reserve_space, it's returned unless the item was saved
+    """
+    if mover:
+        mover.finish(file_path, saved)
+    elif planner:
+        planner.finish(file_path, saved)
+
+
+def save_duplicate(item, file_path, result, saved_files, duplicates, options):
+    """
+    Returns True if the item is a repeat of a recording that's already saved, or currently saving
+    Repeats are skipped, or hard linked to the saved file when requested and possible
+    """
+    entry = duplicates.find(item)
+    if not entry:
+        return False
+
+    if entry['file'] and options.duplicates == DUPLICATES_LINK:
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            os.link(entry['file'], file_path)
+        except OSError as err:
+            print_warning(f'Unable to link duplicate [{item.title}] to [{entry["file"]}], saving instead: {err}')
+            duplicates.add(item)
+            return False
+        print_item('Duplicate of [%s], linked: [%s]' % (entry['file'], item.title))
+        result['recorded'] = True
+        result['duplicate'] = entry['file']
+        saved_files.add_file(item, file_path)
+        return True
+
+    msg = 'Duplicate of [%s], skipping: [%s]' % (entry['file'] or entry['title'], item.title)
+    print_item(msg)
+    result['skipped'] = msg
+    result['duplicate'] = entry['file'] or entry['title']
+    return True
+
+
+def save_item(item, file_path, result, saved_files, options, post_processor=None, duplicates=None, throughput=None,
+              controller=None, windows=None, mover=None, planner=None):
+    """
+    Save a single recording item, unless it's already being written
+    With a FileMover the item is saved to the staging directory, then moved to the file path in the background
+    Saved items are queued for post-processing when requested
+    The space reserved for the item on the planner is returned if it isn't saved
+    """
+    target_path = file_path
+    try:
+        check_stopping()
+        if mover:
+            file_path = mover.get_staged_path(target_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # Check if already writing
+        lock_file = get_lock_file(file_path, bool(options.transcode))
+        resume = False
+        # Owned before the lock file is written, e.g. while waiting for a download window
+        if (os.path.exists(lock_file) or os.path.exists(lock_file + LOCK_OWNER)) and is_lock_active(lock_file):
+            msg = 'Already writing (lock file exists) skipping: [%s]' % item.title
+            print_item(msg)
+            result['warning'] = msg
+            release_space(planner, target_path, mover)
+            if duplicates:
+                duplicates.finish(item)
+            report_result(result, options)
+            return
+        if os.path.exists(lock_file):
+            # Left behind by an earlier run
+            if options.transcode:
+                # The transcoder can't continue from where it stopped
+                print_item('Restarting partial transcode: [%s]' % item.title)
+                os.remove(lock_file)
+            else:
+                print_item('Resuming partial download: [%s]' % item.title)
+                resume = True
+
+        claim_lock(lock_file)
+        if windows:
+            # Don't hold a download slot while waiting
+            windows.wait(lock_file)
+        if controller:
+            controller.acquire()
+        start_size = get_written_size(lock_file) if resume else 0
+        start_time = time.monotonic()
+        saved = False
+        try:
+            if options.transcode:
+                saved = transcode_file(item, file_path, result, options.transcode, windows)
+            else:
+                saved = download_file(item, file_path, result, resume,
+                                      int(options.segments) if options.segments else 1, get_buffer_size(options),
+                                      bool(options.follow), windows)
+        finally:
+            if not saved:
+                size = None
+            elif options.transcode:
+                # The bytes received, not the size of the transcoded file
+                size = result['transcode']['bytes']
+            else:
+                size = os.path.getsize(file_path) - start_size
+            # Only the time spent transferring, not paused between transfer windows
+            elapsed = time.monotonic() - start_time - result.get('paused', 0)
+            if controller:
+                controller.release(elapsed, 'error' not in result, size)
+            release_lock(lock_file)
+    except BaseException:
+        # Stopped, or an unexpected error
+        release_space(planner, target_path, mover)
+        raise
+    if saved and throughput and not result.get('followed'):
+        # Recordings in progress are limited by the recording, not the network
+        throughput.add(size, elapsed)
+    if saved and mover:
+        # Only recorded once it has been moved, the mover is then done with its space
+        mover.submit(item, file_path, target_path, result,
+                     lambda moved: finish_item(item, target_path, moved, result, saved_files, options, post_processor,
+                                               duplicates))
+        return
+    release_space(planner, target_path, mover, saved)
+    finish_item(item, file_path, saved, result, saved_files, options, post_processor, duplicates)
+
+
+def finish_item(item, file_path, saved, result, saved_files, options, post_processor=None, duplicates=None):
+    """
+    Record a saved item and queue it for post-processing, or report the result if it wasn't saved
+    """
+    if duplicates:
+        duplicates.finish(item, file_path if saved else None)
+    if saved:
+        result['recorded'] = True
+        saved_files.add_file(item, file_path)
+        if post_processor:
+            # Reported once post-processing completes
+            post_processor.submit(item, file_path, result)
+            return
+
+    report_result(result, options)
+
+
+def post_processed(item, file_path, result, saved_files, options):
+    """
+    Record the file details again once the command has succeeded, it may have rewritten the file, and report the result
+    """
+    if result['postprocess']['status'] == 'success' and os.path.exists(file_path):
+        # So --overwrite=changed compares against the processed file, not the downloaded one
+        saved_files.add_file(item, file_path)
+    report_result(result, options)
+
+
+def claim_lock(lock_file, command_pid=None):
+    """
+    Record this process as the one writing the lock file, in a file next to it, with the command writing it for
+    this process, if any
+    """
+    with open(lock_file + LOCK_OWNER, 'w') as f:
+        json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'command_pid': command_pid}, f)
+
+
+def release_lock(lock_file):
+    try:
+        os.remove(lock_file + LOCK_OWNER)
+    except FileNotFoundError:
+        pass
+
+
+def is_lock_active(lock_file):
+    """
+    Returns True if the lock file is still being written, e.g. by another run that's waiting for a download window
+    The processes that own it are checked when they're on this host, otherwise the lock is taken to be abandoned once
+    neither it nor its owner have been written to for STALE_LOCK seconds
+    """
+    try:
+        with open(lock_file + LOCK_OWNER, 'r') as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        owner = None
+    if owner and owner.get('host') == socket.gethostname():
+        return is_process_running(owner.get('pid')) or is_process_running(owner.get('command_pid'))
+    mtimes = [os.path.getmtime(path) for path in [lock_file, lock_file + LOCK_OWNER] if os.path.exists(path)]
+    return bool(mtimes) and time.time() - max(mtimes) < STALE_LOCK
+
+
+def is_process_running(pid):
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # os.kill() would terminate the process on Windows
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and \
+                exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        return True
+    return True
+
+
+def get_buffer_size(options):
+    """
+    Size of the download buffer in bytes, --buffer is in MB
+    """
+    return int(float(options.buffer) * 1024 * 1024) if type(options.buffer) is str else DEFAULT_BUFFER * 1024 * 1024
+
+
+def report_result(result, options):
+    if options.ndjson:
+        print_ndjson(dict(record='download', **result))
+
+
+def is_ndjson():
+    return Options.INSTANCE and Options.INSTANCE.ndjson
+
+
+def print_ndjson(record):
+    """
+    Write a single JSON record on its own line, flushed so consumers can process it straight away
+    """
+    with PRINT_LOCK:
+        print(json.dumps(record, sort_keys=False), flush=True)
 
 
 def print_item(param, level=1):
+    if is_ndjson():
+        return
     space = '\t' * level
     print(f'{space} -- {param}')
 
 
 def print_warning(param, level=2):
+    if is_ndjson():
+        return
     space = '\t' * level
     print(f'{space} -- [!] {param}')
 
 
 def print_error(param, level=2):
+    if is_ndjson():
+        return
     space = '\t' * level
     print(f'{space} -- [!] {param}')
 
@@ -419,24 +2430,41 @@ def create_item(item):
         'type': item_type,
         'duration': item.duration,
         'size': item.size,
-        'description': item.description
+        'description': item.description,
+        'url': item.url
     }
 
 
+def create_folder(recording):
+    result = {'id': recording['id'], 'title': recording['title']}
+    if 'server' in recording:
+        result['server'] = recording['server']
+    return result
+
+
 def print_recordings(recordings):
-    if Options.INSTANCE and not Options.INSTANCE.json:
+    if is_ndjson():
+        for recording in recordings:
+            folder = create_folder(recording)
+            print_ndjson(dict(record='folder', **folder))
+            for item in recording['items']:
+                item = dict(record='item', folder_id=recording['id'], **create_item(item))
+                if 'server' in folder:
+                    item['server'] = folder['server']
+                print_ndjson(item)
+    elif Options.INSTANCE and not Options.INSTANCE.json:
         print_heading('List Recordings')
         if not recordings:
             print_warning('No recordings found!', level=1)
         for recording in recordings:
-            print_item(recording['title'])
+            print_item(f'[{recording["server"]}] {recording["title"]}' if 'server' in recording else recording['title'])
             for item in recording['items']:
                 print_item(f'{item.title} ({item.url})', level=2)
     else:
         output = []
         for recording in recordings:
             items = []
-            output.append({'id': recording['id'], 'title': recording['title'], 'items': items})
+            output.append(dict(create_folder(recording), items=items))
             for item in recording['items']:
                 items.append(create_item(item))
         output = json.dumps(output, indent=2, sort_keys=False)
@@ -445,7 +2473,7 @@ def print_recordings(recordings):
 
 
 def print_heading(param, value=''):
-    if Options.INSTANCE and Options.INSTANCE.json:
+    if Options.INSTANCE and (Options.INSTANCE.json or Options.INSTANCE.ndjson):
         return
     print(f'[+] {param}: {value}')
 
@@ -457,27 +2485,122 @@ def main(argv):
         return
 
     print_heading('Started', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if options.retries:
+        upnp.RETRY_POLICY = upnp.RetryPolicy(attempts=int(options.retries))
+
+    is_listing = options.recordings or options.shows or options.is_recording
+    if is_listing and uses_catalogue(options) and not options.refresh and not options.info and has_catalogue(options):
+        # Answer from the local catalogue without contacting the server
+        print_recordings(get_catalogue_recordings(options, tagged=bool(options.servers)))
+        print_heading('Done', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        return
+
     print_heading('Discover Fetch UPnP location')
-    fetch_server = discover_fetch(ip=options.ip, port=int(options.port) if options.port else FETCHTV_PORT)
+    port = int(options.port) if options.port else upnp.FETCHTV_PORT
+    if options.servers:
+        fetch_servers = discover_fetch_servers(options.servers, port=port)
+    else:
+        fetch_server = discover_fetch(ip=options.ip, port=port)
+        fetch_servers = [fetch_server] if fetch_server else []
 
-    if not fetch_server:
+    if not fetch_servers:
         return
 
     if options.info:
-        pprint(vars(fetch_server))
+        for fetch_server in fetch_servers:
+            pprint(vars(fetch_server))
 
-    if options.recordings or options.shows or options.is_recording:
-        recordings = get_fetch_recordings(fetch_server, options)
-        if not options.save:
-            print_recordings(recordings)
+    if options.proxy:
+        serve_proxy(fetch_servers[0], options)
+
+    if is_listing:
+        if options.servers:
+            results = process_servers(fetch_servers, options)
         else:
-            print_heading('Saving Recordings')
-            json_result = save_recordings(recordings, options)
-            if Options.INSTANCE and Options.INSTANCE.json:
-                output = json.dumps(json_result, indent=2, sort_keys=False)
-                print(output)
+            results = process_server(fetch_servers[0], options)
+        if not options.save:
+            if not options.ndjson:
+                print_recordings(results)
+        elif Options.INSTANCE and Options.INSTANCE.json:
+            output = json.dumps(results, indent=2, sort_keys=False)
+            print(output)
     print_heading('Done', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
+def serve_proxy(fetch_server, options):
+    """
+    Serve the server's recordings over HTTP until interrupted, caching the parts that are played
+    """
+    port = int(options.proxy) if type(options.proxy) is str else DEFAULT_PROXY_PORT
+    cache_limit = float(options.cache_limit) if options.cache_limit else DEFAULT_CACHE_LIMIT
+    cache = SegmentCache(options.cache_dir or CACHE_DIR, int(cache_limit * 1024 * 1024 * 1024))
+    with FetchClient(fetch_server) as client:
+        server = create_server(RecordingProxy(client, cache), port=port)
+        print_heading('Serving recordings', f'http://{socket.gethostname()}:{server.server_port}/recordings')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def process_server(fetch_server, options, tagged=False, session=None, legacy=False):
+    """
+    List or save the recordings on a single Fetch server
+    Returns the recordings, or the save results, tagged with the server name if requested
+    Set legacy when it's the only server, so it keeps the saved files from before servers had their own
+    """
+    server = get_server_name(fetch_server) if tagged else None
+    if options.from_manifest:
+        recordings = get_manifest_recordings(fetch_server, options, server)
+    elif uses_catalogue(options):
+        refresh_catalogue(fetch_server, options)
+        recordings = get_catalogue_recordings(options, [get_server_name(fetch_server)], tagged)
+    elif options.ndjson or options.save:
+        # Process each folder as soon as it has been browsed, downloads start while the other folders are browsed
+        recordings = iter_fetch_recordings(fetch_server, options, server)
+    else:
+        recordings = get_fetch_recordings(fetch_server, options, server)
+    if not options.save:
+        if options.ndjson:
+            print_recordings(recordings)
+            return []
+        return recordings
+
+    if options.plan:
+        print_heading('Planning Recordings', server or '')
+        return plan_recordings(recordings, options, fetch_server if tagged else None, legacy)
+
+    print_heading('Saving Recordings', server or '')
+    return save_recordings(recordings, options, fetch_server if tagged else None, session, legacy)
+
+
+def process_servers(fetch_servers, options):
+    """
+    Process several Fetch servers concurrently, returning the combined results tagged by server
+    """
+    results = []
+    # Servers are saving to the same path
+    session = SaveSession(options) if options.save else None
+    # The saved files from before servers had their own could be from any of them, unless there's only one
+    legacy = len(fetch_servers) == 1
+    with ThreadPoolExecutor(max_workers=len(fetch_servers)) as executor:
+        futures = [executor.submit(process_server, fetch_server, options, True, session, legacy)
+                   for fetch_server in fetch_servers]
+        try:
+            for fetch_server, future in zip(fetch_servers, futures):
+                try:
+                    results.extend(future.result())
+                except upnp.UpnpError as err:
+                    # Don't let one unavailable server stop the others
+                    print_error(f'[{get_server_name(fetch_server)}] {err}', level=1)
+        except KeyboardInterrupt:
+            # Stop each server's downloads, rather than waiting for them all
+            STOPPING.set()
+            raise
+    return results
+
+
 if __name__ == "__main__":
     main(sys.argv)
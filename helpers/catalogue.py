@@ -0,0 +1,122 @@
+import sqlite3
+
+from helpers.upnp import Folder, Item
+
+CATALOGUE_TIMEOUT = 30
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS folders (
+        server TEXT NOT NULL,
+        id TEXT NOT NULL,
+        parent_id TEXT,
+        title TEXT,
+        position INTEGER,
+        PRIMARY KEY (server, id)
+    );
+    CREATE TABLE IF NOT EXISTS items (
+        server TEXT NOT NULL,
+        id TEXT NOT NULL,
+        folder_id TEXT NOT NULL,
+        parent_id TEXT,
+        type TEXT,
+        title TEXT,
+        description TEXT,
+        url TEXT,
+        size INTEGER,
+        duration REAL,
+        parent_name TEXT,
+        position INTEGER,
+        PRIMARY KEY (server, id)
+    );
+    CREATE INDEX IF NOT EXISTS items_folder ON items (server, folder_id, position);
+'''
+
+FTS_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(title, description, content='items', content_rowid='rowid')
+'''
+
+ITEM_COLUMNS = ['id', 'folder_id', 'parent_id', 'type', 'title', 'description', 'url', 'size', 'duration',
+                'parent_name']
+
+
+class Catalogue:
+    """
+    Local copy of the FetchTV recording folders and items, so they can be listed and searched without browsing
+    the server. Stored in SQLite, with a full-text index of item titles and descriptions when FTS5 is available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__conn = sqlite3.connect(path, timeout=CATALOGUE_TIMEOUT)
+        self.__conn.executescript(SCHEMA)
+        try:
+            self.__conn.execute(FTS_SCHEMA)
+            self.has_fts = True
+        except sqlite3.OperationalError:
+            # SQLite was built without FTS5, searches fall back to a table scan
+            self.has_fts = False
+
+    def close(self):
+        self.__conn.close()
+
+    def is_empty(self):
+        return self.__conn.execute('SELECT COUNT(*) FROM folders').fetchone()[0] == 0
+
+    def get_servers(self):
+        return [row[0] for row in self.__conn.execute('SELECT DISTINCT server FROM folders ORDER BY server')]
+
+    def refresh(self, server, folders):
+        """
+        Replace the catalogue for a server with the browsed folders and their items
+        The folders are all browsed before writing, so the database is only locked briefly, not while the server
+        is browsed, and other servers can be refreshed at the same time
+        """
+        folders = list(folders)
+        with self.__conn:
+            self.__conn.execute('DELETE FROM folders WHERE server = ?', (server,))
+            self.__conn.execute('DELETE FROM items WHERE server = ?', (server,))
+            item_position = 0
+            for folder_position, folder in enumerate(folders):
+                self.__conn.execute('INSERT INTO folders VALUES (?, ?, ?, ?, ?)',
+                                    (server, folder.id, folder.parent_id, folder.title, folder_position))
+                for item in folder.items:
+                    self.__conn.execute(f'INSERT OR REPLACE INTO items VALUES ({", ".join("?" * 12)})',
+                                        (server, item.id, folder.id, item.parent_id, item.type, item.title,
+                                         item.description, item.url, item.size, item.duration, item.parent_name,
+                                         item_position))
+                    item_position += 1
+            if self.has_fts:
+                self.__conn.execute("INSERT INTO items_fts(items_fts) VALUES('rebuild')")
+
+    def get_folders(self, server, search=None):
+        """
+        Return the server's folders, each with its items
+        Only items matching all the words in the search text are included when provided
+        """
+        columns = ', '.join(f'items.{column}' for column in ITEM_COLUMNS)
+        if not search:
+            rows = self.__conn.execute(f'SELECT {columns} FROM items WHERE server = ? ORDER BY position', (server,))
+        elif self.has_fts:
+            # Quote each word so the text isn't parsed as an FTS query
+            query = ' '.join('"%s"' % word.replace('"', '""') for word in search.split())
+            rows = self.__conn.execute(f'SELECT {columns} FROM items_fts JOIN items ON items.rowid = items_fts.rowid '
+                                       'WHERE items_fts MATCH ? AND items.server = ? ORDER BY items.position',
+                                       (query, server))
+        else:
+            words = search.split()
+            match = ' AND '.join(["(title || ' ' || IFNULL(description, '')) LIKE ?"] * len(words))
+            rows = self.__conn.execute(f'SELECT {columns} FROM items WHERE server = ? AND {match} ORDER BY position',
+                                       [server] + [f'%{word}%' for word in words])
+
+        items = {}
+        for row in rows:
+            values = dict(zip(ITEM_COLUMNS, row))
+            items.setdefault(values.pop('folder_id'), []).append(Item.from_values(values))
+
+        result = []
+        for folder_id, parent_id, title in self.__conn.execute(
+                'SELECT id, parent_id, title FROM folders WHERE server = ? ORDER BY position', (server,)):
+            folder = Folder.from_values({'id': folder_id, 'parent_id': parent_id, 'title': title})
+            folder.add_items(items.get(folder_id, []))
+            result.append(folder)
+        return result
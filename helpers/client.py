@@ -0,0 +1,197 @@
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+import helpers.upnp as upnp
+from helpers.download import CONST_LOCK, get_short_length, is_live, open_stream
+
+RECORDINGS_TITLE = 'Recordings'
+CHUNK_SIZE = 8192
+STREAM_TIMEOUT = 30
+PROGRESS_STEPS = 100
+
+
+class FetchClient:
+    """
+    Client for a FetchTV server, for use as a library. Nothing is printed, errors are raised as UpnpError.
+    The server's services and Recordings folder are looked up once and reused, and requests share a pooled
+    requests.Session, so repeated queries only cost the network time of the query itself
+
+    e.g.
+        with FetchClient.discover() as client:
+            for item in client.iter_items(folder=['2 Broke Girls'], title=['S4 E12']):
+                client.download(item, f'/recordings/{item.id}.mpeg', on_progress=print)
+    """
+
+    def __init__(self, location, session=None):
+        self.location = location
+        self.session = session or requests.Session()
+        self.__lock = threading.Lock()
+        self.__services = None
+        self.__recordings = None
+
+    @staticmethod
+    def discover_all(ips=None, port=upnp.FETCHTV_PORT, session=None):
+        """
+        Return a client for each Fetch server found by auto-discovery, or at the listed "<ip>[:<port>]" addresses
+        """
+        session = session or requests.Session()
+        location_urls = upnp.get_location_urls(ips, port) if ips else upnp.discover_pnp_locations()
+        return [FetchClient(location, session) for location in upnp.iter_fetch_locations(location_urls, session)]
+
+    @staticmethod
+    def discover(ip=None, port=upnp.FETCHTV_PORT, session=None):
+        """
+        Return a client for the first Fetch server found, or None
+        """
+        clients = FetchClient.discover_all([ip] if ip else None, port, session)
+        return clients[0] if clients else None
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def name(self):
+        return urlparse(self.location.url).netloc
+
+    def get_services(self):
+        with self.__lock:
+            if self.__services is None:
+                self.__services = upnp.get_services(self.location, self.session)
+            return self.__services
+
+    def get_recordings_id(self):
+        """
+        Return the id of the Recordings folder, or None if the server doesn't have one
+        """
+        services = self.get_services()
+        with self.__lock:
+            if self.__recordings is None:
+                folders = upnp.iter_directories(services, browse_filter=upnp.FILTER_TITLES, with_items=False)
+                self.__recordings = next((folder.id for folder in folders if folder.title == RECORDINGS_TITLE), '')
+            return self.__recordings or None
+
+    def refresh(self):
+        """
+        Look up the services and Recordings folder again on the next query, e.g. after the server restarts
+        """
+        with self.__lock:
+            self.__services = None
+            self.__recordings = None
+
+    def iter_folders(self, with_items=True, browse_filter=upnp.FILTER_MEDIA, folder_filter=None):
+        """
+        Yield each recording folder, with its items unless with_items is False, as soon as it has been browsed
+        Only the folders that folder_filter(folder) returns True for are browsed, when provided
+        """
+        recordings_id = self.get_recordings_id()
+        if recordings_id:
+            yield from upnp.iter_directories(self.get_services(), recordings_id, browse_filter, with_items,
+                                             folder_filter=folder_filter)
+
+    def iter_recordings(self, folder=None, exclude=None, title=None, browse_filter=upnp.FILTER_MEDIA):
+        """
+        Yield the recording folders with a title containing any of the folder text and none of the exclude text,
+        with only the items with a title containing any of the title text. Folders without matching items aren't
+        included when filtering by title. Titles are searched for on the server when it supports searching
+        """
+        folders = None
+        folder_filter = None
+        if folder or exclude:
+            # Folders that don't match aren't browsed
+            folder_filter = lambda recording: upnp.is_match(recording.title, folder, exclude)
+        criteria = upnp.get_title_criteria(title) if title else None
+        if criteria and self.get_services().search:
+            folders = self.__search_folders(criteria, browse_filter, folder_filter)
+        if folders is None:
+            folders = self.iter_folders(browse_filter=browse_filter, folder_filter=folder_filter)
+
+        for recording in folders:
+            recording.add_items(item for item in recording.items if upnp.is_match(item.title, title))
+            if title and not recording.items:
+                continue
+            yield recording
+
+    def __search_folders(self, criteria, browse_filter, folder_filter):
+        recordings_id = self.get_recordings_id()
+        if not recordings_id:
+            return []
+        try:
+            return upnp.search_folders(self.get_services(), recordings_id, criteria, browse_filter, folder_filter)
+        except upnp.UpnpError:
+            # Browse instead
+            return None
+
+    def iter_items(self, folder=None, exclude=None, title=None, browse_filter=upnp.FILTER_MEDIA):
+        """
+        Same as iter_recordings, but yields the matching items
+        """
+        for recording in self.iter_recordings(folder, exclude, title, browse_filter):
+            yield from recording.items
+
+    def is_recording(self, item):
+        """
+        Returns True if the item is currently being recorded
+        """
+        with self.session.get(item.url, stream=True, timeout=STREAM_TIMEOUT) as r:
+            r.raise_for_status()
+            return is_live(r)
+
+    def download(self, item, file_path, on_progress=None):
+        """
+        Save an item to a file, writing to a lock file that's renamed once complete
+        A lock file left by an earlier download is continued from where it stopped, as are dropped connections
+        on_progress(item, bytes_received, total_bytes) is called about every 1% of the download
+        Returns False if the item is currently being recorded
+        """
+        lock_file = file_path + CONST_LOCK
+        delays = upnp.RETRY_POLICY.delays()
+        while True:
+            try:
+                saved = self.__write_stream(item, lock_file, on_progress)
+                break
+            except requests.exceptions.RequestException as err:
+                delay = next(delays, None)
+                if delay is None:
+                    raise upnp.UpnpError(msg=f'Download of {item.url} failed, Error: {err}')
+                time.sleep(delay)
+        if saved:
+            os.replace(lock_file, file_path)
+        return saved
+
+    def __write_stream(self, item, lock_file, on_progress):
+        r, offset = open_stream(self.session.get, item.url, lock_file, os.path.exists(lock_file), STREAM_TIMEOUT)
+        with r:
+            if is_live(r):
+                return False
+
+            total = offset + int(r.headers.get('content-length', 0))
+            received = offset
+            step = max(total // PROGRESS_STEPS, CHUNK_SIZE)
+            next_report = received + step
+            with open(lock_file, 'ab' if offset else 'wb') as f:
+                try:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:  # filter out keep-alive new chunks
+                            f.write(chunk)
+                            received += len(chunk)
+                            if on_progress and received >= next_report:
+                                on_progress(item, received, total)
+                                next_report = received + step
+                except requests.exceptions.RequestException as err:
+                    # Complete when the stream is only shorter than its content-length, a known issue
+                    if get_short_length(err, r) is None:
+                        raise
+                    total = received
+            if on_progress:
+                on_progress(item, received, total)
+            return True
@@ -0,0 +1,103 @@
+import os
+
+from urllib3.exceptions import IncompleteRead
+
+import helpers.upnp as upnp
+
+CONST_LOCK = '.lock'
+LOCK_WRITTEN = '.written'
+
+
+def is_live(response):
+    """
+    Check if the response is for an item that's currently recording, which has no size yet
+    """
+    content_range = response.headers.get('content-range', '')
+    return (int(response.headers.get('content-length', 0)) == upnp.MAX_OCTET or
+            content_range.endswith(f'/{upnp.MAX_OCTET}') or content_range.endswith('/*'))
+
+
+def get_short_length(err, response):
+    """
+    Return the bytes actually received if the error is the known issue where the media stream is shorter than its
+    content-length, so it can be saved as complete, otherwise None
+    """
+    try:
+        if isinstance(err.args[0].args[1], IncompleteRead):
+            actual_length = int(response.raw.tell())
+            if int(response.headers.get('content-length')) != actual_length:
+                return actual_length
+    except (IndexError, AttributeError, TypeError):
+        # Some other error occurred
+        pass
+    return None
+
+
+def open_stream(get, url, lock_file, resume, timeout):
+    """
+    Request the url, continuing from the bytes already written to the lock file when resuming
+    Returns the response and the offset it starts at, which is 0 if the server doesn't support range requests
+    A lock file the server can't continue, e.g. it's bigger than the recording, is emptied and the whole recording
+    requested instead. Client errors are raised as UpnpError
+    """
+    offset = discard_unwritten(lock_file) if resume else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    r = get(url, stream=True, headers=headers, timeout=timeout)
+    if offset and r.status_code == 416:
+        r.close()
+        open(lock_file, 'wb').close()
+        offset = 0
+        r = get(url, stream=True, headers={}, timeout=timeout)
+    try:
+        if 400 <= r.status_code < 500:
+            raise upnp.UpnpError(msg=f'Request failed with status: {r.status_code}')
+        r.raise_for_status()
+    except BaseException:
+        r.close()
+        raise
+    if r.status_code != 206:
+        # Range not supported, start from the beginning
+        offset = 0
+    return r, offset
+
+
+def record_written(lock_file, size):
+    """
+    Record the bytes written to a preallocated lock file, in a file next to it, as they're unknown from its size
+    """
+    with open(lock_file + LOCK_WRITTEN, 'w') as f:
+        f.write(str(size))
+
+
+def remove_written(lock_file):
+    try:
+        os.remove(lock_file + LOCK_WRITTEN)
+    except FileNotFoundError:
+        pass
+
+
+def get_written_size(lock_file):
+    """
+    Return the bytes written to a lock file, which is only its size once any preallocated space has been released
+    """
+    if not os.path.exists(lock_file):
+        return 0
+    size = os.path.getsize(lock_file)
+    try:
+        with open(lock_file + LOCK_WRITTEN, 'r') as f:
+            return min(int(f.read()), size)
+    except (OSError, ValueError):
+        return size
+
+
+def discard_unwritten(lock_file):
+    """
+    Release the preallocated space left by a run that was killed, so the download continues from the bytes written
+    Returns the size of the lock file
+    """
+    size = get_written_size(lock_file)
+    if os.path.exists(lock_file + LOCK_WRITTEN):
+        with open(lock_file, 'r+b') as f:
+            f.truncate(size)
+        remove_written(lock_file)
+    return size
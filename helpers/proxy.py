@@ -0,0 +1,250 @@
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import helpers.upnp as upnp
+
+CACHE_BLOCK = 4 * 1024 * 1024
+STREAM_TIMEOUT = 30
+RECORDINGS_PATH = '/recordings'
+CONTENT_TYPE = 'video/mpeg'
+
+
+class SegmentCache:
+    """
+    Blocks of recordings stored on disk, one file per block, so only the parts that have been watched are kept
+    Once the cache is over its size limit the least recently read blocks are removed
+    """
+
+    def __init__(self, path, limit, block_size=CACHE_BLOCK):
+        self.path = path
+        self.limit = limit
+        self.block_size = block_size
+        self.__lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, _, size in self.__iter_blocks())
+
+    def __iter_blocks(self):
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for block in os.scandir(directory.path):
+                if block.is_file() and not block.name.endswith('.tmp'):
+                    stat = block.stat()
+                    yield block.path, stat.st_mtime, stat.st_size
+
+    def get_block_path(self, key, index):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', key), str(index))
+
+    def get(self, key, index):
+        """
+        Return a cached block, or None if it isn't cached
+        """
+        block_path = self.get_block_path(key, index)
+        try:
+            with open(block_path, 'rb') as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(block_path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, index, data):
+        block_path = self.get_block_path(key, index)
+        os.makedirs(os.path.dirname(block_path), exist_ok=True)
+        temp_path = f'{block_path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        with self.__lock:
+            existing = os.path.getsize(block_path) if os.path.exists(block_path) else 0
+            os.replace(temp_path, block_path)
+            self.size += len(data) - existing
+            if self.size > self.limit:
+                self.__evict()
+
+    def __evict(self):
+        for block_path, _, size in sorted(self.__iter_blocks(), key=lambda block: block[1]):
+            if self.size <= self.limit:
+                break
+            try:
+                os.remove(block_path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+
+class RecordingProxy:
+    """
+    Serves recordings from a FetchClient, reading the blocks requested from the cache or the Fetch server
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+        self.__items = {}
+        self.__lock = threading.Lock()
+        self.__block_locks = {}
+
+    def get_items(self, refresh=False):
+        with self.__lock:
+            if refresh or not self.__items:
+                self.__items = {item.id: item for folder in self.client.iter_folders() for item in folder.items}
+            return dict(self.__items)
+
+    def get_item(self, item_id):
+        """
+        Return the recording with the id, browsing the server again if it's a new recording
+        """
+        item = self.get_items().get(item_id)
+        if item is None:
+            item = self.get_items(refresh=True).get(item_id)
+        return item
+
+    def read_block(self, item, index):
+        """
+        Return a block of the recording, fetching and caching it if it isn't cached
+        """
+        data = self.cache.get(item.id, index)
+        if data is not None:
+            return data
+
+        with self.__lock:
+            block_lock = self.__block_locks.setdefault((item.id, index), threading.Lock())
+        with block_lock:
+            # Another request may have just fetched it
+            data = self.cache.get(item.id, index)
+            if data is None:
+                data = self.fetch_block(item, index)
+                self.cache.put(item.id, index, data)
+        with self.__lock:
+            self.__block_locks.pop((item.id, index), None)
+        return data
+
+    def fetch_block(self, item, index):
+        start = index * self.cache.block_size
+        end = min(start + self.cache.block_size, item.size) - 1
+        headers = {'Range': f'bytes={start}-{end}'}
+        resp = upnp.request_with_retry(item.url, lambda: self.client.session.get(item.url, headers=headers,
+                                                                                 timeout=STREAM_TIMEOUT))
+        if resp.status_code != 206:
+            raise upnp.UpnpError(msg=f'Range request failed with status: {resp.status_code}')
+        return resp.content
+
+    def iter_range(self, item, start, end):
+        """
+        Yield the bytes of the recording from start to end, inclusive
+        """
+        block_size = self.cache.block_size
+        for index in range(start // block_size, end // block_size + 1):
+            data = self.read_block(item, index)
+            block_start = index * block_size
+            yield data[max(start - block_start, 0):end - block_start + 1]
+
+
+def parse_range(value, size):
+    """
+    Return the start and end of a single "bytes=" range, None if there's no range, or raise ValueError if the
+    range can't be satisfied
+    """
+    if not value:
+        return None
+    match = re.match(r'^bytes=(\d*)-(\d*)$', value.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError(f'Unsupported range: {value}')
+    if not match.group(1):
+        # Suffix range, the last n bytes
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        raise ValueError(f'Range not satisfiable: {value}')
+    return start, end
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    """
+    GET /recordings lists the recordings and their paths as JSON
+    GET /recordings/<id>.mpeg streams a recording, supports Range requests
+    """
+    proxy = None
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        self.streaming = False
+        try:
+            if self.path.rstrip('/') == RECORDINGS_PATH:
+                self.send_index(send_body)
+                return
+            match = re.match(f'^{RECORDINGS_PATH}/([^/]+)\\.mpeg$', self.path)
+            item = self.proxy.get_item(match.group(1)) if match else None
+            if item is None:
+                self.send_error(404, 'Recording not found')
+                return
+            self.send_recording(item, send_body)
+        except upnp.UpnpError as err:
+            if self.streaming:
+                # Too late to report the error
+                self.close_connection = True
+            else:
+                self.send_error(502, str(err))
+        except (BrokenPipeError, ConnectionResetError):
+            # Player stopped reading, e.g. it seeked elsewhere
+            pass
+
+    def send_index(self, send_body):
+        recordings = [{'id': item.id, 'title': item.title, 'folder': item.parent_name, 'size': item.size,
+                       'duration': item.duration, 'path': f'{RECORDINGS_PATH}/{item.id}.mpeg'}
+                      for item in self.proxy.get_items(refresh=True).values()]
+        body = json.dumps(recordings, indent=2).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_recording(self, item, send_body):
+        if not item.size or item.size == upnp.MAX_OCTET:
+            self.send_error(503, 'Recording is in progress')
+            return
+        try:
+            byte_range = parse_range(self.headers.get('Range'), item.size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{item.size}')
+            self.end_headers()
+            return
+
+        start, end = byte_range or (0, item.size - 1)
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        if byte_range:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{item.size}')
+        self.end_headers()
+        self.streaming = True
+        if send_body:
+            for data in self.proxy.iter_range(item, start, end):
+                self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests aren't logged
+        pass
+
+
+def create_server(proxy, host='', port=0):
+    """
+    Return an HTTP server for the proxy, call serve_forever() to start it
+    """
+    handler = type('Handler', (ProxyHandler,), {'proxy': proxy})
+    return ThreadingHTTPServer((host, port), handler)
@@ -1,7 +1,12 @@
+import random
 import re
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
 
 try:
     from urlparse import urlparse
@@ -10,7 +15,30 @@ except ImportError:
 
 DISCOVERY_TIMEOUT = 3
 REQUEST_TIMEOUT = 5
+BROWSE_TIMEOUT = 30
 NO_NUMBER_DEFAULT = ''
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 10
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_RESET = 30
+MAX_OCTET = 4398046510080
+ADAPTIVE_MAX = 8
+ADAPTIVE_WINDOW = 4
+ADAPTIVE_LATENCY_FACTOR = 2
+ADAPTIVE_MIN_GAIN = 0.05
+CONTENT_DIRECTORY = 'ContentDirectory'
+FETCHTV_PORT = 49152
+FETCH_MANUFACTURER_URL = 'http://www.fetch.com/'
+
+# Browse filters, the properties the server should return for each object
+FILTER_ALL = '*'
+FILTER_TITLES = 'dc:title,upnp:class'
+FILTER_MEDIA = 'dc:title,upnp:class,res,res@size,res@duration,res@parentTaskName'
+
+# Browse flags, an object's children or the object itself
+BROWSE_CHILDREN = 'BrowseDirectChildren'
+BROWSE_METADATA = 'BrowseMetadata'
 
 
 class UpnpError(Exception):
@@ -18,6 +46,211 @@ class UpnpError(Exception):
         super().__init__(msg)
 
 
+class RetryPolicy:
+    """
+    How many times to retry a failed request, waiting with exponential backoff and jitter between attempts
+    """
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delays(self):
+        """
+        Yield the delay before each retry, half fixed and half random so clients don't retry in lock step
+        """
+        for attempt in range(self.attempts):
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            yield delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests once a server has stopped responding, until it has had some time to recover
+    Requests wait while the circuit is open rather than fail, so a server that's briefly overloaded only delays them
+    """
+
+    def __init__(self, threshold=CIRCUIT_THRESHOLD, reset_timeout=CIRCUIT_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.__lock = threading.Lock()
+
+    def check(self, url):
+        """
+        Wait while the circuit is open, then let requests through on trial, another failure opens it again
+        """
+        waited = None
+        while True:
+            with self.__lock:
+                if self.opened_at is None:
+                    return
+                if self.opened_at == waited or time.monotonic() - self.opened_at >= self.reset_timeout:
+                    # Allow a trial request through
+                    self.opened_at = None
+                    self.failures = self.threshold - 1
+                    return
+                # Waited again if the circuit was opened again by another request's trial
+                waited = self.opened_at
+                remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            time.sleep(remaining)
+
+    def success(self):
+        with self.__lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class ConcurrencyController:
+    """
+    Adjusts how many requests are sent to a server at once, AIMD style
+    After each window of completed requests the limit is halved if any failed or their latency has grown well
+    beyond the best seen, otherwise it's raised by one. For transfers the limit is only raised while doing so
+    increases the total throughput, so it settles near what the server can handle
+    """
+
+    def __init__(self, name, initial=1, maximum=ADAPTIVE_MAX, minimum=1, log=None):
+        self.name = name
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.log = log
+        self.decisions = []
+        self.in_flight = 0
+        self.__condition = threading.Condition()
+        self.__baseline = None
+        self.__last_throughput = None
+        self.__raised = False
+        self.__reset_window()
+
+    def __reset_window(self):
+        self.__window_start = time.monotonic()
+        self.__latencies = []
+        self.__errors = 0
+        self.__bytes = 0
+
+    def acquire(self):
+        """
+        Wait until another request can be sent
+        """
+        with self.__condition:
+            while self.in_flight >= self.limit:
+                self.__condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds, success=True, size=None):
+        """
+        Record a completed request and its latency, and the bytes transferred for streams
+        """
+        with self.__condition:
+            self.in_flight -= 1
+            self.__latencies.append(seconds)
+            if not success:
+                self.__errors += 1
+            if size:
+                self.__bytes += size
+            if len(self.__latencies) >= max(ADAPTIVE_WINDOW, self.limit):
+                self.__adjust()
+            self.__condition.notify_all()
+
+    def call(self, request, *args):
+        """
+        Call request(*args) once a request can be sent, recording its latency and whether it failed
+        """
+        self.acquire()
+        start = time.monotonic()
+        success = False
+        try:
+            result = request(*args)
+            success = True
+            return result
+        finally:
+            self.release(time.monotonic() - start, success)
+
+    def __adjust(self):
+        latency = sum(self.__latencies) / len(self.__latencies)
+        elapsed = time.monotonic() - self.__window_start
+        throughput = self.__bytes / elapsed if self.__bytes and elapsed > 0 else None
+        limit = self.limit
+        if self.__errors:
+            limit = max(self.minimum, self.limit // 2)
+            reason = f'{self.__errors} failed'
+        elif self.__baseline and not throughput and latency > self.__baseline * ADAPTIVE_LATENCY_FACTOR:
+            limit = max(self.minimum, self.limit // 2)
+            reason = f'latency {latency:.2f}s is over {ADAPTIVE_LATENCY_FACTOR}x the best {self.__baseline:.2f}s'
+        elif (throughput and self.__raised and self.__last_throughput and
+              throughput < self.__last_throughput * (1 + ADAPTIVE_MIN_GAIN)):
+            limit = max(self.minimum, self.limit - 1)
+            reason = f'throughput {throughput / 1024 / 1024:.1f} MB/s didn\'t improve'
+        else:
+            limit = min(self.maximum, self.limit + 1)
+            reason = f'latency {latency:.2f}s' + (f', throughput {throughput / 1024 / 1024:.1f} MB/s'
+                                                 if throughput else '')
+        if not self.__errors:
+            self.__baseline = latency if self.__baseline is None else min(self.__baseline, latency)
+        self.__raised = limit > self.limit
+        self.__last_throughput = throughput
+        if limit != self.limit:
+            self.decisions.append((self.limit, limit, reason))
+            if self.log:
+                self.log(f'{self.name} concurrency {self.limit} -> {limit}, {reason}')
+            self.limit = limit
+        self.__reset_window()
+
+
+RETRY_POLICY = RetryPolicy()
+CIRCUIT_BREAKERS = {}
+CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+
+def get_circuit_breaker(url):
+    """
+    Return the circuit breaker shared by all requests to the url's server
+    """
+    netloc = urlparse(url).netloc
+    with CIRCUIT_BREAKERS_LOCK:
+        if netloc not in CIRCUIT_BREAKERS:
+            CIRCUIT_BREAKERS[netloc] = CircuitBreaker()
+        return CIRCUIT_BREAKERS[netloc]
+
+
+def request_with_retry(url, request, is_final=None):
+    """
+    Call request(), retrying connection errors, timeouts and server errors as per the RETRY_POLICY
+
+    @param url the url being requested, used to find the server's circuit breaker
+    @param request a function that sends the request and returns the response
+    @param is_final optional function returning True for a server error response that retrying won't change, which is
+           returned as is without counting towards the circuit breaker
+    """
+    breaker = get_circuit_breaker(url)
+    delays = RETRY_POLICY.delays()
+    while True:
+        breaker.check(url)
+        try:
+            resp = request()
+            if resp.status_code < 500 or (is_final and is_final(resp)):
+                breaker.success()
+                return resp
+            msg = f'Request failed with status: {resp.status_code}'
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            msg = f'Request to {url} failed, Error: {err}'
+
+        breaker.failure()
+        delay = next(delays, None)
+        if delay is None:
+            raise UpnpError(msg=msg)
+        time.sleep(delay)
+
+
 class Location:
     BASE_PATH = "./{urn:schemas-upnp-org:device-1-0}device/{urn:schemas-upnp-org:device-1-0}"
 
@@ -30,6 +263,30 @@ class Location:
         self.modelDescription = get_xml_text(xml, Location.BASE_PATH + "modelDescription")
         self.modelName = get_xml_text(xml, Location.BASE_PATH + "modelName")
         self.modelNumber = get_xml_text(xml, Location.BASE_PATH + "modelNumber")
+        self.udn = get_xml_text(xml, Location.BASE_PATH + "UDN")
+
+
+class ContentDirectory:
+    """
+    The capabilities of a server's ContentDirectory service, as returned by get_services
+    Requests using the service are sent with its session, if it has one
+    """
+
+    def __init__(self, base_url, service, actions, session=None):
+        self.service_type = get_xml_text(service, './{urn:schemas-upnp-org:device-1-0}serviceType')
+        self.scpd_url = get_service_url(base_url, service, 'SCPDURL')
+        self.control_url = get_service_url(base_url, service, 'controlURL')
+        self.event_url = get_service_url(base_url, service, 'eventSubURL')
+        self.actions = list(actions)
+        self.session = session
+
+    @property
+    def browse(self):
+        return 'Browse' in self.actions
+
+    @property
+    def search(self):
+        return 'Search' in self.actions
 
 
 class Folder:
@@ -39,6 +296,16 @@ class Folder:
         self.parent_id = get_xml_attr(xml, 'parentID', NO_NUMBER_DEFAULT)
         self.items = []
 
+    @staticmethod
+    def from_values(values):
+        """
+        Instantiate from previously saved values, e.g. from a catalogue
+        """
+        folder = Folder.__new__(Folder)
+        folder.__dict__.update(values)
+        folder.items = []
+        return folder
+
     def add_items(self, items):
         self.items = [itm for itm in items]
 
@@ -53,11 +320,23 @@ class Item:
         self.description = xml.find("./{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}description")
         self.description = self.description.text if self.description is not None else ''
         res = xml.find("./{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}res")
-        self.url = res.text
-        self.size = int(get_xml_attr(res, 'size', NO_NUMBER_DEFAULT))
+        if res is None:
+            # Excluded by the browse filter
+            res = ElementTree.Element('res')
+        self.url = res.text or ''
+        self.size = int(get_xml_attr(res, 'size', '0'))
         self.duration = ts_to_seconds(get_xml_attr(res, 'duration', '0'))
         self.parent_name = get_xml_attr(res, 'parentTaskName')
 
+    @staticmethod
+    def from_values(values):
+        """
+        Instantiate from previously saved values, e.g. from a catalogue
+        """
+        item = Item.__new__(Item)
+        item.__dict__.update(values)
+        return item
+
 
 def ts_to_seconds(ts):
     """
@@ -122,7 +401,43 @@ def get_xml_text(xml, xml_name, default=''):
         return default
 
 
-def parse_locations(locations):
+def get_http(session=None):
+    """
+    Return the requests.Session to send requests with, or the requests module so each request has its own connection
+    """
+    return session or requests
+
+
+def get_location_url(ip, port=FETCHTV_PORT):
+    return 'http://%s:%i/MediaServer.xml' % (ip, port)
+
+
+def get_location_urls(servers, port=FETCHTV_PORT):
+    """
+    Return the location url of each "<ip>[:<port>]" server, using the port when a server doesn't have one
+    """
+    location_urls = []
+    for server in servers:
+        ip, _, server_port = server.partition(':')
+        location_urls.append(get_location_url(ip, int(server_port) if server_port else port))
+    return location_urls
+
+
+def iter_fetch_locations(location_urls, session=None):
+    """
+    Yield the location of each Fetch server, ignoring any other UPnP devices
+    """
+    for location in location_urls:
+        try:
+            locations = parse_locations([location], session)
+            if locations[0].manufacturerURL == FETCH_MANUFACTURER_URL:
+                yield locations[0]
+        except UpnpError:
+            # Bad location
+            pass
+
+
+def parse_locations(locations, session=None):
     """
     Loads the XML at each location and prints out the API along with some other
     interesting data.
@@ -134,7 +449,7 @@ def parse_locations(locations):
     if len(locations) > 0:
         for location in locations:
             try:
-                resp = requests.get(location, timeout=REQUEST_TIMEOUT)
+                resp = get_http(session).get(location, timeout=REQUEST_TIMEOUT)
                 try:
                     xml_root = ElementTree.fromstring(resp.text)
                 except ElementTree.ParseError as err:
@@ -150,50 +465,90 @@ def parse_locations(locations):
     return result
 
 
-def get_services(location):
+def get_services(location, session=None):
+    """
+    Return the capabilities of the server's first ContentDirectory service that supports browsing
+    The ContentDirectory service descriptions are fetched concurrently, and the other services' descriptions are
+    only fetched if none of them support browsing
+    Later requests using the services are sent with the session, if provided
+    """
     parsed = urlparse(location.url)
-    resp = requests.get(location.url, timeout=REQUEST_TIMEOUT)
+    resp = get_http(session).get(location.url, timeout=REQUEST_TIMEOUT)
     try:
         xml_root = ElementTree.fromstring(resp.text)
     except Exception as err:
         raise UpnpError(msg=f'XML parsing failed for location: {location}, Error: {err.msg}')
 
-    result = {}
-
+    base_url = parsed.scheme + "://" + parsed.netloc
     services = xml_root.findall(".//*{urn:schemas-upnp-org:device-1-0}serviceList/")
-    for service in services:
-        # Add a lead in '/' if it doesn't exist
-        scp = service.find('./{urn:schemas-upnp-org:device-1-0}SCPDURL').text
-        if scp[0] != '/':
-            scp = '/' + scp
-        service_url = parsed.scheme + "://" + parsed.netloc + scp
-
-        # read in the SCP XML
-        resp = requests.get(service_url, timeout=REQUEST_TIMEOUT)
+    content_directories = [service for service in services if CONTENT_DIRECTORY in (
+        get_xml_text(service, './{urn:schemas-upnp-org:device-1-0}serviceType') or '')]
+    others = [service for service in services if service not in content_directories]
+    for candidates in (content_directories, others):
+        if not candidates:
+            continue
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            futures = [executor.submit(get_service_actions, base_url, service, session) for service in candidates]
+            try:
+                for service, future in zip(candidates, futures):
+                    actions = future.result()
+                    if 'Browse' in actions:
+                        return ContentDirectory(base_url, service, actions, session)
+            finally:
+                for future in futures:
+                    future.cancel()
+    raise UpnpError(msg=f'No ContentDirectory service found for location: {location.url}')
+
+
+def get_service_actions(base_url, service, session=None):
+    """
+    Return the names of the actions in a service's description (SCPD)
+    """
+    resp = get_http(session).get(get_service_url(base_url, service, 'SCPDURL'), timeout=REQUEST_TIMEOUT)
+    try:
         service_xml = ElementTree.fromstring(resp.text)
+    except ElementTree.ParseError:
+        # Not a service we can use
+        return []
+    actions = service_xml.findall(".//*{urn:schemas-upnp-org:service-1-0}action")
+    return [action.find('./{urn:schemas-upnp-org:service-1-0}name').text for action in actions]
 
-        actions = service_xml.findall(".//*{urn:schemas-upnp-org:service-1-0}action")
-        for action in actions:
-            if action.find('./{urn:schemas-upnp-org:service-1-0}name').text == 'Browse':
-                result['service_url'] = service_url
-                result['cd_ctr'] = parsed.scheme + "://" + parsed.netloc + service.find(
-                    './{urn:schemas-upnp-org:device-1-0}controlURL').text
-                result['cd_service'] = service.find('./{urn:schemas-upnp-org:device-1-0}serviceType').text
-                break
-    return result
 
+def get_service_url(base_url, service, name):
+    """
+    Return a service's absolute URL, e.g. its SCPDURL, or '' if it doesn't have one
+    """
+    path = get_xml_text(service, './{urn:schemas-upnp-org:device-1-0}' + name)
+    if not path:
+        return ''
+    # Add a lead in '/' if it doesn't exist
+    if path[0] != '/':
+        path = '/' + path
+    return base_url + path
 
-def find_directories(api_service, object_id='0'):
+
+def find_directories(api_service, object_id='0', browse_filter=FILTER_ALL):
     """
     Send a 'Browse' request for the top level directory. We will print out the
     top level containers that we observer. I've limited the count to 10.
 
     @param p_url the url to send the SOAPAction to
     @param p_service the service in charge of this control URI
+    @param browse_filter the properties to return for each folder and item, e.g. FILTER_TITLES
     """
-    p_url = api_service['cd_ctr']
-    p_service = api_service['cd_service']
-    result = []
+    return list(iter_directories(api_service, object_id, browse_filter))
+
+
+def iter_directories(api_service, object_id='0', browse_filter=FILTER_ALL, with_items=True, controller=None,
+                     folder_filter=None):
+    """
+    Same as find_directories, but yields each folder as soon as its items have been browsed
+    Folder items aren't browsed if with_items is False
+    With a ConcurrencyController several folders are browsed at once, folders are still yielded in order
+    Only folders that folder_filter(folder) returns True for are browsed and yielded, when provided
+    """
+    p_url = api_service.control_url
+    p_service = api_service.service_type
     payload = (
         f'''
             <?xml version="1.0" encoding="utf-8" standalone="yes"?>
@@ -202,7 +557,7 @@ def find_directories(api_service, object_id='0'):
             <u:Browse xmlns:u="{p_service}">
             <ObjectID>{object_id}</ObjectID>
             <BrowseFlag>BrowseDirectChildren</BrowseFlag>
-            <Filter>*</Filter>
+            <Filter>{browse_filter}</Filter>
             <StartingIndex>0</StartingIndex>
             <SortCriteria></SortCriteria>
             </u:Browse>
@@ -215,26 +570,46 @@ def find_directories(api_service, object_id='0'):
         'Content-type': 'text/xml;charset="utf-8"'
     }
 
-    resp = requests.post(p_url, data=payload, headers=soap_action_header)
+    http = get_http(api_service.session)
+    resp = request_with_retry(p_url, lambda: http.post(p_url, data=payload, headers=soap_action_header,
+                                                       timeout=BROWSE_TIMEOUT))
     if resp.status_code != 200:
         raise UpnpError(msg=f'Request failed with status: {resp.status_code}')
 
     xml_root = ElementTree.fromstring(resp.text)
     containers = xml_root.find(".//*Result").text
     if not containers:
-        return result
+        return
 
     xml_root = ElementTree.fromstring(containers)
     containers = xml_root.findall("./{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}container")
-    for container in containers:
-        if container.find("./{urn:schemas-upnp-org:metadata-1-0/upnp/}class").text.find("object.container") > -1:
-            folder = Folder(container)
-            result.append(folder)
-            folder.add_items(find_items(p_url, p_service, container.attrib['id']))
-    return result
-
-
-def find_items(p_url, p_service, object_id):
+    folders = [Folder(container) for container in containers
+               if container.find("./{urn:schemas-upnp-org:metadata-1-0/upnp/}class").text.find("object.container") > -1]
+    if folder_filter:
+        folders = [folder for folder in folders if folder_filter(folder)]
+    if not with_items:
+        yield from folders
+        return
+    if not controller:
+        for folder in folders:
+            folder.add_items(find_items(p_url, p_service, folder.id, browse_filter, api_service.session))
+            yield folder
+        return
+
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        futures = [executor.submit(controller.call, find_items, p_url, p_service, folder.id, browse_filter,
+                                   api_service.session) for folder in folders]
+        try:
+            for folder, future in zip(folders, futures):
+                folder.add_items(future.result())
+                yield folder
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def find_items(p_url, p_service, object_id, browse_filter=FILTER_ALL, session=None,
+               browse_flag=BROWSE_CHILDREN):
     result = []
     payload = (
         f'''
@@ -243,8 +618,8 @@ def find_items(p_url, p_service, object_id):
             <s:Body>
             <u:Browse xmlns:u="{p_service}">
             <ObjectID>{object_id}</ObjectID>
-            <BrowseFlag>BrowseDirectChildren</BrowseFlag>
-            <Filter>*</Filter>
+            <BrowseFlag>{browse_flag}</BrowseFlag>
+            <Filter>{browse_filter}</Filter>
             <StartingIndex>0</StartingIndex>
             <SortCriteria></SortCriteria>
             </u:Browse>
@@ -256,7 +631,9 @@ def find_items(p_url, p_service, object_id):
         'Content-type': 'text/xml;charset="utf-8"'
     }
 
-    resp = requests.post(p_url, data=payload, headers=soap_action_header)
+    http = get_http(session)
+    resp = request_with_retry(p_url, lambda: http.post(p_url, data=payload, headers=soap_action_header,
+                                                       timeout=BROWSE_TIMEOUT))
     if resp.status_code != 200:
         raise UpnpError(msg=f'Request failed with status: {resp.status_code}')
 
@@ -271,3 +648,131 @@ def find_items(p_url, p_service, object_id):
         itm = Item(item)
         result.append(itm)
     return result
+
+
+def find_metadata(api_service, object_id, browse_filter=FILTER_ALL):
+    """
+    Send a 'BrowseMetadata' request for a single item, without browsing its folder
+    Returns None if the object isn't an item, e.g. it has been deleted
+    """
+    items = find_items(api_service.control_url, api_service.service_type, object_id, browse_filter,
+                       api_service.session, BROWSE_METADATA)
+    return next((item for item in items if item.id == str(object_id)), None)
+
+
+def search_items(api_service, container_id, criteria, browse_filter=FILTER_ALL):
+    """
+    Send a 'Search' request for all the items under a container that match the search criteria
+
+    @param container_id the container to search, including its sub-containers
+    @param criteria the UPnP search criteria, e.g. 'dc:title contains "S4 E12"'
+    """
+    p_url = api_service.control_url
+    p_service = api_service.service_type
+    result = []
+    payload = (
+        f'''
+            <?xml version="1.0" encoding="utf-8" standalone="yes"?>
+            <s:Envelope s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/" xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
+            <s:Body>
+            <u:Search xmlns:u="{p_service}">
+            <ContainerID>{container_id}</ContainerID>
+            <SearchCriteria>{escape(criteria)}</SearchCriteria>
+            <Filter>{browse_filter}</Filter>
+            <StartingIndex>0</StartingIndex>
+            <RequestedCount>0</RequestedCount>
+            <SortCriteria></SortCriteria>
+            </u:Search>
+            </s:Body>
+            </s:Envelope>
+            ''')
+    soap_action_header = {
+        'Soapaction': f'"{p_service}#Search"',
+        'Content-type': 'text/xml;charset="utf-8"'
+    }
+
+    http = get_http(api_service.session)
+    resp = request_with_retry(p_url, lambda: http.post(p_url, data=payload, headers=soap_action_header,
+                                                       timeout=BROWSE_TIMEOUT),
+                              is_final=get_soap_error)
+    if resp.status_code != 200:
+        error = get_soap_error(resp)
+        if error:
+            raise UpnpError(msg=f'Search not supported, UPnP error: {error}')
+        raise UpnpError(msg=f'Search failed with status: {resp.status_code}')
+
+    try:
+        xml_root = ElementTree.fromstring(resp.text)
+        items = xml_root.find(".//*Result").text
+        if not items:
+            return result
+        xml_root = ElementTree.fromstring(items)
+    except (ElementTree.ParseError, AttributeError) as err:
+        raise UpnpError(msg=f'Search response could not be parsed, Error: {err}')
+    for item in xml_root.findall("./{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}item"):
+        result.append(Item(item))
+    return result
+
+
+def get_soap_error(resp):
+    """
+    Return the UPnP error code of a SOAP fault response, e.g. 708 for unsupported search criteria, otherwise None
+    A fault is the server's answer to the request, so sending it again won't change it
+    """
+    if resp.status_code != 500:
+        return None
+    try:
+        xml_root = ElementTree.fromstring(resp.text)
+    except (ElementTree.ParseError, TypeError):
+        return None
+    if xml_root.find(".//{http://schemas.xmlsoap.org/soap/envelope/}Fault") is None:
+        return None
+    return get_xml_text(xml_root, ".//{urn:schemas-upnp-org:control-1-0}errorCode") or 'unknown'
+
+
+def search_folders(api_service, container_id, criteria, browse_filter=FILTER_ALL, folder_filter=None):
+    """
+    Return the folders under a container, with only the items that match the search criteria
+    Only the folders are browsed, the items are found with a single search, then grouped by their parent folder
+    """
+    folders = list(iter_directories(api_service, container_id, FILTER_TITLES, with_items=False,
+                                    folder_filter=folder_filter))
+    folder_items = {}
+    for item in search_items(api_service, container_id, criteria, browse_filter):
+        folder_items.setdefault(item.parent_id, []).append(item)
+    for folder in folders:
+        folder.add_items(folder_items.get(folder.id, []))
+    return folders
+
+
+def quote_criteria(value):
+    """
+    Quote a string for use in search criteria
+    """
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def get_title_criteria(titles):
+    """
+    Return search criteria for items with a title containing any of the text, or None if there's no text
+    """
+    titles = [title.strip() for title in titles if title.strip()]
+    if not titles:
+        return None
+    matches = ' or '.join(f'dc:title contains {quote_criteria(title)}' for title in titles)
+    return f'upnp:class derivedfrom "object.item" and ({matches})'
+
+
+def contains_any(text, values):
+    """
+    Returns True if the text contains any of the values, ignoring case, the local equivalent of get_title_criteria
+    """
+    text = (text or '').lower()
+    return any(text.find(value.strip().lower()) != -1 for value in values)
+
+
+def is_match(text, include=None, exclude=None):
+    """
+    Returns True if the text contains any of the include values, or there are none, and none of the exclude values
+    """
+    return (not include or contains_any(text, include)) and not (exclude and contains_any(text, exclude))
@@ -0,0 +1,57 @@
+"""
+Compares the size of the Browse responses, and the time taken to browse all recordings, for each browse filter.
+Uses the Fetch server set in .env, e.g.
+python -m tests.benchmark_browse
+"""
+import os
+import time
+from os.path import join, dirname
+
+import requests
+from dotenv import load_dotenv
+
+import fetchtv_upnp as fetchtv
+import helpers.upnp as upnp
+
+dotenv_path = join(dirname(__file__), '.env')
+load_dotenv(dotenv_path)
+
+FETCHTV_IP = os.getenv("FETCHTV_IP")
+FETCHTV_PORT = int(os.getenv("FETCHTV_PORT"))
+
+
+def benchmark(fetch_server, browse_filter):
+    response_bytes = 0
+    post = requests.post
+
+    def counting_post(*args, **kwargs):
+        nonlocal response_bytes
+        resp = post(*args, **kwargs)
+        response_bytes += len(resp.content)
+        return resp
+
+    requests.post = counting_post
+    try:
+        start = time.perf_counter()
+        folders = list(fetchtv.iter_fetch_folders(fetch_server, browse_filter))
+        elapsed = time.perf_counter() - start
+    finally:
+        requests.post = post
+    items = sum(len(folder.items) for folder in folders)
+    return response_bytes, elapsed, len(folders), items
+
+
+def main():
+    fetch_server = fetchtv.discover_fetch(ip=FETCHTV_IP, port=FETCHTV_PORT)
+    if not fetch_server:
+        return
+    full_bytes = None
+    for name in ['FILTER_ALL', 'FILTER_MEDIA', 'FILTER_TITLES']:
+        response_bytes, elapsed, folders, items = benchmark(fetch_server, getattr(upnp, name))
+        full_bytes = full_bytes or response_bytes
+        print(f'{name:<14} {folders} folders, {items} items: {response_bytes} bytes '
+              f'({100 * response_bytes / full_bytes:.0f}%) in {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,28 @@
+import io
+import itertools
 import json
 import os
+import socket
+import subprocess
+import sys
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
 import fetchtv_upnp as fetchtv
 import tempfile
+import threading
+import urllib.error
+import urllib.request
+import requests
 from mock import Mock, patch, mock_open
+from urllib3.exceptions import IncompleteRead, ProtocolError
+import helpers.download as download
 import helpers.upnp as upnp
+from helpers.catalogue import Catalogue
+from helpers.client import FetchClient
+from helpers.proxy import RecordingProxy, SegmentCache, create_server, parse_range
 
 OPTION_IP = '--ip'
 OPTION_PORT = '--port'
@@ -14,6 +32,8 @@ OPTION_TITLE = '--title'
 OPTION_EXCLUDE = '--exclude'
 OPTION_SAVE = '--save'
 OPTION_JSON = '--json'
+OPTION_NDJSON = '--ndjson'
+OPTION_SERVERS = '--servers'
 
 CMD_RECORDINGS = '--recordings'
 CMD_IS_RECORDING = '--isrecording'
@@ -36,7 +56,7 @@ def get_file(filename):
         return file.read()
 
 
-def mock_get(p_url, timeout=0, stream=False):
+def mock_get(p_url, timeout=0, stream=False, headers=None):
     result = Mock()
     result.__enter__ = Mock(return_value=result)
     result.__exit__ = Mock()
@@ -56,7 +76,22 @@ def mock_get(p_url, timeout=0, stream=False):
     return result
 
 
-def mock_get_recording(p_url, timeout=0, stream=False):
+def mock_get_short(p_url, timeout=0, stream=False, headers=None):
+    """
+    A stream that ends before its content-length, a known issue with the Fetch server
+    """
+    result = mock_get(p_url)
+    result.__exit__ = Mock(return_value=False)
+
+    def iter_content(chunk_size):
+        yield b'012'
+        raise requests.exceptions.ChunkedEncodingError(ProtocolError('Connection broken', IncompleteRead(3, 2)))
+    result.iter_content = iter_content
+    result.raw.tell = Mock(return_value=3)
+    return result
+
+
+def mock_get_recording(p_url, timeout=0, stream=False, headers=None):
     result = Mock()
     result.__enter__ = Mock(return_value=result)
     result.__exit__ = Mock()
@@ -71,14 +106,16 @@ def mock_get_recording(p_url, timeout=0, stream=False):
     return result
 
 
-def mock_post(p_url, data, headers):
+def mock_post(p_url, data, headers, timeout=0):
     result = Mock()
     result.__enter__ = Mock()
     result.__exit__ = Mock()
     result.status_code = 200
 
     response_dir = os.path.dirname(__file__) + os.path.sep + 'responses' + os.path.sep
-    if data.find('<ObjectID>61</ObjectID>') != -1:
+    if headers['Soapaction'].endswith('#Search"'):
+        result.text = get_file(response_dir + 'fetch_search_items.xml')
+    elif data.find('<ObjectID>61</ObjectID>') != -1:
         result.text = get_file(response_dir + 'fetch_recording_items.xml')
     elif data.find('<ObjectID>0</ObjectID>') != -1:
         if p_url.startswith(URL_NO_RECORDINGS):
@@ -123,7 +160,7 @@ class TestOptions(unittest.TestCase):
 
     def test_option_multi_value(self):
         # Support multiple values
-        for option in [OPTION_FOLDER, OPTION_TITLE, OPTION_EXCLUDE]:
+        for option in [OPTION_FOLDER, OPTION_TITLE, OPTION_EXCLUDE, OPTION_SERVERS]:
             option = option.strip('-')
             options = fetchtv.Options([f'--{option}="wibble"'])
             self.assertEqual(options.__getattribute__(option), ['wibble'])
@@ -153,6 +190,19 @@ class TestOptions(unittest.TestCase):
             self.assertEqual(options.__getattribute__(option), 'wibble, wobble, rabble')
 
 
+    def test_option_choices(self):
+        options = fetchtv.Options(['--duplicates=link', '--diskfull=defer'])
+        self.assertEqual(fetchtv.DUPLICATES_LINK, options.duplicates)
+        self.assertEqual(fetchtv.DISK_FULL_DEFER, options.disk_full)
+        # The default when there's no value
+        options = fetchtv.Options(['--duplicates', '--diskfull'])
+        self.assertEqual(fetchtv.DUPLICATES_SKIP, options.duplicates)
+        self.assertEqual(fetchtv.DISK_FULL_SKIP, options.disk_full)
+        self.assertFalse(fetchtv.Options([CMD_RECORDINGS]).duplicates)
+        for option in ['--duplicates=lnk', '--diskfull=deferred']:
+            with self.assertRaises(ValueError):
+                fetchtv.Options([option])
+
 @patch('requests.get', mock_get)
 @patch('requests.post', mock_post)
 class TestGetFetchRecordings(unittest.TestCase):
@@ -174,6 +224,120 @@ class TestGetFetchRecordings(unittest.TestCase):
         output = json.loads(output)
         self.assertEqual(8, len(output))
 
+    def test_browse_filter(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        browse_filters = set()
+
+        def mock_post_filter(p_url, data, headers, timeout=0):
+            browse_filters.add(data[data.find('<Filter>') + len('<Filter>'):data.find('</Filter>')])
+            return mock_post(p_url, data, headers)
+
+        # Shows only need the titles
+        with patch('requests.post', mock_post_filter):
+            results = fetchtv.get_fetch_recordings(fetch_server, fetchtv.Options([CMD_SHOWS]))
+        self.assertEqual(8, len(results))
+        self.assertEqual({upnp.FILTER_TITLES}, browse_filters)
+
+        browse_filters.clear()
+        with patch('requests.post', mock_post_filter):
+            fetchtv.get_fetch_recordings(fetch_server, fetchtv.Options([CMD_RECORDINGS]))
+        self.assertEqual({upnp.FILTER_TITLES, upnp.FILTER_MEDIA}, browse_filters)
+
+    def test_search_recordings(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        actions = []
+
+        def mock_post_action(p_url, data, headers, timeout=0):
+            actions.append(headers['Soapaction'].split('#')[1].strip('"'))
+            return mock_post(p_url, data, headers)
+
+        options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}"'])
+        self.assertEqual('upnp:class derivedfrom "object.item" and (dc:title contains "S4 E12")',
+                         fetchtv.get_search_criteria(options))
+        with patch('requests.post', mock_post_action):
+            results = fetchtv.get_fetch_recordings(fetch_server, options)
+        # Only the folders are browsed, the items are searched for
+        self.assertEqual(['Browse', 'Browse', 'Search'], actions)
+        self.assertEqual(8, len(results))
+        items = [item for result in results for item in result['items']]
+        self.assertEqual(1, len(items))
+        self.assertTrue(items[0].title.startswith(SHOW_ONE_EP_ONE))
+
+    def test_search_fallback(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+
+        def mock_post_no_search(p_url, data, headers, timeout=0):
+            result = mock_post(p_url, data, headers)
+            if headers['Soapaction'].endswith('#Search"'):
+                result.status_code = 500
+            return result
+
+        options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}"'])
+        with patch('requests.post', mock_post_no_search), redirect_stdout(io.StringIO()):
+            results = fetchtv.get_fetch_recordings(fetch_server, options)
+        items = [item for result in results for item in result['items']]
+        self.assertEqual(1, len(items))
+        self.assertTrue(items[0].title.startswith(SHOW_ONE_EP_ONE))
+
+    def test_search_fault_not_retried(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        actions = []
+        fault = ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body><s:Fault>'
+                 '<faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring><detail>'
+                 '<UPnPError xmlns="urn:schemas-upnp-org:control-1-0"><errorCode>708</errorCode>'
+                 '<errorDescription>Unsupported or invalid search criteria</errorDescription></UPnPError>'
+                 '</detail></s:Fault></s:Body></s:Envelope>')
+
+        def mock_post_fault(p_url, data, headers, timeout=0):
+            actions.append(headers['Soapaction'].split('#')[1].strip('"'))
+            result = mock_post(p_url, data, headers)
+            if headers['Soapaction'].endswith('#Search"'):
+                result.status_code = 500
+                result.text = fault
+            return result
+
+        breaker = upnp.CircuitBreaker()
+        options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}"'])
+        with patch('requests.post', mock_post_fault), patch('time.sleep') as sleep, \
+                patch('helpers.upnp.get_circuit_breaker', return_value=breaker), \
+                redirect_stdout(io.StringIO()) as output:
+            results = fetchtv.get_fetch_recordings(fetch_server, options)
+        # The fault is the answer to the search, so it falls back to browsing straight away
+        self.assertEqual(1, actions.count('Search'))
+        sleep.assert_not_called()
+        self.assertEqual(0, breaker.failures)
+        self.assertIn('708', output.getvalue())
+        items = [item for result in results for item in result['items']]
+        self.assertEqual(1, len(items))
+
+    def test_folder_filter_before_browse(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        browsed = []
+
+        def mock_post_count(p_url, data, headers, timeout=0):
+            browsed.append(data[data.find('<ObjectID>') + len('<ObjectID>'):data.find('</ObjectID>')])
+            return mock_post(p_url, data, headers)
+
+        with patch('requests.post', mock_post_count):
+            results = fetchtv.get_fetch_recordings(fetch_server, fetchtv.Options([CMD_RECORDINGS,
+                                                                                  f'{OPTION_FOLDER}="{SHOW_ONE}"']))
+        self.assertEqual(1, len(results))
+        self.assertEqual(134, len(results[0]['items']))
+        # Base folders, recording folders, then only the matching folder's items
+        self.assertEqual(['0', '1', '61'], browsed)
+
+        browsed.clear()
+        with patch('requests.post', mock_post_count):
+            results = fetchtv.get_fetch_recordings(fetch_server, fetchtv.Options([CMD_SHOWS,
+                                                                                  f'{OPTION_EXCLUDE}="{SHOW_ONE}"']))
+        self.assertEqual(7, len(results))
+        self.assertEqual(['0', '1'], browsed)
+
     def test_no_recordings_folder(self):
         fetch_server = Mock()
         fetch_server.url = URL_NO_RECORDINGS
@@ -201,6 +365,22 @@ class TestGetFetchRecordings(unittest.TestCase):
         self.assertEqual(8, len(output))
         self.assertEqual(134, len(output[4]['items']))
 
+    def test_get_all_recordings_ndjson(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        options = fetchtv.Options([CMD_RECORDINGS, OPTION_NDJSON])
+        self.assertFalse(options.json)
+        results = fetchtv.iter_fetch_recordings(fetch_server, options)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            fetchtv.print_recordings(results)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        folders = [record for record in records if record['record'] == 'folder']
+        items = [record for record in records if record['record'] == 'item']
+        self.assertEqual(8, len(folders))
+        self.assertEqual(134, len(items))
+        self.assertEqual(folders[4]['id'], items[0]['folder_id'])
+
     def test_get_recordings_items_json(self):
         fetch_server = Mock()
         fetch_server.url = URL_DUMMY
@@ -270,6 +450,122 @@ class TestGetFetchRecordings(unittest.TestCase):
         self.assertEqual(1, len(results))
         self.assertEqual(2, len(results[0]['items']))
 
+    def test_get_services(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        requested = []
+
+        def mock_get_count(p_url, timeout=0, stream=False, headers=None):
+            requested.append(p_url)
+            return mock_get(p_url)
+
+        with patch('requests.get', mock_get_count):
+            services = upnp.get_services(fetch_server)
+        # The ConnectionManager description isn't needed
+        self.assertEqual([URL_DUMMY, f'{URL_DUMMY}/web/cds.xml'], requested)
+        self.assertEqual('urn:schemas-upnp-org:service:ContentDirectory:1', services.service_type)
+        self.assertEqual(f'{URL_DUMMY}/web/cds_control', services.control_url)
+        self.assertEqual(f'{URL_DUMMY}/web/cds_event', services.event_url)
+        self.assertTrue(services.browse)
+        self.assertTrue(services.search)
+
+    def test_from_manifest(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        browse_flags = []
+
+        def mock_post_metadata(p_url, data, headers, timeout=0):
+            browse_flags.append(data[data.find('<BrowseFlag>') + len('<BrowseFlag>'):data.find('</BrowseFlag>')])
+            if data.find(upnp.BROWSE_METADATA) != -1:
+                # The item is found in its folder's response
+                data = data.replace(data[data.find('<ObjectID>'):data.find('</ObjectID>')], '<ObjectID>61')
+            return mock_post(p_url, data, headers)
+
+        options = fetchtv.Options([CMD_RECORDINGS, OPTION_JSON, f'{OPTION_FOLDER}="{SHOW_ONE}"',
+                                   f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}, {SHOW_ONE_EP_TWO}"'])
+        listed = json.loads(fetchtv.print_recordings(fetchtv.get_fetch_recordings(fetch_server, options)))
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest = os.path.join(temp_dir, 'manifest.json')
+            with open(manifest, 'w') as f:
+                json.dump(listed, f)
+            options = fetchtv.Options([CMD_RECORDINGS, f'--from-manifest={manifest}'])
+            with patch('requests.post', mock_post_metadata):
+                results = fetchtv.process_server(fetch_server, options)
+            # The listed URLs are used, nothing is browsed
+            self.assertEqual([], browse_flags)
+            self.assertEqual(SHOW_ONE, results[0]['title'])
+            self.assertEqual([item['url'] for item in listed[0]['items']],
+                             [item.url for item in results[0]['items']])
+
+            with open(manifest, 'w') as f:
+                f.write('903106335\n903106337\nmissing\n')
+            with patch('requests.post', mock_post_metadata), redirect_stdout(io.StringIO()):
+                results = fetchtv.process_server(fetch_server, options)
+            self.assertEqual([upnp.BROWSE_METADATA] * 3, browse_flags)
+            self.assertEqual(1, len(results))
+            self.assertEqual(SHOW_ONE, results[0]['title'])
+            self.assertEqual(['903106335', '903106337'], [item.id for item in results[0]['items']])
+
+
+@patch('requests.get', mock_get)
+@patch('requests.post', mock_post)
+class TestMultipleServers(unittest.TestCase):
+
+    def test_discover_listed_servers(self):
+        fetch_servers = fetchtv.discover_fetch_servers(['192.168.1.10', '192.168.1.11:8080'])
+        self.assertEqual(['http://192.168.1.10:49152/MediaServer.xml', 'http://192.168.1.11:8080/MediaServer.xml'],
+                         [fetch_server.url for fetch_server in fetch_servers])
+        self.assertEqual('uuid:898f9738-d930-4db4-a3cf-00000', fetch_servers[0].udn)
+
+    def test_get_recordings_tagged_by_server(self):
+        fetch_servers = fetchtv.discover_fetch_servers(['192.168.1.10', '192.168.1.11'])
+        options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_FOLDER}="{SHOW_ONE}"', OPTION_JSON])
+        results = fetchtv.process_servers(fetch_servers, options)
+        self.assertEqual(2, len(results))
+        self.assertEqual({'192.168.1.10:49152', '192.168.1.11:49152'}, {result['server'] for result in results})
+        output = json.loads(fetchtv.print_recordings(results))
+        self.assertEqual('192.168.1.10:49152', output[0]['server'])
+        self.assertEqual(134, len(output[0]['items']))
+
+    def test_saved_files_namespace(self):
+        item = Mock()
+        item.id = '903106335'
+        item.title = SHOW_ONE_EP_ONE
+        with tempfile.TemporaryDirectory() as temp_dir:
+            saved_files = fetchtv.SavedFiles.load(temp_dir, 'uuid:server-one')
+            saved_files.add_file(item)
+            self.assertTrue(fetchtv.SavedFiles.load(temp_dir, 'uuid:server-one').contains(item))
+            self.assertFalse(fetchtv.SavedFiles.load(temp_dir, 'uuid:server-two').contains(item))
+            self.assertFalse(fetchtv.SavedFiles.load(temp_dir).contains(item))
+
+    def test_legacy_only_for_single_server(self):
+        options = fetchtv.Options([CMD_RECORDINGS])
+        with patch('fetchtv_upnp.process_server', return_value=[]) as process_server:
+            fetchtv.process_servers([Mock()], options)
+            self.assertTrue(process_server.call_args[0][4])
+            fetchtv.process_servers([Mock(), Mock()], options)
+            self.assertEqual([False, False], [call[0][4] for call in process_server.call_args_list[1:]])
+
+    def test_saved_files_legacy(self):
+        item = Mock()
+        item.id = '903106335'
+        item.title = SHOW_ONE_EP_ONE
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Saved by earlier runs with --ip
+            fetchtv.SavedFiles.load(temp_dir).add_file(item)
+            # Could be from any of several servers, so none of them are seeded with it
+            self.assertFalse(fetchtv.SavedFiles.load(temp_dir, 'uuid:server-two').contains(item))
+            saved_files = fetchtv.SavedFiles.load(temp_dir, 'uuid:server-one', legacy=True)
+            self.assertTrue(saved_files.contains(item))
+            other = Mock()
+            other.id = '903106337'
+            other.title = SHOW_ONE_EP_TWO
+            saved_files.add_file(other)
+            saved_files = fetchtv.SavedFiles.load(temp_dir, 'uuid:server-one')
+            self.assertTrue(saved_files.contains(item))
+            self.assertTrue(saved_files.contains(other))
+            self.assertFalse(fetchtv.SavedFiles.load(temp_dir).contains(other))
+
 
 @patch('requests.get', mock_get)
 @patch('requests.post', mock_post)
@@ -299,6 +595,277 @@ class TestSaveRecordings(unittest.TestCase):
             os.remove(lock_file)
             os.rmdir(temp_dir + os.path.sep + show_folder)
 
+    def test_plan(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS,
+                                       f'{OPTION_FOLDER}="{SHOW_ONE}"',
+                                       f'{OPTION_SAVE}="{temp_dir}"',
+                                       '--workers=2',
+                                       '--plan'])
+            with redirect_stdout(io.StringIO()):
+                results = fetchtv.process_server(fetch_server, options)
+                self.assertEqual(134, len(results[0]['items']))
+                self.assertIsNone(results[0]['eta'])
+                # Nothing is saved
+                self.assertEqual([fetchtv.SAVE_FILE, fetchtv.THROUGHPUT_FILE], sorted(os.listdir(temp_dir)))
+
+                fetchtv.ThroughputHistory.load(temp_dir).add(1000000, 10)
+                results = fetchtv.process_server(fetch_server, options)
+            size = sum(item['size'] for item in results[0]['items'])
+            self.assertEqual(size, results[0]['size'])
+            self.assertEqual(100000, results[0]['rate'])
+            # Two workers take at least half as long as one
+            self.assertGreaterEqual(results[0]['eta'], size / 100000 / 2)
+            self.assertLess(results[0]['eta'], size / 100000)
+
+    def test_save_while_browsing(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        events = []
+        saving = threading.Event()
+
+        def mock_post_wait(p_url, data, headers, timeout=0):
+            object_id = data[data.find('<ObjectID>') + len('<ObjectID>'):data.find('</ObjectID>')]
+            if object_id == '93':
+                # The folder after 2 Broke Girls isn't browsed until its recording is being saved
+                saving.wait(timeout=5)
+            events.append(f'browse {object_id}')
+            return mock_post(p_url, data, headers)
+
+        def mock_save_item(item, *args):
+            events.append(f'save {item.id}')
+            saving.set()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"'])
+            with patch('requests.post', mock_post_wait), patch('fetchtv_upnp.save_item', mock_save_item), \
+                    redirect_stdout(io.StringIO()):
+                results = fetchtv.process_server(fetch_server, options)
+        self.assertEqual(134, len(results))
+        self.assertLess(events.index(f'save {results[0]["item"]["id"]}'), events.index('browse 93'))
+        self.assertIn('browse 268', events)
+
+    def test_interrupted(self):
+        items = [upnp.Item.from_values({'id': item_id, 'title': item_id, 'size': 5, 'duration': 60, 'description': '',
+                                        'url': f'http://192.168.1.147:49152/web/{item_id}'}) for item_id in ['1', '2']]
+
+        def recordings_interrupted(downloading):
+            yield {'title': SHOW_ONE, 'id': '61', 'items': items}
+            downloading.wait(timeout=5)
+            raise KeyboardInterrupt()
+
+        def recordings(downloading):
+            yield {'title': SHOW_ONE, 'id': '61', 'items': items}
+
+        # Interrupted while browsing, or once browsing is done and the queued saves are being waited for
+        for get_recordings, interrupt_wait in [(recordings_interrupted, False), (recordings, True)]:
+            with self.subTest(interrupt_wait=interrupt_wait):
+                requested = []
+                downloading = threading.Event()
+                executors = []
+
+                def mock_get_endless(p_url, timeout=0, stream=False, headers=None):
+                    requested.append(p_url)
+                    result = mock_get(p_url)
+                    result.__exit__ = Mock(return_value=False)
+
+                    def iter_content(chunk_size):
+                        while True:
+                            downloading.set()
+                            time.sleep(0.01)
+                            yield b'0'
+                    result.iter_content = iter_content
+                    return result
+
+                class InterruptedExecutor(ThreadPoolExecutor):
+                    def __init__(self, *args, **kwargs):
+                        super().__init__(*args, **kwargs)
+                        executors.append(self)
+
+                    def shutdown(self, wait=True, **kwargs):
+                        if wait and interrupt_wait and len(executors) == 1:
+                            executors.append(None)
+                            downloading.wait(timeout=5)
+                            raise KeyboardInterrupt()
+                        super().shutdown(wait, **kwargs)
+
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"', '--buffer=0'])
+                    try:
+                        with patch('requests.get', mock_get_endless), redirect_stdout(io.StringIO()), \
+                                patch('fetchtv_upnp.ThreadPoolExecutor', InterruptedExecutor):
+                            with self.assertRaises(KeyboardInterrupt):
+                                fetchtv.save_recordings(get_recordings(downloading), options)
+                            self.assertTrue(fetchtv.STOPPING.is_set())
+                            executors[0].shutdown(wait=True)
+                    finally:
+                        fetchtv.STOPPING.clear()
+                    # The download in progress was stopped, keeping its lock file, and the next one wasn't started
+                    self.assertEqual([items[0].url], requested)
+                    show_folder = temp_dir + os.path.sep + fetchtv.create_valid_filename(SHOW_ONE)
+                    self.assertEqual(['1.mpeg.lock'], os.listdir(show_folder))
+
+    def test_staging(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[b'01234'])
+            return result
+
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as staging_dir:
+            options = fetchtv.Options([CMD_RECORDINGS,
+                                       f'{OPTION_FOLDER}="{SHOW_ONE}"',
+                                       f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}"',
+                                       f'{OPTION_SAVE}="{temp_dir}"',
+                                       f'--staging="{staging_dir}"'])
+            recordings = fetchtv.get_fetch_recordings(fetch_server, options)
+            item = recordings[0]['items'][0]
+            file_path = fetchtv.get_file_path(temp_dir, recordings[0], item)
+            staged_path = fetchtv.get_file_path(staging_dir, recordings[0], item)
+
+            # Not recorded as saved when the move fails, the staged file is kept
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()), \
+                    patch('fetchtv_upnp.FileMover.move', Mock(side_effect=OSError('Share unavailable'))):
+                results = fetchtv.save_recordings(recordings, options)
+            self.assertFalse(results[0]['recorded'])
+            self.assertTrue(results[0]['error'].find('Share unavailable') != -1)
+            self.assertFalse(fetchtv.SavedFiles.load(temp_dir).contains(item))
+            self.assertEqual('01234', get_file(staged_path))
+
+            os.remove(staged_path)
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()):
+                results = fetchtv.save_recordings(recordings, options)
+            self.assertTrue(results[0]['recorded'])
+            self.assertEqual('01234', get_file(file_path))
+            self.assertFalse(os.path.exists(staged_path))
+            # The moved file, not the staged one
+            self.assertEqual(file_path, fetchtv.SavedFiles.load(temp_dir).get_path(item))
+
+    def test_move_across_file_systems(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            staged_path = os.path.join(temp_dir, 'staging', 'show.mpeg')
+            file_path = os.path.join(temp_dir, 'save', SHOW_ONE, 'show.mpeg')
+            os.makedirs(os.path.dirname(staged_path))
+            with open(staged_path, 'w') as f:
+                f.write('01234')
+            with patch('fetchtv_upnp.os.replace', Mock(side_effect=[OSError(fetchtv.errno.EXDEV, 'Cross-device'),
+                                                                    None])) as replace:
+                fetchtv.FileMover.move(staged_path, file_path)
+            # Copied to a lock file, which is renamed once complete
+            self.assertEqual('01234', get_file(file_path + fetchtv.CONST_LOCK))
+            replace.assert_called_with(file_path + fetchtv.CONST_LOCK, file_path)
+            self.assertFalse(os.path.exists(staged_path))
+
+    def test_overwrite_changed_skips_complete_files(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS,
+                                       f'{OPTION_FOLDER}="{SHOW_ONE}"',
+                                       f'{OPTION_TITLE}="{SHOW_ONE_EP_ONE}"',
+                                       f'{OPTION_OVERWRITE}=changed',
+                                       f'{OPTION_SAVE}="{temp_dir}"'])
+            results = fetchtv.get_fetch_recordings(fetch_server, options)
+            item = results[0]['items'][0]
+            show_folder = temp_dir + os.path.sep + fetchtv.create_valid_filename(results[0]['title'])
+            os.mkdir(show_folder)
+            with open(f'{show_folder}{os.path.sep}{fetchtv.create_valid_filename(item.title)}.mpeg', 'wb') as f:
+                f.truncate(item.size)
+            json_result = fetchtv.save_recordings(results, options)
+            self.assertTrue(json_result[0]['skipped'].startswith('Already saved and unchanged'))
+            self.assertFalse(json_result[0]['recorded'])
+
+
+class TestSavedFiles(unittest.TestCase):
+
+    def test_is_unchanged(self):
+        item = Mock()
+        item.id = '903106335'
+        item.title = SHOW_ONE_EP_ONE
+        item.size = 5
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            self.assertFalse(saved_files.is_unchanged(item, file_path))
+
+            # Size matches the server when there are no saved details
+            with open(file_path, 'wb') as f:
+                f.write(b'0123')
+            self.assertFalse(saved_files.is_unchanged(item, file_path))
+            with open(file_path, 'ab') as f:
+                f.write(b'4')
+            self.assertTrue(saved_files.is_unchanged(item, file_path))
+
+            # Saved details are used when available, the server can report a different size to the file
+            with open(file_path, 'ab') as f:
+                f.write(b'5')
+            saved_files.add_file(item, file_path)
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            self.assertTrue(saved_files.is_unchanged(item, file_path))
+            item.size = 6
+            self.assertFalse(saved_files.is_unchanged(item, file_path))
+
+
+class TestDuplicateIndex(unittest.TestCase):
+
+    @staticmethod
+    def get_item(item_id, title, duration=1800, size=1000):
+        item = Mock()
+        item.id = item_id
+        item.title = title
+        item.parent_name = SHOW_ONE
+        item.duration = duration
+        item.size = size
+        return item
+
+    def test_normalise_title(self):
+        self.assertEqual('s4 e2 and the dj face', fetchtv.normalise_title('S4 E2 - And the DJ Face - Wed 01 Jul'))
+        self.assertEqual('s4 e2 and the dj face', fetchtv.normalise_title('S4 E2: And The DJ Face - Sat 11 Jul'))
+
+    def test_find_duplicates(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            duplicates = fetchtv.DuplicateIndex.load(temp_dir)
+            first = self.get_item('1', 'S4 E2 - And the DJ Face - Wed 01 Jul')
+            self.assertIsNone(duplicates.find(first))
+            # Currently saving
+            repeat = self.get_item('2', 'S4 E2 - And the DJ Face - Sat 11 Jul', duration=1810, size=1010)
+            self.assertEqual('1', duplicates.find(repeat)['id'])
+
+            file_path = f'{temp_dir}{os.path.sep}first.mpeg'
+            with open(file_path, 'wb') as f:
+                f.write(b'01234')
+            duplicates.finish(first, file_path)
+            duplicates = fetchtv.DuplicateIndex.load(temp_dir)
+            self.assertEqual(file_path, duplicates.find(repeat)['file'])
+            # Different length recordings aren't duplicates
+            self.assertIsNone(duplicates.find(self.get_item('3', first.title, duration=3600)))
+            self.assertIsNone(duplicates.find(self.get_item('4', first.title, size=2000)))
+
+    def test_link_duplicate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, '--duplicates=link', f'{OPTION_SAVE}="{temp_dir}"'])
+            duplicates = fetchtv.DuplicateIndex.load(temp_dir)
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            first = self.get_item('1', 'S4 E2 - And the DJ Face - Wed 01 Jul')
+            repeat = self.get_item('2', 'S4 E2 - And the DJ Face - Sat 11 Jul')
+            first_path = f'{temp_dir}{os.path.sep}first.mpeg'
+            repeat_path = f'{temp_dir}{os.path.sep}repeat.mpeg'
+            self.assertFalse(fetchtv.save_duplicate(first, first_path, {}, saved_files, duplicates, options))
+            with open(first_path, 'wb') as f:
+                f.write(b'01234')
+            duplicates.finish(first, first_path)
+
+            result = {'recorded': False}
+            self.assertTrue(fetchtv.save_duplicate(repeat, repeat_path, result, saved_files, duplicates, options))
+            self.assertTrue(result['recorded'])
+            self.assertTrue(os.path.samefile(first_path, repeat_path))
+            self.assertTrue(saved_files.contains(repeat))
+
 
 @patch('requests.get', mock_get)
 class TestDownloadFile(unittest.TestCase):
@@ -359,6 +926,402 @@ class TestDownloadFile(unittest.TestCase):
         finally:
             os.remove(f'{temp_file}.lock')
 
+    def test_resume_after_dropped_connection(self):
+        requested_ranges = []
+
+        def mock_get_dropped(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            requested_ranges.append((headers or {}).get('Range'))
+
+            def iter_content(chunk_size):
+                if len(requested_ranges) == 1:
+                    yield b'012'
+                    raise requests.exceptions.ConnectionError('Connection dropped')
+                yield b'34'
+            result.__exit__ = Mock(return_value=False)
+            result.status_code = 206 if headers else 200
+            result.iter_content = iter_content
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            with patch('requests.get', mock_get_dropped), patch('time.sleep', Mock()):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}))
+            self.assertEqual([None, 'bytes=3-'], requested_ranges)
+            self.assertEqual('01234', get_file(temp_file))
+
+    def test_short_stream(self):
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            json_result = {}
+            with patch('requests.get', mock_get_short), redirect_stdout(io.StringIO()):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, json_result, buffer_size=0))
+            self.assertEqual('012', get_file(temp_file))
+            self.assertTrue(json_result['warning'].startswith('Handling known issue'))
+
+    def test_resume_preallocated(self):
+        requested_ranges = []
+
+        def mock_get_range(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            requested_ranges.append((headers or {}).get('Range'))
+            result.__exit__ = Mock(return_value=False)
+            result.status_code = 206
+            result.iter_content = Mock(return_value=[b'34'])
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            lock_file = temp_file + fetchtv.CONST_LOCK
+            # Left by a run that was killed with the lock file preallocated, and 3 bytes written
+            with open(lock_file, 'wb') as f:
+                f.write(b'012' + bytes(fetchtv.PREALLOCATE_MIN))
+            download.record_written(lock_file, 3)
+            self.assertEqual(3, download.get_written_size(lock_file))
+            with patch('requests.get', mock_get_range):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}, resume=True))
+            self.assertEqual(['bytes=3-'], requested_ranges)
+            self.assertEqual('01234', get_file(temp_file))
+            self.assertFalse(os.path.exists(lock_file + download.LOCK_WRITTEN))
+
+    def test_follow_recording(self):
+        requested_ranges = []
+        # Recording grows by a chunk per request, then completes
+        responses = [(200, {'content-length': fetchtv.MAX_OCTET}, [b'012']),
+                     (206, {'content-range': f'bytes 3-{fetchtv.MAX_OCTET - 1}/{fetchtv.MAX_OCTET}'}, [b'34']),
+                     (206, {'content-range': f'bytes 5-{fetchtv.MAX_OCTET - 1}/{fetchtv.MAX_OCTET}'}, []),
+                     (206, {'content-range': 'bytes 5-6/7', 'content-length': 2}, [b'56'])]
+
+        def mock_get_growing(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            requested_ranges.append((headers or {}).get('Range'))
+            result.status_code, result.headers, chunks = responses[len(requested_ranges) - 1]
+            result.headers.setdefault('content-length', fetchtv.MAX_OCTET)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=chunks)
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            json_result = {}
+            with patch('requests.get', mock_get_growing), patch('time.sleep', Mock()):
+                # Skipped unless following
+                self.assertFalse(fetchtv.download_file(mock_location, temp_file, json_result))
+                requested_ranges.clear()
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, json_result, follow=True))
+            self.assertEqual([None, 'bytes=3-', 'bytes=5-', 'bytes=5-'], requested_ranges)
+            self.assertEqual('0123456', get_file(temp_file))
+            self.assertTrue(json_result['followed'])
+
+    def test_save_following(self):
+        requested_ranges = []
+        # Recording grows by a chunk per request, then completes
+        responses = [(200, {'content-length': fetchtv.MAX_OCTET}, [b'012']),
+                     (206, {'content-range': 'bytes 3-4/5', 'content-length': 2}, [b'34'])]
+
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            if p_url.endswith('/live'):
+                requested_ranges.append((headers or {}).get('Range'))
+                result.status_code, result.headers, chunks = responses[len(requested_ranges) - 1]
+                result.headers.setdefault('content-length', fetchtv.MAX_OCTET)
+                result.iter_content = Mock(return_value=chunks)
+            else:
+                result.iter_content = Mock(return_value=[b'01234'])
+            return result
+
+        items = [upnp.Item.from_values({'id': item_id, 'title': item_id, 'size': size, 'duration': 60,
+                                        'description': '', 'url': f'http://192.168.1.147:49152/web/{item_id}'})
+                 for item_id, size in [('live', fetchtv.MAX_OCTET), ('saved', 5)]]
+        usage = Mock()
+        usage.free = fetchtv.MIN_FREE_SPACE + 1024 * 1024 * 1024
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"', '--follow', '--diskfull=defer'])
+            with patch('requests.get', mock_get_content), patch('time.sleep', Mock()), \
+                    patch('shutil.disk_usage', Mock(return_value=usage)), redirect_stdout(io.StringIO()):
+                results = fetchtv.save_recordings([{'title': SHOW_ONE, 'id': '61', 'items': items}], options)
+            # The recording in progress doesn't need its unknown size free, or defer the others
+            self.assertEqual([True, True], [result['recorded'] for result in results])
+            self.assertTrue(results[0]['followed'])
+            self.assertEqual('01234', get_file(fetchtv.get_file_path(temp_dir, {'title': SHOW_ONE}, items[0])))
+
+    def test_follow_stopped_growing(self):
+        def mock_get_stalled(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.headers = {'content-length': fetchtv.MAX_OCTET}
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[] if headers else [b'012'])
+            result.status_code = 206 if headers else 200
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            clock = itertools.count(0, 60)
+            with patch('requests.get', mock_get_stalled), patch('time.sleep', Mock()), \
+                    patch('time.monotonic', lambda: next(clock)), redirect_stdout(io.StringIO()):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}, buffer_size=0, follow=True))
+            self.assertEqual('012', get_file(temp_file))
+
+    def test_pause_at_window_close(self):
+        requested_ranges = []
+        windows = fetchtv.TransferWindows(['00:00-00:00'])
+
+        def mock_get_paused(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            requested_ranges.append((headers or {}).get('Range'))
+
+            def iter_content(chunk_size):
+                if len(requested_ranges) == 1:
+                    yield b'012'
+                    # Window closes while downloading
+                    windows.closed = True
+                    yield b'34'
+                    raise AssertionError('Not paused')
+                yield b'34'
+            result.__exit__ = Mock(return_value=False)
+            result.status_code = 206 if headers else 200
+            result.iter_content = iter_content
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            with patch('requests.get', mock_get_paused):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}, windows=windows))
+            self.assertEqual([None, 'bytes=5-'], requested_ranges)
+            # Continued from where it was paused
+            self.assertEqual('0123434', get_file(temp_file))
+
+    def test_transcode(self):
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[b'abc', b'def'])
+            return result
+
+        item = upnp.Item.from_values({'id': '903106335', 'title': SHOW_ONE_EP_ONE, 'size': 6,
+                                      'url': 'http://192.168.1.147:49152/web/903106335'})
+        script = "import sys; open(sys.argv[1], 'wb').write(sys.stdin.buffer.read().upper())"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"',
+                                       f'--transcode={sys.executable} -c "{script}" {{file}}'])
+            file_path = fetchtv.get_file_path(temp_dir, {'title': SHOW_ONE}, item, fetchtv.get_extension(options))
+            self.assertTrue(file_path.endswith('.mp4'))
+            os.makedirs(os.path.dirname(file_path))
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            result = {'recorded': False}
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()):
+                fetchtv.save_item(item, file_path, result, saved_files, options)
+            self.assertTrue(result['recorded'])
+            self.assertEqual(0, result['transcode']['returncode'])
+            self.assertEqual(6, result['transcode']['bytes'])
+            self.assertEqual('ABCDEF', get_file(file_path))
+            self.assertEqual(file_path, saved_files.get_path(item))
+            self.assertFalse(os.path.exists(file_path + fetchtv.CONST_LOCK + fetchtv.LOCK_OWNER))
+            transcoded = os.path.basename(file_path)
+
+            script = "import sys; sys.stdin.buffer.read(1); sys.stderr.write('bad input'); sys.exit(2)"
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"', '--extension=mkv',
+                                       f'--transcode={sys.executable} -c "{script}" {{file}}'])
+            file_path = fetchtv.get_file_path(temp_dir, {'title': SHOW_ONE}, item, fetchtv.get_extension(options))
+            result = {'recorded': False}
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()):
+                fetchtv.save_item(item, file_path, result, saved_files, options)
+            self.assertFalse(result['recorded'])
+            self.assertEqual(2, result['transcode']['returncode'])
+            self.assertEqual('bad input', result['transcode']['error'])
+            # The partial output is removed
+            self.assertEqual([transcoded], os.listdir(os.path.dirname(file_path)))
+
+    def test_transcode_paused(self):
+        windows = Mock()
+        windows.closed = False
+        windows.wait = Mock(side_effect=lambda lock_file: setattr(windows, 'closed', False))
+        requests_made = []
+
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            requests_made.append(p_url)
+
+            def iter_content(chunk_size):
+                yield b'abc'
+                if len(requests_made) == 1:
+                    # Window closes part way through
+                    windows.closed = True
+                yield b'def'
+            result.iter_content = iter_content
+            return result
+
+        item = upnp.Item.from_values({'id': '903106335', 'title': SHOW_ONE_EP_ONE, 'size': 6,
+                                      'url': 'http://192.168.1.147:49152/web/903106335'})
+        script = "import sys; open(sys.argv[1], 'wb').write(sys.stdin.buffer.read().upper())"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mp4'
+            result = {}
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()):
+                self.assertTrue(fetchtv.transcode_file(item, file_path, result,
+                                                       f'{sys.executable} -c "{script}" {{file}}', windows))
+            # Restarted from the beginning once the window opened again
+            self.assertEqual(2, len(requests_made))
+            self.assertEqual(2, windows.wait.call_count)
+            self.assertEqual('ABCDEF', get_file(file_path))
+
+    def test_retries_exhausted(self):
+        def mock_get_error(p_url, timeout=0, stream=False, headers=None):
+            raise requests.exceptions.ConnectionError('Connection refused')
+
+        mock_location = Mock()
+        mock_location.url = 'http://retries_exhausted'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_result = {}
+            with patch('requests.get', mock_get_error), patch('time.sleep', Mock()) as sleep:
+                self.assertFalse(fetchtv.download_file(mock_location, f'{temp_dir}{os.path.sep}test.txt', json_result))
+            self.assertEqual(upnp.RETRY_ATTEMPTS, sleep.call_count)
+            self.assertTrue(json_result['error'].find('Connection refused') != -1)
+
+    def test_download_waits_for_circuit(self):
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[b'01234'])
+            return result
+
+        mock_location = Mock()
+        mock_location.url = 'http://circuit_open/web/1'
+        breaker = upnp.get_circuit_breaker(mock_location.url)
+        for _ in range(upnp.CIRCUIT_THRESHOLD):
+            breaker.failure()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_result = {}
+            # Not failed while the server recovers
+            with patch('requests.get', mock_get_content), patch('time.sleep', Mock()) as sleep:
+                self.assertTrue(fetchtv.download_file(mock_location, f'{temp_dir}{os.path.sep}test.txt', json_result))
+            sleep.assert_called_once()
+            self.assertNotIn('error', json_result)
+
+    def test_segmented_download(self):
+        content = bytes(range(256)) * 40
+        requested_ranges = []
+
+        def mock_get_range(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            requested_ranges.append(headers['Range'])
+            start, end = [int(pos) for pos in headers['Range'][len('bytes='):].split('-')]
+            result.status_code = 206
+            result.headers = {'content-range': f'bytes {start}-{end}/{len(content)}'}
+            result.iter_content = Mock(return_value=[content[start:end + 1]])
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            with patch('requests.get', mock_get_range):
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}, segments=4))
+            self.assertEqual('bytes=0-0', requested_ranges[0])
+            self.assertEqual({'bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679', 'bytes=7680-10239'},
+                             set(requested_ranges[1:]))
+            with open(temp_file, 'rb') as f:
+                self.assertEqual(content, f.read())
+            self.assertFalse(os.path.exists(temp_file + fetchtv.CONST_LOCK))
+
+    def test_segmented_download_interrupted(self):
+        content = bytes(range(256)) * 40
+        requested_ranges = []
+
+        def mock_get_range(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            requested_ranges.append((headers or {}).get('Range'))
+            if not headers:
+                result.headers = {'content-length': len(content)}
+                result.iter_content = Mock(return_value=[content])
+                return result
+            start, end = [int(pos) for pos in headers['Range'][len('bytes='):].split('-')]
+            result.status_code = 206
+            result.headers = {'content-range': f'bytes {start}-{end}/{len(content)}'}
+
+            def iter_content(chunk_size):
+                if start == 7680:
+                    # Interrupted once the last range has been written, leaving the others as holes
+                    yield content[start:end + 1]
+                    fetchtv.STOPPING.set()
+                    yield b''
+                else:
+                    time.sleep(0.1)
+                    yield b''
+            result.iter_content = iter_content
+            return result
+
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_file = f'{temp_dir}{os.path.sep}test.txt'
+            # e.g. on Windows or a network share
+            with patch('requests.get', mock_get_range), patch('fetchtv_upnp.preallocate', Mock(return_value=False)):
+                try:
+                    with self.assertRaises(fetchtv.TransferStopped):
+                        fetchtv.download_file(mock_location, temp_file, {}, segments=4)
+                finally:
+                    fetchtv.STOPPING.clear()
+                self.assertEqual(len(content), os.path.getsize(temp_file + fetchtv.CONST_LOCK))
+                self.assertEqual(0, download.get_written_size(temp_file + fetchtv.CONST_LOCK))
+
+                # The next run starts again, rather than continuing after the holes
+                requested_ranges.clear()
+                self.assertTrue(fetchtv.download_file(mock_location, temp_file, {}, resume=True, segments=4))
+            self.assertEqual([None], requested_ranges)
+            with open(temp_file, 'rb') as f:
+                self.assertEqual(content, f.read())
+
+    def test_segmented_download_fallback(self):
+        # Server ignores the range request
+        mock_file = mock_open(read_data='xxx')
+        mock_location = Mock()
+        mock_location.url = URL_DUMMY
+        with patch('fetchtv_upnp.open', mock_file):
+            with patch('fetchtv_upnp.os.rename', Mock()):
+                self.assertTrue(fetchtv.download_file(mock_location, 'test.txt', {}, segments=4))
+        mock_file.assert_called_once_with('test.txt' + fetchtv.CONST_LOCK, 'xb')
+
+    def test_buffered_write(self):
+        chunks = [bytes([i]) * fetchtv.CHUNK_SIZE for i in range(64)]
+        output = io.BytesIO()
+        writer = fetchtv.BufferedWriter(output, fetchtv.CHUNK_SIZE * 2)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        self.assertEqual(b''.join(chunks), output.getvalue())
+        self.assertEqual(len(output.getvalue()), writer.bytes_written)
+        stats = writer.get_stats()
+        # Never holds more than the buffer, plus the chunk being written and the one being queued
+        self.assertLessEqual(stats['peak'], fetchtv.CHUNK_SIZE * 4)
+        self.assertEqual({'buffer', 'peak', 'read_wait', 'write_wait'}, set(stats.keys()))
+
+    def test_buffered_write_error(self):
+        output = Mock()
+        output.write = Mock(side_effect=OSError('Disk error'))
+        writer = fetchtv.BufferedWriter(output, fetchtv.CHUNK_SIZE)
+        writer.write(b'x')
+        writer.close()
+        self.assertIsInstance(writer.error, OSError)
+        with self.assertRaises(OSError):
+            writer.write(b'x')
+
     def test_io_error(self):
         temp_dir = tempfile.gettempdir()
         temp_file = f'{temp_dir}{os.path.sep}test.txt'
@@ -373,6 +1336,662 @@ class TestDownloadFile(unittest.TestCase):
                 self.assertTrue(json_result['error'].find('An IO error') != -1)
 
 
+class TestFetchClient(unittest.TestCase):
+
+    @staticmethod
+    def get_session():
+        session = Mock()
+        session.get = Mock(side_effect=mock_get)
+        session.post = Mock(side_effect=mock_post)
+        return session
+
+    def test_discover_and_browse(self):
+        session = self.get_session()
+        with FetchClient.discover('192.168.1.10', session=session) as client:
+            self.assertEqual('192.168.1.10:49152', client.name)
+            folders = list(client.iter_folders())
+            self.assertEqual(8, len(folders))
+            self.assertEqual(134, len(folders[4].items))
+            self.assertIsInstance(folders[4].items[0], upnp.Item)
+
+            # Services and the Recordings folder are only looked up once
+            service_requests = session.get.call_count
+            browse_requests = session.post.call_count
+            list(client.iter_folders(with_items=False))
+            self.assertEqual(service_requests, session.get.call_count)
+            self.assertEqual(browse_requests + 1, session.post.call_count)
+        session.close.assert_called_once()
+
+    def test_iter_items(self):
+        session = self.get_session()
+        client = FetchClient(upnp.parse_locations([URL_DUMMY], session)[0], session)
+        items = list(client.iter_items(folder=[SHOW_ONE], title=[SHOW_ONE_EP_ONE]))
+        self.assertEqual(1, len(items))
+        self.assertTrue(items[0].title.startswith(SHOW_ONE_EP_ONE))
+        self.assertEqual(7, len(list(client.iter_recordings(exclude=[SHOW_ONE], browse_filter=upnp.FILTER_TITLES))))
+
+        # Only the matching folder's items are browsed
+        session.post.reset_mock()
+        list(client.iter_items(folder=[SHOW_ONE]))
+        self.assertEqual(2, session.post.call_count)
+
+    def test_download(self):
+        session = self.get_session()
+
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.headers = {'content-length': 20000}
+            result.iter_content = Mock(return_value=[b'x' * 10000, b'y' * 10000])
+            return result
+        session.get = Mock(side_effect=mock_get_content)
+
+        item = Mock()
+        item.url = 'http://192.168.1.147:49152/web/903106335'
+        progress = []
+        client = FetchClient(Mock(), session)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+            self.assertTrue(client.download(item, file_path, lambda *args: progress.append(args[1:])))
+            self.assertEqual(20000, os.path.getsize(file_path))
+        self.assertEqual([(10000, 20000), (20000, 20000), (20000, 20000)], progress)
+
+    def test_download_resume(self):
+        requested_ranges = []
+
+        def mock_get_range(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            requested_ranges.append((headers or {}).get('Range'))
+            result.__exit__ = Mock(return_value=False)
+            if len(requested_ranges) == 1:
+                # Lock file is bigger than the recording
+                result.status_code = 416
+            else:
+                result.iter_content = Mock(return_value=[b'01234'])
+            return result
+        session = self.get_session()
+        session.get = Mock(side_effect=mock_get_range)
+
+        item = Mock()
+        item.url = 'http://192.168.1.147:49152/web/903106335'
+        client = FetchClient(Mock(), session)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+            # Preallocated by a run that was killed, with 3 bytes written
+            with open(file_path + fetchtv.CONST_LOCK, 'wb') as f:
+                f.write(b'abc' + bytes(100))
+            download.record_written(file_path + fetchtv.CONST_LOCK, 3)
+            self.assertTrue(client.download(item, file_path))
+            # Not taken as complete, the whole recording is downloaded again
+            self.assertEqual(['bytes=3-', None], requested_ranges)
+            self.assertEqual('01234', get_file(file_path))
+
+    def test_download_short_stream(self):
+        session = self.get_session()
+        session.get = Mock(side_effect=mock_get_short)
+        item = Mock()
+        item.url = 'http://192.168.1.147:49152/web/903106335'
+        client = FetchClient(Mock(), session)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+            with patch('time.sleep', Mock()):
+                self.assertTrue(client.download(item, file_path))
+            self.assertEqual('012', get_file(file_path))
+        self.assertEqual(1, session.get.call_count)
+
+    def test_is_recording(self):
+        def mock_get_live(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.headers = {'content-length': 100, 'content-range': 'bytes 0-99/*'}
+            return result
+        session = self.get_session()
+        client = FetchClient(Mock(), session)
+        item = Mock()
+        item.url = 'http://192.168.1.147:49152/web/903106335'
+        self.assertFalse(client.is_recording(item))
+        session.get = Mock(side_effect=mock_get_live)
+        self.assertTrue(client.is_recording(item))
+
+
+class TestProxy(unittest.TestCase):
+    CONTENT = bytes(range(256)) * 100
+
+    def get_client(self):
+        def mock_get_range(p_url, timeout=0, stream=False, headers=None):
+            result = Mock()
+            start, end = [int(pos) for pos in headers['Range'][len('bytes='):].split('-')]
+            result.status_code = 206
+            result.content = self.CONTENT[start:end + 1]
+            return result
+
+        item = upnp.Item.from_values({'id': '903106335', 'title': SHOW_ONE_EP_ONE, 'parent_name': SHOW_ONE,
+                                      'url': 'http://192.168.1.147:49152/web/903106335',
+                                      'size': len(self.CONTENT), 'duration': 1800})
+        folder = upnp.Folder.from_values({'id': '61', 'parent_id': '1', 'title': SHOW_ONE})
+        folder.add_items([item])
+        client = Mock()
+        client.iter_folders = Mock(side_effect=lambda: [folder])
+        client.session.get = Mock(side_effect=mock_get_range)
+        return client
+
+    def test_parse_range(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertEqual((10, 99), parse_range('bytes=10-', 100))
+        self.assertEqual((10, 20), parse_range('bytes=10-20', 100))
+        self.assertEqual((90, 99), parse_range('bytes=-10', 100))
+        self.assertEqual((90, 99), parse_range('bytes=90-200', 100))
+        with self.assertRaises(ValueError):
+            parse_range('bytes=100-', 100)
+        with self.assertRaises(ValueError):
+            parse_range('bytes=1-2,5-6', 100)
+
+    def test_range_requests_are_cached(self):
+        client = self.get_client()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = SegmentCache(temp_dir, len(self.CONTENT), block_size=1000)
+            server = create_server(RecordingProxy(client, cache), host='127.0.0.1')
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                url = f'http://127.0.0.1:{server.server_port}/recordings/903106335.mpeg'
+                request = urllib.request.Request(url, headers={'Range': 'bytes=1500-2499'})
+                with urllib.request.urlopen(request) as response:
+                    self.assertEqual(206, response.status)
+                    self.assertEqual(f'bytes 1500-2499/{len(self.CONTENT)}', response.headers['Content-Range'])
+                    self.assertEqual(self.CONTENT[1500:2500], response.read())
+                # Blocks 1 and 2
+                self.assertEqual(2, client.session.get.call_count)
+
+                # Played again, from the cache
+                with urllib.request.urlopen(url) as response:
+                    self.assertEqual(200, response.status)
+                    self.assertEqual(self.CONTENT, response.read())
+                self.assertEqual(26, client.session.get.call_count)
+                with urllib.request.urlopen(url) as response:
+                    self.assertEqual(self.CONTENT, response.read())
+                self.assertEqual(26, client.session.get.call_count)
+
+                with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/recordings') as response:
+                    self.assertEqual(['/recordings/903106335.mpeg'],
+                                     [recording['path'] for recording in json.loads(response.read())])
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/recordings/1.mpeg')
+                self.assertEqual(404, context.exception.code)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = SegmentCache(temp_dir, 250, block_size=100)
+            for index in range(3):
+                cache.put('item', index, b'x' * 100)
+                os.utime(cache.get_block_path('item', index), (index, index))
+            self.assertEqual(200, cache.size)
+            # Least recently used is removed
+            self.assertIsNone(cache.get('item', 0))
+            self.assertIsNotNone(cache.get('item', 2))
+            self.assertEqual(200, SegmentCache(temp_dir, 250, block_size=100).size)
+
+
+@patch('requests.get', mock_get)
+@patch('requests.post', mock_post)
+class TestCatalogue(unittest.TestCase):
+
+    def test_refresh_and_list_offline(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        with tempfile.TemporaryDirectory() as temp_dir:
+            catalogue = f'{temp_dir}{os.path.sep}catalogue.db'
+            options = fetchtv.Options([CMD_RECORDINGS, f'--catalogue={catalogue}'])
+            self.assertFalse(fetchtv.has_catalogue(options))
+            results = fetchtv.process_server(fetch_server, options)
+            self.assertEqual(8, len(results))
+            self.assertTrue(fetchtv.has_catalogue(options))
+
+            # Listed from the catalogue without contacting the server
+            with patch('requests.post', Mock(side_effect=AssertionError('Server browsed'))):
+                options = fetchtv.Options([CMD_RECORDINGS, f'--catalogue={catalogue}', f'{OPTION_FOLDER}="{SHOW_ONE}"'])
+                results = fetchtv.get_catalogue_recordings(options)
+                self.assertEqual(1, len(results))
+                self.assertEqual(134, len(results[0]['items']))
+                item = results[0]['items'][0]
+                self.assertEqual('http://192.168.1.147:49152/web/903106335', item.url)
+                self.assertEqual(930528256, item.size)
+                self.assertEqual(1788, item.duration)
+
+                options = fetchtv.Options([CMD_RECORDINGS, f'--catalogue={catalogue}', '--search="dj face"'])
+                results = fetchtv.get_catalogue_recordings(options)
+                self.assertEqual(1, len(results))
+                self.assertEqual(['S4 E2 - And the DJ Face - Wed 01 Jul'], [item.title for item in results[0]['items']])
+
+    def test_refresh_servers_at_once(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = f'{temp_dir}{os.path.sep}catalogue.db'
+            first = Catalogue(path)
+            first.refresh('one', [])
+
+            def browse():
+                # Another server is refreshed while this one is browsed, without waiting
+                with patch('helpers.catalogue.CATALOGUE_TIMEOUT', 0):
+                    second = Catalogue(path)
+                    try:
+                        second.refresh('two', [upnp.Folder.from_values({'id': '2', 'parent_id': '1',
+                                                                        'title': SHOW_TWO})])
+                    finally:
+                        second.close()
+                yield upnp.Folder.from_values({'id': '1', 'parent_id': '0', 'title': SHOW_ONE})
+
+            first.refresh('one', browse())
+            self.assertEqual(['one', 'two'], first.get_servers())
+            first.close()
+
+
+class TestRetry(unittest.TestCase):
+
+    def test_retry_delays(self):
+        delays = list(upnp.RetryPolicy(attempts=4, backoff=1, max_backoff=3).delays())
+        self.assertEqual(4, len(delays))
+        for delay, maximum in zip(delays, [1, 2, 3, 3]):
+            self.assertTrue(maximum / 2 <= delay <= maximum)
+
+    def test_request_with_retry(self):
+        response = Mock()
+        response.status_code = 200
+        request = Mock(side_effect=[requests.exceptions.Timeout('Timed out'), response])
+        with patch('time.sleep', Mock()):
+            self.assertEqual(response, upnp.request_with_retry('http://retry_once', request))
+        self.assertEqual(2, request.call_count)
+
+    def test_circuit_breaker(self):
+        request = Mock(side_effect=requests.exceptions.ConnectionError('Connection refused'))
+        with patch('time.sleep', Mock()) as sleep:
+            self.assertRaises(upnp.UpnpError, upnp.request_with_retry, 'http://not_responding', request)
+            self.assertFalse([delay for delay in sleep.call_args_list if delay[0][0] > upnp.RETRY_MAX_BACKOFF])
+
+            # Circuit opens after 5 consecutive failures, the next request waits for the server to recover
+            response = Mock()
+            response.status_code = 200
+            request.side_effect = [requests.exceptions.ConnectionError('Connection refused'), response]
+            self.assertEqual(response, upnp.request_with_retry('http://not_responding', request))
+        self.assertEqual(upnp.CIRCUIT_THRESHOLD + 1, request.call_count)
+        self.assertTrue(upnp.CIRCUIT_RESET / 2 < sleep.call_args_list[-1][0][0] <= upnp.CIRCUIT_RESET)
+        self.assertIsNone(upnp.get_circuit_breaker('http://not_responding').opened_at)
+
+
+class TestSpacePlanner(unittest.TestCase):
+
+    @staticmethod
+    def mock_disk_usage(free):
+        usage = Mock()
+        usage.free = fetchtv.MIN_FREE_SPACE + free
+        return Mock(return_value=usage)
+
+    def test_skip_items_that_dont_fit(self):
+        planner = fetchtv.SpacePlanner(fetchtv.DISK_FULL_SKIP)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch('shutil.disk_usage', self.mock_disk_usage(100)):
+                self.assertTrue(planner.reserve(temp_dir, 60))
+                self.assertFalse(planner.reserve(temp_dir, 60))
+                self.assertTrue(planner.reserve(temp_dir, 40))
+                self.assertFalse(planner.deferred)
+
+    def test_defer_remaining_items(self):
+        planner = fetchtv.SpacePlanner(fetchtv.DISK_FULL_DEFER)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with patch('shutil.disk_usage', self.mock_disk_usage(100)):
+                self.assertTrue(planner.reserve(temp_dir, 60))
+                self.assertFalse(planner.reserve(temp_dir, 60))
+                self.assertFalse(planner.reserve(temp_dir, 40))
+                self.assertTrue(planner.deferred)
+
+    def test_reserve_staging(self):
+        planner = fetchtv.SpacePlanner(fetchtv.DISK_FULL_SKIP)
+        item = Mock()
+        item.title = SHOW_ONE_EP_ONE
+        item.size = 60
+        with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as staging_dir:
+            mover = fetchtv.FileMover(staging_dir, temp_dir, planner)
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+            stat = os.stat
+
+            def mock_stat(path, *args, **kwargs):
+                # The staging directory is on another volume
+                values = list(stat(path, *args, **kwargs))
+                values[2] = 2 if str(path).startswith(staging_dir) else 1
+                return os.stat_result(values)
+
+            def mock_disk_usage(path):
+                return self.mock_disk_usage(100 if path.startswith(staging_dir) else 150)()
+
+            with patch('os.stat', mock_stat), patch('shutil.disk_usage', mock_disk_usage), \
+                    redirect_stdout(io.StringIO()):
+                self.assertTrue(fetchtv.reserve_space(planner, item, file_path, {}, mover))
+                # The staging volume is full until the first recording has been moved
+                self.assertFalse(fetchtv.reserve_space(planner, item, file_path + '2', {}, mover))
+                mover.release(file_path)
+                self.assertTrue(fetchtv.reserve_space(planner, item, file_path + '2', {}, mover))
+                # The save volume is full, so nothing is reserved on the staging volume
+                mover.release(file_path + '2')
+                self.assertFalse(fetchtv.reserve_space(planner, item, file_path + '3', {}, mover))
+                self.assertTrue(planner.reserve(staging_dir, 100))
+
+    def test_release_unsaved(self):
+        item = Mock()
+        item.title = SHOW_ONE_EP_ONE
+        item.size = 60
+        saved_files = Mock()
+        options = fetchtv.Options([CMD_RECORDINGS])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = f'{temp_dir}{os.path.sep}test.mpeg'
+
+            def reserve_and_save(planner, download=None, mover=None):
+                self.assertTrue(fetchtv.reserve_space(planner, item, file_path, {}, mover))
+                with patch('fetchtv_upnp.download_file', download or Mock(return_value=False)):
+                    fetchtv.save_item(item, file_path, {}, saved_files, options, mover=mover, planner=planner)
+
+            with patch('shutil.disk_usage', self.mock_disk_usage(100)), redirect_stdout(io.StringIO()):
+                # Skipped while another run is writing it
+                planner = fetchtv.SpacePlanner()
+                fetchtv.claim_lock(file_path + fetchtv.CONST_LOCK)
+                reserve_and_save(planner)
+                fetchtv.release_lock(file_path + fetchtv.CONST_LOCK)
+                self.assertTrue(planner.reserve(temp_dir, 100))
+
+                # The download failed
+                planner = fetchtv.SpacePlanner()
+                reserve_and_save(planner)
+                self.assertTrue(planner.reserve(temp_dir, 100))
+
+                # Stopped
+                planner = fetchtv.SpacePlanner()
+                with self.assertRaises(fetchtv.TransferStopped):
+                    reserve_and_save(planner, Mock(side_effect=fetchtv.TransferStopped()))
+                self.assertTrue(planner.reserve(temp_dir, 100))
+
+                # Saved, so the space is in use
+                planner = fetchtv.SpacePlanner()
+                with patch('os.path.getsize', Mock(return_value=60)):
+                    reserve_and_save(planner, Mock(return_value=True))
+                self.assertFalse(planner.reserve(temp_dir, 100))
+
+                # Saved to the staging directory, but not moved
+                with tempfile.TemporaryDirectory() as staging_dir:
+                    planner = fetchtv.SpacePlanner()
+                    mover = fetchtv.FileMover(staging_dir, temp_dir, planner)
+                    with patch('os.path.getsize', Mock(return_value=60)), \
+                            patch.object(fetchtv.FileMover, 'move', Mock(side_effect=OSError('failed'))):
+                        reserve_and_save(planner, Mock(return_value=True), mover)
+                        mover.shutdown()
+                    self.assertTrue(planner.reserve(temp_dir, 100))
+
+    @unittest.skipUnless(hasattr(os, 'posix_fallocate'), 'Preallocation not supported')
+    def test_preallocate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(f'{temp_dir}{os.path.sep}test.txt', 'wb') as f:
+                self.assertTrue(fetchtv.preallocate(f, fetchtv.PREALLOCATE_MIN))
+                self.assertEqual(fetchtv.PREALLOCATE_MIN, os.fstat(f.fileno()).st_size)
+                self.assertEqual(0, download.get_written_size(f.name))
+                # The bytes written are recorded, as the file size no longer shows them
+                out = fetchtv.CheckpointedFile(f, f.name, interval=4)
+                out.write(b'012')
+                self.assertEqual(0, download.get_written_size(f.name))
+                out.write(b'34')
+                self.assertEqual(5, download.get_written_size(f.name))
+                f.truncate(f.tell())
+                self.assertEqual(5, os.fstat(f.fileno()).st_size)
+
+
+class TestConcurrencyController(unittest.TestCase):
+
+    def test_additive_increase(self):
+        controller = upnp.ConcurrencyController('Browse', maximum=3)
+        for _ in range(upnp.ADAPTIVE_WINDOW * 3):
+            controller.acquire()
+            controller.release(0.1)
+        self.assertEqual(3, controller.limit)
+        self.assertEqual([(1, 2), (2, 3)], [decision[:2] for decision in controller.decisions])
+
+    def test_multiplicative_decrease(self):
+        messages = []
+        controller = upnp.ConcurrencyController('Browse', initial=8, maximum=8, log=messages.append)
+        for _ in range(8):
+            controller.acquire()
+            controller.release(0.1)
+        self.assertEqual(8, controller.limit)
+        # Latency has grown, e.g. the server is overloaded
+        for _ in range(8):
+            controller.acquire()
+            controller.release(1.0)
+        self.assertEqual(4, controller.limit)
+        # Errors halve the limit again
+        for _ in range(3):
+            controller.acquire()
+            controller.release(0.1)
+        controller.acquire()
+        controller.release(0.1, success=False)
+        self.assertEqual(2, controller.limit)
+        self.assertEqual(2, len(messages))
+        self.assertTrue(messages[0].startswith('Browse concurrency 8 -> 4'))
+
+    def test_call_limits_concurrency(self):
+        controller = upnp.ConcurrencyController('Browse', initial=2, maximum=2)
+        in_flight = []
+
+        def request(value):
+            in_flight.append(controller.in_flight)
+            time.sleep(0.01)
+            return value
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda value: controller.call(request, value), range(8)))
+        self.assertEqual(list(range(8)), results)
+        self.assertLessEqual(max(in_flight), 2)
+
+    def test_adaptive_browse(self):
+        fetch_server = Mock()
+        fetch_server.url = URL_DUMMY
+        with patch('requests.get', mock_get), patch('requests.post', mock_post), redirect_stdout(io.StringIO()):
+            results = fetchtv.get_fetch_recordings(fetch_server, fetchtv.Options([CMD_RECORDINGS, '--adaptive']))
+        self.assertEqual(8, len(results))
+        self.assertEqual(134, len(results[4]['items']))
+
+
+class TestTransferWindows(unittest.TestCase):
+
+    def test_windows(self):
+        windows = fetchtv.TransferWindows(['01:00-06:00', '23:30-00:30'])
+        self.assertEqual((3600, 21600), windows.windows[0])
+        self.assertEqual(0, windows.get_wait(datetime(2024, 1, 1, 2, 0)))
+        self.assertEqual(4 * 3600, windows.get_remaining(datetime(2024, 1, 1, 2, 0)))
+        self.assertEqual(0, windows.get_remaining(datetime(2024, 1, 1, 6, 0)))
+        self.assertEqual(17.5 * 3600, windows.get_wait(datetime(2024, 1, 1, 6, 0)))
+        # Runs past midnight
+        self.assertEqual(0, windows.get_wait(datetime(2024, 1, 1, 0, 15)))
+        self.assertEqual(15 * 60, windows.get_remaining(datetime(2024, 1, 1, 0, 15)))
+        self.assertEqual(30 * 60, windows.get_wait(datetime(2024, 1, 1, 0, 30)))
+        with self.assertRaises(ValueError):
+            fetchtv.TransferWindows(['1am-6am'])
+
+    def test_paused_lock_stays_active(self):
+        windows = fetchtv.TransferWindows(['01:00-06:00'])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lock_file = f'{temp_dir}{os.path.sep}test.mpeg{fetchtv.CONST_LOCK}'
+            open(lock_file, 'w').close()
+            old = time.time() - fetchtv.STALE_LOCK * 2
+            os.utime(lock_file, (old, old))
+            # Not owned, so only its age is checked
+            self.assertFalse(fetchtv.is_lock_active(lock_file))
+
+            # Touched while waiting for the window to open
+            with patch.object(windows, 'get_wait', Mock(side_effect=[60, 0])), patch('time.sleep', Mock()), \
+                    patch.object(windows, 'get_remaining', Mock(return_value=60)), redirect_stdout(io.StringIO()):
+                windows.wait(lock_file)
+            self.assertTrue(fetchtv.is_lock_active(lock_file))
+
+            # Owned by a process on this host, whatever its age
+            os.utime(lock_file, (old, old))
+            fetchtv.claim_lock(lock_file)
+            self.assertTrue(fetchtv.is_lock_active(lock_file))
+            process = subprocess.Popen([sys.executable, '-c', 'pass'])
+            process.wait()
+            with open(lock_file + fetchtv.LOCK_OWNER, 'w') as f:
+                json.dump({'pid': process.pid, 'host': socket.gethostname()}, f)
+            self.assertFalse(fetchtv.is_lock_active(lock_file))
+            # The command writing the lock file for it is still running, e.g. a transcode finishing
+            with open(lock_file + fetchtv.LOCK_OWNER, 'w') as f:
+                json.dump({'pid': process.pid, 'host': socket.gethostname(), 'command_pid': os.getpid()}, f)
+            self.assertTrue(fetchtv.is_lock_active(lock_file))
+            fetchtv.release_lock(lock_file)
+            self.assertFalse(os.path.exists(lock_file + fetchtv.LOCK_OWNER))
+
+
+    def test_paused_time_not_measured(self):
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[b'01234'])
+            return result
+
+        clock = [0]
+
+        def wait(lock_file):
+            if windows.wait.call_count == 2:
+                # Paused overnight once the download has started
+                clock[0] += 8 * 3600
+                return 8 * 3600
+            return 0
+        windows = Mock()
+        windows.closed = False
+        windows.wait = Mock(side_effect=wait)
+        item = upnp.Item.from_values({'id': '903106335', 'title': SHOW_ONE_EP_ONE, 'size': 5,
+                                      'url': 'http://192.168.1.147:49152/web/903106335'})
+        throughput = Mock()
+        controller = Mock()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"', '--buffer=0'])
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            result = {'recorded': False}
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()), \
+                    patch('time.monotonic', lambda: clock[0]):
+                fetchtv.save_item(item, f'{temp_dir}{os.path.sep}test.mpeg', result, saved_files, options,
+                                  throughput=throughput, controller=controller, windows=windows)
+            self.assertTrue(result['recorded'])
+            self.assertEqual(8 * 3600, result['paused'])
+            # Only the transfer is measured
+            self.assertEqual(0, throughput.add.call_args[0][1])
+            self.assertEqual(0, controller.release.call_args[0][0])
+
+
+class TestThroughputHistory(unittest.TestCase):
+
+    def test_estimate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = fetchtv.ThroughputHistory.load(temp_dir)
+            self.assertIsNone(history.estimate([100]))
+            history.add(100, 1)
+            history.add(300, 1)
+            history = fetchtv.ThroughputHistory.load(temp_dir)
+            self.assertEqual(200, history.get_rate())
+            self.assertEqual(3, history.estimate([200, 200, 200]))
+            # The last download starts on whichever worker finishes first
+            self.assertEqual(2, history.estimate([200, 200, 200], workers=2))
+            self.assertEqual(2, history.estimate([400, 200, 200], workers=2))
+            self.assertEqual(2, history.estimate([400], workers=4))
+
+
+class TestProgressReporter(unittest.TestCase):
+
+    def test_aggregate_progress(self):
+        output = io.StringIO()
+        reporter = fetchtv.ProgressReporter(stream=output, interval=60)
+        first = reporter.start('first', 1000)
+        second = reporter.start('second', 3000)
+        first.bytes += 500
+        second.bytes += 1500
+        status = reporter.get_status()
+        self.assertEqual(2, status['active'])
+        self.assertEqual(2000, status['bytes'])
+        self.assertEqual(4000, status['total'])
+
+        # Not a terminal, so progress is logged as lines
+        reporter.report()
+        self.assertTrue(output.getvalue().find('2 downloading') != -1)
+        self.assertTrue(output.getvalue().endswith('\n'))
+
+        reporter.finish(first)
+        reporter.finish(second)
+        self.assertEqual(0, reporter.get_status()['active'])
+
+    def test_format_status(self):
+        reporter = fetchtv.ProgressReporter()
+        self.assertEqual('2 downloading, 1.5 MB of 3.0 MB, 512.0 KB/s, ETA 0:00:03',
+                         reporter.format_status({'active': 2, 'bytes': 1536 * 1024, 'total': 3 * 1024 * 1024,
+                                                 'rate': 512 * 1024, 'eta': 3}))
+
+
+class TestPostProcessor(unittest.TestCase):
+
+    @staticmethod
+    def get_command(script):
+        return f'"{sys.executable}" -c "{script}" {{file}} {{title}}'
+
+    def test_post_process_item(self):
+        item = Mock()
+        item.title = SHOW_ONE_EP_ONE
+        results = []
+        post_processor = fetchtv.PostProcessor(
+            self.get_command("import sys; sys.exit(sys.argv[1:] != ['show.mpeg', 'S4 E12'])"),
+            processes=2, callback=lambda itm, file_path, result: results.append(result))
+        result = {'recorded': True}
+        post_processor.submit(item, 'show.mpeg', result)
+        post_processor.shutdown()
+        self.assertEqual([result], results)
+        self.assertEqual('success', result['postprocess']['status'])
+        self.assertEqual(0, result['postprocess']['returncode'])
+
+    def test_post_process_failure(self):
+        item = Mock()
+        item.title = SHOW_ONE_EP_ONE
+        post_processor = fetchtv.PostProcessor(
+            self.get_command("import sys; sys.stderr.write('bad file'); sys.exit(3)"))
+        result = {'recorded': True}
+        post_processor.submit(item, 'show.mpeg', result)
+        post_processor.shutdown()
+        self.assertEqual('failed', result['postprocess']['status'])
+        self.assertEqual(3, result['postprocess']['returncode'])
+        self.assertEqual('bad file', result['postprocess']['error'])
+
+    def test_post_processed_unchanged(self):
+        def mock_get_content(p_url, timeout=0, stream=False, headers=None):
+            result = mock_get(p_url)
+            result.__exit__ = Mock(return_value=False)
+            result.iter_content = Mock(return_value=[b'abc', b'def'])
+            return result
+
+        item = upnp.Item.from_values({'id': '903106335', 'title': SHOW_ONE_EP_ONE, 'size': 6,
+                                      'url': 'http://192.168.1.147:49152/web/903106335'})
+        # Rewrites the recording, e.g. with the adverts cut
+        script = "import sys; open(sys.argv[1], 'wb').write(b'abc')"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            options = fetchtv.Options([CMD_RECORDINGS, f'{OPTION_SAVE}="{temp_dir}"', '--overwrite=changed',
+                                       f'--postprocess={sys.executable} -c "{script}" {{file}}'])
+            file_path = fetchtv.get_file_path(temp_dir, {'title': SHOW_ONE}, item)
+            os.makedirs(os.path.dirname(file_path))
+            saved_files = fetchtv.SavedFiles.load(temp_dir)
+            post_processor = fetchtv.PostProcessor(
+                options.postprocess, callback=lambda itm, path, result: fetchtv.post_processed(
+                    itm, path, result, saved_files, options))
+            result = {'recorded': False}
+            with patch('requests.get', mock_get_content), redirect_stdout(io.StringIO()):
+                fetchtv.save_item(item, file_path, result, saved_files, options, post_processor)
+                post_processor.shutdown()
+            self.assertEqual('success', result['postprocess']['status'])
+            self.assertEqual('abc', get_file(file_path))
+            # The processed file isn't taken as changed and downloaded again
+            self.assertTrue(saved_files.is_unchanged(item, file_path))
+
+
 class TestUtils(unittest.TestCase):
 
     def test_valid_filename(self):
@@ -387,6 +2006,16 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(len(fetchtv.create_valid_filename('abc' * 85)), 255)
         self.assertEqual(len(fetchtv.create_valid_filename('abc' * 86)), 255)
 
+    def test_filtered_item(self):
+        item = upnp.Item(upnp.ElementTree.fromstring(
+            '<item xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" '
+            'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" id="1" parentID="60">'
+            '<upnp:class>object.item.videoItem.movie</upnp:class><dc:title>S4 E2</dc:title></item>'))
+        self.assertEqual('S4 E2', item.title)
+        self.assertEqual('', item.url)
+        self.assertEqual(0, item.size)
+        self.assertEqual(0, item.duration)
+
     def test_ts_to_seconds(self):
         self.assertEqual(upnp.ts_to_seconds('00:31:27'), 1887)
         self.assertEqual(upnp.ts_to_seconds('03:31:27'), 12687)